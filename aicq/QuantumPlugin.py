@@ -7,8 +7,11 @@ import logging
 
 import aicq
 import nvplib
-from quantum.common import exceptions as exception
+from aicq import lazy
+from aicq import metrics
 
+# quantum is only imported once an error has to be raised
+exception = lazy.LazyModule("quantum.common.exceptions")
 
 LOG = logging.getLogger("aicq-quantumplugin")
 LOG.setLevel(logging.INFO)
@@ -102,7 +105,7 @@ class NvpPlugin(object):
                 remote_vifs.append(vic["vif_uuid"])
 
         if not result:
-            result = nvplib.get_networks(self.blue, switch)
+            result = nvplib.get_network(self.blue, switch)
 
         d = {
                 "id": netw_id,
@@ -114,6 +117,26 @@ class NvpPlugin(object):
                   (tenant_id, d))
         return d
 
+    def get_networks_details(self, tenant_id, net_ids):
+        """
+        Not required by quantum_plugin_base.py
+        Retrieves the details of many networks in one go, reading the
+        tenant's switches once and their ports concurrently.
+
+        :returns: a mapping of net id to the get_network_details() result
+                  of that network:
+                    {'<net id>': {'id': ..., 'name': ..., 'ifaces': [...],
+                                  'net-op-status': 'UP'},
+                     ...
+                    }
+                  networks not found for the tenant are left out
+        :raises: exception.QuantumException
+        """
+        details = nvplib.get_networks_details(self.blue, tenant_id, net_ids)
+        LOG.debug("get_networks_details() completed for tenant %s: %s" %
+                  (tenant_id, details))
+        return details
+
     def update_network(self, tenant_id, netw_id, **kwargs):
         """
         Updates the properties of a particular Virtual Network.
@@ -197,6 +220,77 @@ class NvpPlugin(object):
         LOG.debug("create_port() completed for tenant %s: %s" % (tenant_id, d))
         return d
 
+    def create_and_plug_port(self, tenant_id, netw_id, remote_interface_id,
+                             port_init_state=None, **params):
+        """
+        Not required by quantum_plugin_base.py
+        Creates a port on the specified Virtual Network and attaches the
+        remote interface to it, what create_port() followed by
+        plug_interface() does with the tenant checked only once and in
+        two controller round trips.
+
+        :returns: a mapping sequence with the following signature:
+                    {'id': uuid representing the created port
+                              on specified quantum network,
+                     'port-op-status': 'UP' or 'DOWN',
+                     'attachment': the remote interface id
+                   }
+                  if the interface cannot be attached the port is removed
+                  again
+        :raises: exception.NetworkNotFound
+        :raises: exception.StateInvalid
+        :raises: exception.AlreadyAttached
+        """
+        if not nvplib.check_tenant(self.blue, netw_id, tenant_id):
+            raise exception.NetworkNotFound(net_id=netw_id)
+        params["controller"] = self.blue
+        result = nvplib.create_and_plug_port(tenant_id, netw_id,
+                                             remote_interface_id,
+                                             port_init_state, **params)
+        d = {
+            "id": result["uuid"],
+            "port-op-status": result["port-op-status"],
+            "attachment": remote_interface_id,
+        }
+        LOG.debug("create_and_plug_port() completed for tenant %s: %s" %
+                  (tenant_id, d))
+        return d
+
+    def create_ports(self, tenant_id, netw_id, count_or_specs,
+                     port_init_state=None, **params):
+        """
+        Not required by quantum_plugin_base.py
+        Creates many ports on the specified Virtual Network in one go. The
+        tenant and network are checked once and the ports are created
+        concurrently.
+
+        count_or_specs is the number of ports to create or a list of port
+        specs, mappings whose optional 'state' takes the place of
+        port_init_state for that port.
+
+        :returns: a list of mappings in the order the ports were asked for:
+                    [{'id': uuid representing the created port
+                            on specified quantum network,
+                      'port-op-status': 'UP' or 'DOWN'},
+                     ...
+                    ]
+                  if any port cannot be created the others are removed
+                  again and nothing is returned
+        :raises: exception.NetworkNotFound
+        :raises: exception.StateInvalid
+        """
+        if not nvplib.check_tenant(self.blue, netw_id, tenant_id):
+            raise exception.NetworkNotFound(net_id=netw_id)
+        params["controller"] = self.blue
+        results = nvplib.create_ports(tenant_id, netw_id, count_or_specs,
+                                      port_init_state, **params)
+        ports = [{"id": result["uuid"],
+                  "port-op-status": result["port-op-status"]}
+                 for result in results]
+        LOG.debug("create_ports() completed for tenant %s: %s" %
+                  (tenant_id, ports))
+        return ports
+
     def update_port(self, tenant_id, netw_id, portw_id, **params):
         """
         Updates the properties of a specific port on the
@@ -262,17 +356,16 @@ class NvpPlugin(object):
         """
         if not nvplib.check_tenant(self.blue, netw_id, tenant_id):
             raise exception.NetworkNotFound(net_id=netw_id)
-        port = nvplib.get_port(self.controller, netw_id, portw_id,
+        port = nvplib.get_port(self.blue, netw_id, portw_id,
                                "LogicalPortAttachment")
         state = "ACTIVE" if port["admin_status_enabled"] else "DOWN"
         op_status = nvplib.get_port_status(self.blue, netw_id, portw_id)
 
-        relation = port["relation"]
-        attach_type = relation["LogicalPortAttachment"]["type"]
+        attachment = port["_relations"]["LogicalPortAttachment"]
 
         vif_uuid = "None"
-        if attach_type == "VifAttachment":
-            vif_uuid = relation["logicalPortAttachment"]["vif_uuid"]
+        if attachment["type"] == "VifAttachment":
+            vif_uuid = attachment["vif_uuid"]
 
         d = {
             "id": portw_id, "attachment": vif_uuid,
@@ -317,6 +410,70 @@ class NvpPlugin(object):
         LOG.debug("unplug_interface() compelted for tenant %s: %s" %
                 (tenant_id, result))
 
+    def plug_interfaces(self, tenant_id, attachments, **params):
+        """
+        Not required by quantum_plugin_base.py
+        Attaches many remote interfaces at once, as when a host is
+        evacuated. attachments is a list of
+        (net id, port id, remote interface id). The tenant is checked once
+        per network and the attachments are made concurrently, at most
+        params['max_workers'] at a time. A failed attachment does not stop
+        the others.
+
+        :returns: a list of mappings in the order of attachments:
+                    [{'net-id': ..., 'port-id': ..., 'attachment': ...,
+                      'error': None, or the exception plug_interface()
+                               would raise (NetworkNotFound, PortNotFound,
+                               AlreadyAttached, ...)
+                     },
+                     ...
+                    ]
+        """
+        results = self._batch(tenant_id, attachments, nvplib.plug_interfaces,
+                              params.get("max_workers"))
+        LOG.debug("plug_interfaces() completed for tenant %s: %s" %
+                  (tenant_id, results))
+        return results
+
+    def unplug_interfaces(self, tenant_id, ports, **params):
+        """
+        Not required by quantum_plugin_base.py
+        Detaches the remote interfaces of many (net id, port id) at once
+        like plug_interfaces() attaches them.
+
+        :returns: a list of mappings in the order of ports:
+                    [{'net-id': ..., 'port-id': ...,
+                      'error': None, or the exception unplug_interface()
+                               would raise
+                     },
+                     ...
+                    ]
+        """
+        results = self._batch(tenant_id, ports, nvplib.unplug_interfaces,
+                              params.get("max_workers"))
+        LOG.debug("unplug_interfaces() completed for tenant %s: %s" %
+                  (tenant_id, results))
+        return results
+
+    def _batch(self, tenant_id, items, run, max_workers):
+        """Runs run(blue, items) for the items, tuples starting with
+        (net id, port id), on networks the tenant owns and fails the
+        others with the error of their ownership check"""
+        checks = nvplib.check_tenants(self.blue, [i[0] for i in items],
+                                      tenant_id)
+        owned = [i for i in items if checks[i[0]] is None]
+        outcomes = iter(run(self.blue, owned, max_workers=max_workers))
+        results = []
+        for item in items:
+            error = checks[item[0]]
+            if error is None:
+                error = outcomes.next()[2]
+            result = {"net-id": item[0], "port-id": item[1], "error": error}
+            if len(item) > 2:
+                result["attachment"] = item[2]
+            results.append(result)
+        return results
+
     def get_port_stats(self, tenant_id, network_id, port_id):
         """
         Not required by quantum_plugin_base.py
@@ -338,3 +495,6 @@ class NvpPlugin(object):
         if not nvplib.check_tenant(self.blue, network_id, tenant_id):
             raise exception.NetworkNotFound(net_id=network_id)
         return nvplib.get_port_stats(self.blue, network_id, port_id)
+
+
+metrics.instrument(NvpPlugin, "plugin", lambda plugin: plugin.blue.metrics)
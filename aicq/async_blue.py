@@ -0,0 +1,102 @@
+"""Non-blocking front ends for Blue and nvplib. Every call is queued on a
+worker pool and a pool.Future is returned right away, so thousands of
+port operations can be in flight without a thread per caller.
+
+    ablue = AsyncBlue("nvp.ini")
+    futures = [ablue.create_enabled_port(tenant, net_id) for i in range(100)]
+    ports = pool.wait_all(futures)
+
+Requests still go through Blue._request, so controller selection, circuit
+breakers and failover behave as they do for Blue. A request that fails
+over gives up its slot on the failed controller before it is retried on
+the next one.
+"""
+import threading
+
+import aicq.blue
+from aicq import pool
+
+
+DEFAULT_PER_CONTROLLER = 20
+
+
+class AsyncBlue(object):
+    """Wraps a Blue so that each of its public methods returns a Future.
+
+    At most max_per_controller of the requests made through it are in
+    flight to any controller; the rest wait in the queue. Callers using
+    the Blue directly are not held back by this limit, only by
+    CONTROLLER_CONCURRENCY.
+    """
+
+    def __init__(self, config_file=None, blue=None,
+                 max_per_controller=DEFAULT_PER_CONTROLLER):
+        if blue is None:
+            blue = aicq.blue.Blue(config_file)
+        self.blue = blue
+        self.max_per_controller = max_per_controller
+        self.limits = {}
+        workers = max_per_controller * max(1, len(blue.connections))
+        self.executor = pool.Executor(workers)
+
+    def _limit(self, conn):
+        limit = self.limits.get(conn.conn_id)
+        if limit is None:
+            limit = self.limits.setdefault(
+                    conn.conn_id,
+                    threading.BoundedSemaphore(self.max_per_controller))
+        return limit
+
+    def submit(self, func, *args, **kwargs):
+        """Queues func(*args, **kwargs), whose requests count against the
+        limits of this AsyncBlue, and returns its Future"""
+        return self.executor.submit(self.blue._with_limit, self._limit,
+                                    func, *args, **kwargs)
+
+    def __getattr__(self, name):
+        attr = getattr(self.blue, name)
+        if name.startswith("_") or not callable(attr):
+            return attr
+
+        def submit(*args, **kwargs):
+            return self.submit(attr, *args, **kwargs)
+        submit.__name__ = name
+        submit.__doc__ = attr.__doc__
+        return submit
+
+    def shutdown(self):
+        self.executor.shutdown()
+        self.blue.selector.stop_probe()
+
+
+class AsyncNvplib(object):
+    """The functions of aicq.nvplib returning Futures. Wherever nvplib
+    takes a controller an AsyncBlue can be passed; its Blue is used.
+
+        anvp = AsyncNvplib(ablue)
+        future = anvp.create_port(tenant, net_id, "ACTIVE", controller=ablue)
+    """
+
+    def __init__(self, async_blue):
+        self.async_blue = async_blue
+
+    def _unwrap(self, value):
+        if isinstance(value, AsyncBlue):
+            return value.blue
+        return value
+
+    def __getattr__(self, name):
+        # nvplib pulls in quantum, only load it once it is used
+        import aicq.nvplib
+        func = getattr(aicq.nvplib, name)
+        if name.startswith("_") or not callable(func):
+            return func
+
+        def submit(*args, **kwargs):
+            args = [self._unwrap(a) for a in args]
+            if "controller" in kwargs:
+                kwargs["controller"] = self._unwrap(kwargs["controller"])
+            return self.async_blue.submit(func, *args, **kwargs)
+        submit.__name__ = name
+        submit.__doc__ = func.__doc__
+        return submit
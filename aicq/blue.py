@@ -16,20 +16,45 @@ quantum/plugins/nicera variety.
 import csv
 import ConfigParser
 import logging
-import sys
+import socket
+import threading
+import time
 
 import aiclib
+import urllib3
+
+from aicq import breaker as circuit
+from aicq import cache
+from aicq import metrics
+from aicq import pool
+from aicq import selector
+from aicq import singleflight
 # from quantum.common import exceptions as exception
 
 LOG = logging.getLogger("aicq-blue")
 LOG.setLevel(logging.INFO)
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-formatter = logging.Formatter(
-        '%(asctime)s - %(levelname)s - %(name)s - %(message)s')
-ch.setFormatter(formatter)
-LOG.addHandler(ch)
 LOG.propagate = True
+_log_lock = threading.Lock()
+_log_ready = False
+
+
+def _setup_logging():
+    """Gives the aicq-blue logger its console handler. This waits for the
+    first Blue instead of happening on import, and is skipped when the
+    application has already configured logging."""
+    global _log_ready
+    with _log_lock:
+        if _log_ready:
+            return
+        _log_ready = True
+        if LOG.handlers or logging.getLogger().handlers:
+            return
+        ch = logging.StreamHandler()
+        ch.setLevel(logging.DEBUG)
+        formatter = logging.Formatter(
+                '%(asctime)s - %(levelname)s - %(name)s - %(message)s')
+        ch.setFormatter(formatter)
+        LOG.addHandler(ch)
 
 
 DEFAULT_REQUEST_TIMEOUT = 30
@@ -37,23 +62,324 @@ DEFAULT_HTTP_TIMEOUT = 10
 DEFAULT_RETRIES = 2
 DEFAULT_REDIRECTS = 2
 API_REQUEST_POOL_SIZE = 10000
+DEFAULT_PAGE_SIZE = 1000
+# the fields check_tenant and check_network_existance read
+OWNER_FIELDS = ("uuid", "tags")
+EXISTS_FIELDS = ("uuid",)
 CONFIG_FILE = "my.ini"
 CONFIG_KEYS = ["DEFAULT_TZ_UUID", "NVP_CONTROLLER_IP", "PORT", "USER",
                "PASSWORD"]
+# Optional tuning keys in the NVP section with their defaults
+CONFIG_OPTIONS = {
+    "OWNERSHIP_CACHE_TTL": cache.DEFAULT_OWNERSHIP_TTL,
+    "OWNERSHIP_CACHE_SIZE": cache.DEFAULT_OWNERSHIP_SIZE,
+    "OWNERSHIP_CACHE_LOCAL_TTL": cache.DEFAULT_OWNERSHIP_LOCAL_TTL,
+    "TRUST_CONTROLLER": False,
+    "BULK_CONCURRENCY": pool.DEFAULT_WORKERS,
+    # seconds between health probes of every controller, 0 turns them off
+    "HEALTH_CHECK_INTERVAL": 0,
+    "BREAKER_THRESHOLD": circuit.DEFAULT_THRESHOLD,
+    "BREAKER_COOLDOWN": circuit.DEFAULT_COOLDOWN,
+    "CONTROLLER_CONCURRENCY": 0,
+    "PAGE_SIZE": DEFAULT_PAGE_SIZE,
+    "OBJECT_CACHE_SIZE": cache.DEFAULT_OBJECT_SIZE,
+    "OBJECT_CACHE_TTL": cache.DEFAULT_OBJECT_TTL,
+    "OBJECT_CACHE_BYTES": cache.DEFAULT_OBJECT_BYTES,
+    # space separated host:port list of memcached servers shared by all
+    # the API workers, the caches stay per process when empty
+    "CACHE_SERVERS": "",
+    "COALESCE_READS": True,
+    # space separated sinks to time calls with: memory, prometheus, statsd
+    "METRICS": "",
+    "STATSD_ADDRESS": "127.0.0.1:%d" % metrics.DEFAULT_STATSD_PORT,
+}
+# Errors that mean the controller could not be reached rather than that it
+# refused the request; these are retried on another controller
+CONTROLLER_ERRORS = (aiclib.nvp.ServiceUnavailable, aiclib.nvp.RequestTimeout,
+                     urllib3.exceptions.HTTPError, socket.error)
+
+
+class NetworkNotFound(aiclib.nvp.ResourceNotFound):
+    message = "The logical switch referenced in the request was not found."
+
+    def __init__(self, uuid):
+        super(NetworkNotFound, self).__init__(uuid)
+        self.uuid = uuid
+
+
+class PortNotFound(aiclib.nvp.ResourceNotFound):
+    message = "The logical port referenced in the request was not found."
+
+    def __init__(self, uuid):
+        super(PortNotFound, self).__init__(uuid)
+        self.uuid = uuid
+
+
+class ControllerUnavailable(aiclib.nvp.ServiceUnavailable):
+    message = "The circuit breaker of every NVP controller is open."
+
+
+class ControllerEndpoint(object):
+    """One NVP controller. The URI and timeouts are worked out once from
+    the config strings; errors and requests are counted under a lock.
+    Reading it like the dicts that used to describe controllers,
+    conn['ip'], still works."""
+
+    __slots__ = ("conn_id", "ip", "port", "username", "password",
+                 "default_tz", "request_timeout", "http_timeout", "retries",
+                 "redirects", "uri", "timeout", "errors", "requests",
+                 "_lock")
+    FIELDS = ("conn_id", "ip", "port", "username", "password", "default_tz",
+              "request_timeout", "http_timeout", "retries", "redirects",
+              "uri", "errors", "requests")
+
+    def __init__(self, conn_id, ip, port, username, password, default_tz,
+                 request_timeout=DEFAULT_REQUEST_TIMEOUT,
+                 http_timeout=DEFAULT_HTTP_TIMEOUT, retries=DEFAULT_RETRIES,
+                 redirects=DEFAULT_REDIRECTS):
+        self.conn_id = conn_id
+        self.ip = ip
+        self.port = str(port)
+        self.username = username
+        self.password = password
+        self.default_tz = default_tz
+        self.request_timeout = int(request_timeout)
+        self.http_timeout = int(http_timeout)
+        self.retries = int(retries)
+        self.redirects = int(redirects)
+        self.uri = self._uri()
+        # http_timeout bounds connecting and each read, request_timeout
+        # bounds the whole request
+        self.timeout = urllib3.Timeout(total=self.request_timeout,
+                                       connect=self.http_timeout,
+                                       read=self.http_timeout)
+        self.errors = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _uri(self):
+        """Ports other than 443 are spoken to over plain http and kept in
+        the URI"""
+        if 'http' in self.ip:
+            return self.ip
+        if self.port == "443":
+            return "https://%s" % self.ip
+        return "http://%s:%s" % (self.ip, self.port)
+
+    def record_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self.FIELDS:
+            return default
+        return getattr(self, key)
+
+    def to_dict(self):
+        return dict((key, getattr(self, key)) for key in self.FIELDS)
+
+    def __repr__(self):
+        return "<ControllerEndpoint %s %s>" % (self.conn_id, self.uri)
+
+
+class ControllerPool(object):
+    """The keep-alive connection pool of one controller, handed to aiclib
+    as its poolmanager. aiclib asks it for a pool with
+    connection_from_url(uri, retries=..., socket_options=...), which
+    urllib3's PoolManager does not accept, so those are added to the pool
+    settings here."""
+
+    def __init__(self, **pool_kw):
+        self.pool_kw = pool_kw
+        self.pools = {}
+        self._lock = threading.Lock()
+
+    def connection_from_url(self, url, **pool_kw):
+        with self._lock:
+            http_pool = self.pools.get(url)
+            if http_pool is None:
+                kwargs = dict(self.pool_kw)
+                kwargs.update(pool_kw)
+                http_pool = urllib3.connection_from_url(url, **kwargs)
+                self.pools[url] = http_pool
+            return http_pool
+
+
+class _Unlimited(object):
+    """Stands in for a semaphore when requests are not limited"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_UNLIMITED = _Unlimited()
+
+
+def _not_sent(error):
+    """Returns whether error shows the request never reached the
+    controller, i.e. the connection could not be made"""
+    if isinstance(error, urllib3.exceptions.MaxRetryError):
+        error = error.reason
+    return isinstance(error, urllib3.exceptions.ConnectTimeoutError)
+
+
+def _answered(error):
+    """Returns whether error is the controller's answer to a request.
+    Anything else, such as the UnboundLocalError aiclib raises after a
+    read timed out, means the controller did not answer. A failed login
+    surfaces as a bare IOError('401', ...) and counts as an answer, since
+    another controller would turn the same credentials down."""
+    if isinstance(error, CONTROLLER_ERRORS):
+        return False
+    if isinstance(error, aiclib.nvp.NVPException):
+        return True
+    if isinstance(error, IOError) and error.errno == '401':
+        return True
+    return getattr(error, "code", None) == 401
+
+
+def _tag_scope(tag):
+    return tag.get('tag_scope') or tag.get('scope')
+
+
+def _tenant_filter(tags):
+    """Returns the tenant an os_tid tag filter in tags asks for, or None"""
+    for t in tags:
+        if _tag_scope(t) == 'os_tid':
+            return t.get('tag')
+    return None
+
+
+def _filter_tags(query, tags):
+    """Adds the {'tag': <tag>, 'tag_scope': <scope>} filters in tags to
+    query. The controller pairs the n-th tag parameter with the n-th
+    tag_scope one, and aiclib sends a list as repeated parameters."""
+    query.tags([t.get('tag') for t in tags])
+    query.tagscopes([_tag_scope(t) for t in tags])
+
+
+def _field_list(fields):
+    """Returns fields as a tuple of names, or None when every field is
+    wanted"""
+    if fields in (None, "*"):
+        return None
+    if isinstance(fields, basestring):
+        fields = fields.split(",")
+    return tuple(fields)
+
+
+def _project(document, fields):
+    """Returns the uuid and the given fields of a document. Relations come
+    along when the document has them."""
+    wanted = set(fields) | set(["uuid", "_relations"])
+    return dict((k, v) for k, v in document.items() if k in wanted)
+
+
+def _read_one(query, uuid, fields, relations=None):
+    """Reads a single entity through query, which unlike a read can be
+    limited to the given fields and ask for relations. All fields are
+    read when fields is None."""
+    query.uuid(uuid)
+    query.fields(fields and list(fields) or "*")
+    if relations:
+        query.relations(relations)
+    results = query.results().get("results") or []
+    if not results:
+        raise aiclib.nvp.ResourceNotFound()
+    return results[0]
+
+
+def _paginate(query, page_size, cursor):
+    if page_size:
+        query.length(page_size)
+    if cursor:
+        # the same key NVPEntityQuery.next() sets for the following page
+        query.query['_page_cursor'] = cursor
+
+
+def _iterate_pages(fetch):
+    """Yields the results of fetch(cursor) page after page until the
+    controller stops handing out a page_cursor"""
+    cursor = None
+    while True:
+        page = fetch(cursor)
+        if not page:
+            return
+        for item in page.get("results", []):
+            yield item
+        cursor = page.get("page_cursor")
+        if not cursor:
+            return
+
+
+def _delete_report(outcomes):
+    """Sorts pool.run outcomes of delete requests into the uuids that were
+    deleted, the ones that were already gone and the ones that failed"""
+    report = {"deleted": [], "not_found": [], "failed": {}}
+    for uuid, result, error in outcomes:
+        if error is None:
+            report["deleted"].append(uuid)
+        elif isinstance(error, aiclib.nvp.ResourceNotFound):
+            report["not_found"].append(uuid)
+        else:
+            report["failed"][uuid] = error
+    return report
+
+
+def _log_failures(action, outcomes):
+    failed = [o for o in outcomes if o[2] is not None]
+    if failed:
+        LOG.error("Failed to %s %d of %d ports" %
+                  (action, len(failed), len(outcomes)))
 
 
 class Blue(object):
+    """cache_backend is a cache.CacheBackend shared by the ownership and
+    object caches. It takes precedence over CACHE_SERVERS in the config."""
 
-    def __init__(self, config_file=None):
+    def __init__(self, config_file=None, cache_backend=None):
+        _setup_logging()
+        self.metrics = metrics.Metrics()
         self.connections = []
         self.conn_count = 0
         self.conn_error = False
-        self.aic = None
+        self.clients = {}
+        self.http_pools = {}
+        self.options = dict(CONFIG_OPTIONS)
+        self.ownership = cache.OwnershipCache()
+        self.objects = cache.ObjectCache()
+        self.cache_backend = cache_backend
+        self.flights = singleflight.SingleFlight()
+        self.trust_controller = False
+        self.bulk_concurrency = pool.DEFAULT_WORKERS
+        self.selector = selector.ControllerSelector(self.connections)
+        self.breakers = {}
+        self.limits = {}
+        self.controller_concurrency = 0
+        self.page_size = DEFAULT_PAGE_SIZE
+        self._clients_lock = threading.Lock()
+        self._local = pool.InheritedLocal()
+        self.conn = None
         try:
             self.load_config(config_file)
             self.conn = self.connections[0]
         except Exception, e:
             LOG.fatal("Configuration invalid. Unable to continue. %s" % e)
+            return
+        self.selector.start_probe(self._probe,
+                                  self.options["HEALTH_CHECK_INTERVAL"])
 
 # --------------------------------
 # Config functions
@@ -73,7 +399,10 @@ class Blue(object):
             LOG.info("Loading config file %s" % config_file)
             self.config.read(config_file)
             self._parse_config_file()
-            LOG.info("Loaded config: %s" % self.output_config())
+            self._parse_options()
+            LOG.info("Loaded config for %d controllers" %
+                     len(self.connections))
+            LOG.debug("Loaded config: %s" % self.output_config())
 
     def create_connection_object(self, ip, port, username, password, tzuuid,
                                  request_timeout=20, http_timeout=10,
@@ -84,33 +413,29 @@ class Blue(object):
 
     def _create_connection_object(self, info, tzuuid):
         try:
-            conn = {}
-            conn['ip'] = info[0]
-            conn['port'] = info[1]
-            conn['username'] = info[2]
-            conn['password'] = info[3]
-            conn['request_timeout'] = info[4]
-            conn['http_timeout'] = info[5]
-            conn['retries'] = info[6]
-            conn['redirects'] = info[7]
-            conn['default_tz'] = tzuuid
-            conn['conn_id'] = self.conn_count
-            conn['errors'] = 0
+            conn = ControllerEndpoint(self.conn_count, info[0], info[1],
+                                      info[2], info[3], tzuuid,
+                                      request_timeout=info[4],
+                                      http_timeout=info[5], retries=info[6],
+                                      redirects=info[7])
         except Exception, e:
-            raise AttributeError("Invalid conneciton parameters, %s", e)
+            raise AttributeError("Invalid conneciton parameters, %s" % e)
         self.conn_count += 1
         self.connections.append(conn)
 
     def _create_legacy_connection_object(self, info):
         try:
-            conn = {}
-            conn['ip'] = info["NVP_CONTROLLER_IP"]
-            conn['port'] = info["PORT"]
-            conn['username'] = info["USER"]
-            conn['password'] = info["PASSWORD"]
-            conn['default_tz'] = info["DEFAULT_TZ_UUID"]
+            if not isinstance(info, dict):
+                info = dict(zip(CONFIG_KEYS, info))
+            conn = ControllerEndpoint(self.conn_count,
+                                      info["NVP_CONTROLLER_IP"],
+                                      info["PORT"], info["USER"],
+                                      info["PASSWORD"],
+                                      info["DEFAULT_TZ_UUID"])
         except Exception, e:
             raise AttributeError("Invalid connection parameters, %s" % e)
+        self.conn_count += 1
+        self.connections.append(conn)
 
     def _parse_config_file(self):
         """This configuration parser is modeled after the legacy nicera
@@ -150,10 +475,52 @@ class Blue(object):
                 LOG.fatal("Invalid connection parameters: %s" % e)
                 raise e
 
+    def _parse_options(self):
+        """Reads the optional tuning keys, keeping the default for any key
+        that is missing or malformed"""
+        for key, default in CONFIG_OPTIONS.items():
+            if not self.config.has_option("NVP", key):
+                continue
+            try:
+                if isinstance(default, bool):
+                    value = self.config.getboolean("NVP", key)
+                else:
+                    value = type(default)(self.config.get("NVP", key))
+                self.options[key] = value
+            except ValueError:
+                LOG.error("Invalid value for %s, using %s" % (key, default))
+        self.ownership.ttl = self.options["OWNERSHIP_CACHE_TTL"]
+        self.ownership.max_entries = self.options["OWNERSHIP_CACHE_SIZE"]
+        self.ownership.local_ttl = self.options["OWNERSHIP_CACHE_LOCAL_TTL"]
+        self.objects.max_entries = self.options["OBJECT_CACHE_SIZE"]
+        self.objects.ttl = self.options["OBJECT_CACHE_TTL"]
+        self.objects.max_bytes = self.options["OBJECT_CACHE_BYTES"]
+        servers = self.options["CACHE_SERVERS"].split()
+        if self.cache_backend is None and servers:
+            self.cache_backend = cache.MemcachedBackend(servers)
+        self.ownership.shared = self.cache_backend
+        self.objects.shared = self.cache_backend
+        self.trust_controller = self.options["TRUST_CONTROLLER"]
+        self.bulk_concurrency = self.options["BULK_CONCURRENCY"]
+        self.controller_concurrency = self.options["CONTROLLER_CONCURRENCY"]
+        self.page_size = self.options["PAGE_SIZE"]
+        self.flights.enabled = self.options["COALESCE_READS"]
+        for name in self.options["METRICS"].split():
+            if name == "memory":
+                self.metrics.add_sink(metrics.MemorySink())
+            elif name == "prometheus":
+                self.metrics.add_sink(metrics.PrometheusSink())
+            elif name == "statsd":
+                self.metrics.add_sink(
+                        metrics.StatsdSink(self.options["STATSD_ADDRESS"]))
+            else:
+                LOG.error("Unknown metrics sink %s" % name)
+
     def output_config(self):
+        """Describes the controllers, leaving out their passwords"""
         output = "CONFIG:\nCONNECTIONS:\n"
         for conn in self.connections:
-            output += "%s" % conn
+            output += "%s" % dict(conn.to_dict(), password="****")
         return output
 
 # --------------------------------
@@ -162,41 +529,229 @@ class Blue(object):
 
     @property
     def connection(self):
-        if self.aic is None or self.conn != self._get_connection():
-            uri = self.conn['ip']
-            if 'http' not in self.conn['ip']:
-                scheme = "https" if self.conn['port'] == "443" else "http"
-                uri = "%s://%s" % (scheme, self.conn['ip'])
-            self.aic = aiclib.nvp.Connection(uri)
-        return self.aic
+        return self._client(self._get_connection())
+
+    def _client(self, conn):
+        """Returns the aiclib connection of a controller. One is built per
+        conn_id and kept, so its login session survives failing over to
+        another controller and back."""
+        aic = self.clients.get(conn.conn_id)
+        if aic is None:
+            with self._clients_lock:
+                aic = self.clients.get(conn.conn_id)
+                if aic is None:
+                    aic = self._new_client(conn)
+                    self.clients[conn.conn_id] = aic
+        return aic
+
+    def _new_client(self, conn):
+        return aiclib.nvp.Connection(
+                conn.uri, poolmanager=self._http_pool(conn),
+                username=conn.username, password=conn.password,
+                timeout=conn.timeout, retries=conn.retries)
+
+    def _http_pool(self, conn):
+        """Returns the keep-alive connection pool of a controller. Each
+        controller keeps its own pool for the life of Blue so connections
+        (and their TLS sessions) are reused across requests and failovers.
+        """
+        http_pool = self.http_pools.get(conn.conn_id)
+        if http_pool is None:
+            http_pool = ControllerPool(maxsize=API_REQUEST_POOL_SIZE,
+                                       block=False, timeout=conn.timeout)
+            self.http_pools[conn.conn_id] = http_pool
+        return http_pool
 
     @property
     def connection_description(self):
         return self._get_connection
 
-    def _get_connection(self):
-        if not self.conn_error:
-            return self.conn
-        self.aic = None
-        min_errors = sys.maxint
-        ret = self.conn
-        for conn in self.connections:
-            if conn['errors'] < min_errors:
-                ret = conn
-                min_errors = conn['errors']
-        self.conn = ret
+    def _get_connection(self, exclude=()):
+        """Returns the controller requests should go to, the fastest
+        healthy one as seen by the selector"""
+        conn = self.selector.select(current=self.conn, exclude=exclude)
+        if conn is not self.conn:
+            LOG.info("Switching to controller %s" % conn.ip)
+            self.conn = conn
         return self.conn
 
     @property
     def default_zone(self):
-        return self._get_connection()['default_tz']
+        return self._get_connection().default_tz
 
     def _connection_error(self, connection):
         self.conn_error = True
-        connection['errors'] += 1
+        connection.record_error()
+        self.selector.record_failure(connection)
+
+    def _request(self, call, idempotent=True):
+        """Runs call(connection), a request against the controller picked
+        by _get_connection. Controllers whose circuit breaker is open are
+        skipped and ControllerUnavailable is raised at once if none is
+        left. When the controller cannot be reached the request is retried
+        on another one, up to the retries configured for the controller.
+        Requests that are not idempotent, such as creates, are only
+        retried when the connection could not be made, as otherwise the
+        first controller may already have carried them out.
+        The latency of every answered request is fed back to the selector.
+        """
+        failed = []
+        skipped = []
+        while True:
+            unavailable = [c for c in self.connections
+                           if c in failed or c in skipped or
+                           not self._breaker(c).available()]
+            if len(unavailable) >= len(self.connections):
+                if failed:
+                    raise last_error
+                LOG.error("No controller available, all breakers open")
+                raise ControllerUnavailable()
+            conn = self._get_connection(exclude=unavailable)
+            breaker = self._breaker(conn)
+            if not breaker.acquire():
+                skipped.append(conn)
+                continue
+            connection = self._client(conn)
+            conn.record_request()
+            with self._limit(conn):
+                start = time.time()
+                try:
+                    result = call(connection)
+                except Exception, e:
+                    self._observe_request(conn, start, e)
+                    if _answered(e):
+                        breaker.record_success()
+                        self.selector.record_success(conn,
+                                                     time.time() - start)
+                        raise
+                    breaker.record_failure()
+                    self._connection_error(conn)
+                    failed.append(conn)
+                    last_error = e
+                    if len(failed) > conn.retries:
+                        raise
+                    if not idempotent and not _not_sent(e):
+                        raise
+                    LOG.warning("Request to %s failed (%s), retrying on "
+                                "another controller" % (conn.ip, e))
+                    if self.metrics.enabled:
+                        self.metrics.incr(metrics.FAILOVER,
+                                          {"conn_id": conn.conn_id})
+                    continue
+                self._observe_request(conn, start)
+                breaker.record_success()
+                self.selector.record_success(conn, time.time() - start)
+                return result
+
+    def _observe_request(self, conn, start, error=None):
+        if self.metrics.enabled:
+            self.metrics.observe(metrics.REQUEST,
+                                 {"op": self.metrics.operation(),
+                                  "conn_id": conn.conn_id},
+                                 time.time() - start, error)
+
+    def _limit(self, conn):
+        """Returns the semaphore bounding the requests in flight to conn,
+        or a no-op when CONTROLLER_CONCURRENCY is 0. Calls made through
+        _with_limit use the limit they were given instead."""
+        limit = getattr(self._local, "limit", None)
+        if limit is not None:
+            return limit(conn)
+        if self.controller_concurrency <= 0:
+            return _UNLIMITED
+        limit = self.limits.get(conn.conn_id)
+        if limit is None:
+            limit = self.limits.setdefault(
+                    conn.conn_id,
+                    threading.BoundedSemaphore(self.controller_concurrency))
+        return limit
+
+    def _with_limit(self, limit, func, *args, **kwargs):
+        """Calls func, bounding the requests it sends by limit(conn), a
+        semaphore per controller, rather than by CONTROLLER_CONCURRENCY.
+        The workers of any pool.run it makes are bound by limit too."""
+        outer = getattr(self._local, "limit", None)
+        self._local.limit = limit
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._local.limit = outer
+
+    def _breaker(self, conn):
+        breaker = self.breakers.get(conn.conn_id)
+        if breaker is None:
+            breaker = self.breakers.setdefault(
+                    conn.conn_id,
+                    circuit.CircuitBreaker(self.options["BREAKER_THRESHOLD"],
+                                           self.options["BREAKER_COOLDOWN"]))
+        return breaker
 
-    def connection_test(self):
-        return self.connection.nvp_function().logout()
+    def breaker_states(self):
+        """Returns the circuit breaker state of every controller keyed by
+        conn_id, e.g. {0: {'ip': 'nvp1', 'state': 'open', 'failures': 5,
+        'opened_at': <time>, 'trips': 1}}"""
+        states = {}
+        for conn in self.connections:
+            state = self._breaker(conn).to_dict()
+            state['ip'] = conn.ip
+            states[conn.conn_id] = state
+        return states
+
+    def _probe(self, conn):
+        """The health probe: reads the default transport zone through the
+        cached client of conn, so probing does not log in every time. A
+        zone that is not found still shows the controller answers."""
+        try:
+            self._client(conn).zone(conn.default_tz).read()
+        except aiclib.nvp.ResourceNotFound:
+            pass
+
+    def connection_test(self, conn=None):
+        """Logs in and out of a controller, the current one by default.
+        A fresh client is used for an explicit conn so the session of the
+        shared client is left alone."""
+        if conn is None:
+            return self.connection.nvp_function().logout()
+        return self._new_client(conn).nvp_function().logout()
+
+    def controller_stats(self):
+        """Returns the rolling latency, error rate and health of every
+        controller keyed by conn_id"""
+        return self.selector.report()
+
+    def _read(self, key, call, fresh=False):
+        """Like _request for reads. Concurrent reads with the same key,
+        e.g. ("lport", net_id, port_id, relations), share one request.
+        A fresh read is sent on its own, as the one in flight may have
+        been sent before a change the caller knows of."""
+        if fresh:
+            return self._request(call)
+        return self.flights.do(key, lambda: self._request(call))
+
+    def _read_stamped(self, key, call, stamp, fresh=False):
+        """Like _read, returning (stamp(), document) for ObjectCache.set.
+        The stamp is taken by the caller that sends the read, right
+        before it, so callers sharing the read cache the document only
+        if nothing was invalidated since it was sent."""
+        def read():
+            taken = stamp()
+            return taken, self._request(call)
+        if fresh:
+            return read()
+        return self.flights.do(key, read)
+
+    def metrics_snapshot(self):
+        """Returns the snapshot of the first in-memory metrics sink, see
+        metrics.MemorySink.snapshot, or None without one"""
+        for sink in self.metrics.sinks:
+            if isinstance(sink, metrics.MemorySink):
+                return sink.snapshot()
+        return None
+
+    def coalescing_stats(self):
+        """Returns how many reads were made and how many of them waited on
+        an identical read in flight instead of sending their own"""
+        return self.flights.stats()
 
 # --------------------------------
 # NVP utility functions
@@ -205,42 +760,128 @@ class Blue(object):
     def default_transport_zone_exists(self):
         """This will check if the default transport zone for the current
         connection actually exists"""
+        zone = self.default_zone
         try:
-            self.connection.zone(self.default_zone).read()
+            self._request(lambda c: c.zone(zone).read())
         except aiclib.nvp.ResourceNotFound:
             return False
         return True
 
     def check_tenant(self, net_id, tenant_id):
-        """Returns true of the tenant 'owns' this network"""
-        network = self.get_network(net_id)
-        for t in network["tags"]:
-            if t["scope"] == "os_tid" and t["tag"] == tenant_id:
-                return True
-        return False
+        """Returns true of the tenant 'owns' this network, that is one of
+        its os_tid tags is tenant_id. The owners are looked up in the
+        ownership cache first and only read from the controller on a miss,
+        or when the cache knows only some of them."""
+        entry = self.ownership.get(net_id)
+        if entry is not None:
+            owners, complete = entry
+            if complete or tenant_id in owners:
+                return tenant_id in owners
+        owners = cache.network_owners(
+                self.get_network(net_id, fields=OWNER_FIELDS))
+        return tenant_id in owners
+
+    def ownership_cache_stats(self):
+        """Returns the hit/miss counters of the ownership cache"""
+        return self.ownership.stats()
+
+    def object_cache_stats(self):
+        """Returns the hit/miss counters of the lswitch/lport cache"""
+        return self.objects.stats()
+
+    def _remember_owners(self, networks, filtered=None):
+        """filtered is the tenant of the os_tid filter the networks were
+        queried with, one of their owners when their tags were not asked
+        for"""
+        entries = {}
+        for network in networks:
+            if "uuid" not in network:
+                continue
+            if "tags" in network:
+                entries[network["uuid"]] = (cache.network_owners(network),
+                                            True)
+            elif filtered is not None:
+                entries[network["uuid"]] = ([filtered], False)
+        self.ownership.set_multi(entries)
 
 # --------------------------------
 # Network (lswitch) functions
 # --------------------------------
 
-    def get_network(self, net_id):
-        resp = self.connection.lswitch(net_id).read()
+    def get_network(self, net_id, fresh=False, fields=None):
+        """Reads the lswitch, from the object cache unless fresh is set.
+
+        With fields, a list of attribute names, only those and the uuid
+        are returned. A cached full document is cut down to them;
+        otherwise only they are asked for, and the partial document is not
+        cached.
+        """
+        fields = _field_list(fields)
+        resp = None
+        if not fresh:
+            resp = self.objects.get("lswitch", net_id)
+        if resp is not None and fields:
+            resp = _project(resp, fields)
+        elif resp is None and fields:
+            resp = self._read(
+                    ("lswitch", net_id, fields),
+                    lambda c: _read_one(c.lswitch().query(), net_id, fields),
+                    fresh)
+        elif resp is None:
+            stamp, resp = self._read_stamped(
+                    ("lswitch", net_id), lambda c: c.lswitch(net_id).read(),
+                    lambda: self.objects.stamp("lswitch", net_id), fresh)
+            self.objects.set(resp, "lswitch", net_id, stamp=stamp)
+        self._remember_owners([resp])
         return resp
 
     def check_network_existance(self, net_id):
         try:
-            self.get_network(net_id)
+            self.get_network(net_id, fields=EXISTS_FIELDS)
             return True
         except Exception:
             pass
         return False
 
-    def query_networks(self, tenant_id, fields="*", tags=None):
+    def _require_network(self, net_id):
+        if not self.check_network_existance(net_id):
+            LOG.error("Network not found")
+            raise NetworkNotFound(net_id)
+
+    def _port_call(self, net_id, port_id, call, key=None):
+        """Runs call(connection), a request against a port on net_id. Reads
+        pass a key so identical concurrent ones are coalesced.
+
+        Unless the controller is trusted the network is probed first. When
+        it is trusted the probe is skipped and only made after the port
+        request fails with ResourceNotFound, to tell a missing network from
+        a missing port. Either way NetworkNotFound or PortNotFound is raised.
+        """
+        if not self.trust_controller:
+            self._require_network(net_id)
+        try:
+            if key is not None:
+                return self._read(key, call)
+            return self._request(call)
+        except aiclib.nvp.ResourceNotFound:
+            if self.trust_controller:
+                self._require_network(net_id)
+            LOG.error("Port not found")
+            raise PortNotFound(port_id)
+
+    def query_networks(self, tenant_id, fields="*", tags=None,
+                       page_size=None, cursor=None):
         """In regard to fields:
         Legacy expects a comma separated string. We expect a list of strings.
+
+        Only the switches tagged with os_tid tenant_id are asked for, so the
+        controller filters instead of sending every switch in the cluster.
+        A tenant_id of None asks for all of them.
+
+        A single page of at most page_size switches is returned. Its
+        'page_cursor', when present, is passed back as cursor to get the
+        next page; iter_networks does that for you.
         """
-        query = self.connection.lswitch().query()
-        query.fields(fields)
         if tags:
             """In regard to tags:
             Legacy expects an list of arrays with tag index 0 and scope
@@ -251,18 +892,51 @@ class Blue(object):
             """
             if not type(tags) is list:
                 tags = [tags]
-            query.tags(tags)
-        results = query.results()
+        else:
+            tags = []
+        owner = _tenant_filter(tags)
+        if owner is None and tenant_id is not None:
+            owner = tenant_id
+            tags = tags + [{'tag': tenant_id, 'tag_scope': 'os_tid'}]
+
+        def query_networks(connection):
+            query = connection.lswitch().query()
+            query.fields(fields)
+            if tags:
+                _filter_tags(query, tags)
+            _paginate(query, page_size, cursor)
+            return query.results()
+
+        results = self._request(query_networks)
+        if results:
+            switches = results.get("results", [])
+            self._remember_owners(switches, owner)
         return results
 
+    def iter_networks(self, tenant_id, fields="*", tags=None,
+                      page_size=None):
+        """Yields the switches query_networks matches, fetching pages of
+        page_size (PAGE_SIZE by default) only as they are consumed"""
+        page_size = page_size or self.page_size
+        return _iterate_pages(
+                lambda cursor: self.query_networks(tenant_id, fields, tags,
+                                                   page_size, cursor))
+
     def update_network(self, net_id, **kwargs):
         """Legacy only allows for updating the name, eventually this should
         and will support updating everything as long as they are given
         properly"""
-        switch = self.connection.lswitch(net_id)
-        if "name" in kwargs:
-            switch.display_name(kwargs['name'])
-        resp = switch.update()
+        def update(connection):
+            switch = connection.lswitch(net_id)
+            if "name" in kwargs:
+                switch.display_name(kwargs['name'])
+            return switch.update()
+
+        try:
+            resp = self._request(update)
+        finally:
+            self.objects.invalidate("lswitch", net_id)
+        self.objects.set(resp, "lswitch", net_id)
         return resp
 
     def create_network(self, tenant_id, net_name, **kwargs):
@@ -271,22 +945,54 @@ class Blue(object):
         to change"""
         transport_zone = kwargs.get("transport_zone", self.default_zone)
         transport_type = kwargs.get("transport_type", "gre")
-        zone = {'zone_uuid': transport_zone,
-                'transport_type': transport_type}
-
-        switch = self.connection.lswitch()
-        switch.display_name(net_name)
-        switch.transport_zones(zone)
-        switch.tags({'tag': tenant_id, 'scope': 'os_tid'})
-        resp = switch.create()
+
+        def create(connection):
+            switch = connection.lswitch()
+            switch.display_name(net_name)
+            switch.transport_zone(transport_zone, transport_type)
+            switch.tags({'tag': tenant_id, 'scope': 'os_tid'})
+            return switch.create()
+
+        resp = self._request(create, idempotent=False)
+        if resp and "uuid" in resp:
+            self.ownership.set(resp["uuid"], [tenant_id])
+            self.objects.set(resp, "lswitch", resp["uuid"])
         return resp
 
     def delete_network(self, net_id):
-        self.delete_networks([net_id])
+        try:
+            self._request(lambda c: c.lswitch(net_id).delete())
+        finally:
+            self.ownership.delete(net_id)
+            self.objects.invalidate("lswitch", net_id)
+            self.objects.invalidate_children(net_id)
 
-    def delete_networks(self, net_ids):
-        for net_id in net_ids:
-            self.connection.lswitch(net_id).delete()
+    def delete_networks(self, net_ids, delete_ports=False, max_workers=None):
+        """Deletes the networks concurrently with at most max_workers
+        workers (BULK_CONCURRENCY by default). When delete_ports is set
+        every port of a network is removed with delete_all_ports first,
+        by the worker of that network so no further threads are started.
+        A network one of whose ports could not be deleted is left in place
+        and failed with the error of that port.
+        Nothing is raised for individual networks; a report is returned:
+            {'deleted': [<net uuid>, ...],
+             'not_found': [<net uuid>, ...],
+             'failed': {<net uuid>: <exception>, ...}}
+        """
+        def delete(net_id):
+            if delete_ports:
+                ports = self.delete_all_ports(net_id, max_workers=1)
+                if ports["failed"]:
+                    raise ports["failed"].values()[0]
+            self.delete_network(net_id)
+
+        outcomes = pool.run(delete, net_ids,
+                            max_workers or self.bulk_concurrency)
+        report = _delete_report(outcomes)
+        if report["failed"]:
+            LOG.error("Failed to delete %d of %d networks" %
+                      (len(report["failed"]), len(net_ids)))
+        return report
 
 # --------------------------------
 # Port (lport) functions
@@ -299,85 +1005,277 @@ class Blue(object):
         return self._create_port(tenant, net_id, False)
 
     def _create_port(self, tenant_id, net_id, enabled, **kwargs):
-        port = self.connection.lswitch_port(net_id)
-        port.admin_status_enabled(enabled)
-        resp = port.create()
+        def create(connection):
+            port = connection.lswitch_port(net_id)
+            port.admin_status_enabled(enabled)
+            return port.create()
+
+        resp = self._request(create, idempotent=False)
+        if resp and "uuid" in resp:
+            self.objects.set(resp, "lport", resp["uuid"], parent=net_id)
         return resp
 
-    def get_port_stats(self, net_id, port):
-        port = self.connection.lswitch_port(net_id, port)
-        stats = port.statsu()
+    def create_port_with_status(self, tenant_id, net_id, enabled):
+        """Creates a port and reads its link status straight after. The
+        network probe of get_port_status is skipped as the create already
+        proved the network exists. Returns (port, 'UP' or 'DOWN')."""
+        port = self._create_port(tenant_id, net_id, enabled)
+        return port, self._link_status(net_id, port['uuid'])
+
+    def create_and_plug_port(self, tenant_id, net_id, vifuuid, enabled):
+        """Creates a port, attaches the vif to it and then reads the link
+        status of the plugged port. The network probe is skipped as the
+        create proves the network exists. Should the attach or the status
+        read fail the port is deleted again and that error is raised.
+        Returns (port, 'UP' or 'DOWN')."""
+        port = self._create_port(tenant_id, net_id, enabled)
+        port_id = port['uuid']
+        try:
+            self._attach_vif(net_id, port_id, vifuuid)
+            status = self._link_status(net_id, port_id, fresh=True)
+        except Exception, error:
+            try:
+                self._request(
+                        lambda c: c.lswitch_port(net_id, port_id).delete())
+            except aiclib.nvp.NVPException, e:
+                LOG.error("Could not delete port %s after plugging it "
+                          "failed: %s" % (port_id, e))
+            self.objects.invalidate("lport", port_id)
+            raise error
+        return port, status
+
+    def create_ports(self, tenant_id, net_id, enabled, max_workers=None):
+        """Creates a port for every flag in enabled, the admin status of
+        that port, and reads its link status like create_port_with_status.
+        Unless the controller is trusted the network is probed once up
+        front, raising NetworkNotFound; the creates are then sent
+        concurrently by at most max_workers workers (BULK_CONCURRENCY by
+        default). A failed create does not stop the others. Returns the
+        pool.run outcomes in input order, where a port whose status read
+        failed keeps its port next to the error:
+            [(<enabled>, (<port>, 'UP' or 'DOWN'), None), ...
+             (<enabled>, (<port>, None), <exception>), ...
+             (<enabled>, None, <exception>), ...]
+        """
+        if not self.trust_controller:
+            self._require_network(net_id)
+
+        def create(enabled):
+            port = self._create_port(tenant_id, net_id, enabled)
+            try:
+                return port, self._link_status(net_id, port['uuid']), None
+            except Exception, e:
+                return port, None, e
+
+        outcomes = []
+        for flag, created, error in pool.run(
+                create, enabled, max_workers or self.bulk_concurrency):
+            if created is not None:
+                error = created[2]
+                created = created[:2]
+            outcomes.append((flag, created, error))
+        _log_failures("create", outcomes)
+        return outcomes
+
+    def _link_status(self, net_id, port_id, fresh=False):
+        try:
+            resp = self._read(
+                    ("lport_status", net_id, port_id),
+                    lambda c: c.lswitch_port(net_id, port_id).status(), fresh)
+        except aiclib.nvp.ResourceNotFound:
+            raise PortNotFound(port_id)
+        return "UP" if resp['link_status_up'] else "DOWN"
+
+    def get_port_stats(self, net_id, port_id):
+        stats = self._port_call(
+                net_id, port_id,
+                lambda c: c.lswitch_port(net_id, port_id).statistics())
         return stats
 
-    def get_port(self, net_id, port, relations=None):
-        port = self.connection.lswitch_port(net_id, port)
-        if relations:
-            port.relations(relations)
-        resp = port.read()
+    def get_port(self, net_id, port, relations=None, fresh=False,
+                 fields=None):
+        """Reads the lport, from the object cache unless fresh is set.
+        fields works as it does for get_network."""
+        fields = _field_list(fields)
+
+        def read(connection):
+            if relations:
+                # only the lport query takes relations
+                return _read_one(connection.lswitch_port(net_id).query(),
+                                 port, None, relations)
+            return connection.lswitch_port(net_id, port).read()
+
+        def read_fields(connection):
+            return _read_one(connection.lswitch_port(net_id).query(), port,
+                             fields, relations)
+
+        resp = None
+        if not fresh:
+            resp = self.objects.get("lport", port, relations, parent=net_id)
+        key = relations
+        if isinstance(key, list):
+            key = tuple(key)
+        if resp is not None and fields:
+            resp = _project(resp, fields)
+        elif resp is None and fields:
+            resp = self._read(("lport", net_id, port, key, fields),
+                              read_fields, fresh)
+        elif resp is None:
+            stamp, resp = self._read_stamped(
+                    ("lport", net_id, port, key), read,
+                    lambda: self.objects.stamp("lport", port, relations,
+                                               parent=net_id), fresh)
+            self.objects.set(resp, "lport", port, relations, parent=net_id,
+                             stamp=stamp)
         return resp
 
-    def delete_port(self, net_id, port):
-        if not self.check_network_existance(net_id):
-            LOG.error("Network not found")
-            raise aiclib.nvp.ResourceNotFound()
-        port = self.connection.lswitch_port(net_id, port)
-        port.delete()
+    def delete_port(self, net_id, port_id):
+        try:
+            self._port_call(
+                    net_id, port_id,
+                    lambda c: c.lswitch_port(net_id, port_id).delete())
+        finally:
+            self.objects.invalidate("lport", port_id)
 
-    def delete_all_ports(self, net_id):
-        if not self.check_network_existance(net_id):
-            LOG.error("Network not found")
-            raise aiclib.nvp.ResourceNotFound()
-        resp = self.query_ports(net_id, fields=["uuid"])
-        for port in resp["results"]:
-            self.delete_port(net_id, port["uuid"])
+    def delete_all_ports(self, net_id, max_workers=None):
+        """Deletes every port of the network. The network is checked once
+        and the deletes are sent concurrently by at most max_workers
+        workers (BULK_CONCURRENCY by default). A failed delete does not
+        stop the others; a report is returned instead:
+            {'deleted': [<port uuid>, ...],
+             'not_found': [<port uuid>, ...],
+             'failed': {<port uuid>: <exception>, ...}}
+        """
+        if not self.trust_controller:
+            self._require_network(net_id)
+        try:
+            port_ids = [port["uuid"] for port in
+                        self.iter_ports(net_id, fields=["uuid"])]
+        except aiclib.nvp.ResourceNotFound:
+            raise NetworkNotFound(net_id)
+
+        def delete(port_id):
+            self._request(lambda c: c.lswitch_port(net_id, port_id).delete())
+
+        outcomes = pool.run(delete, port_ids,
+                            max_workers or self.bulk_concurrency)
+        self.objects.invalidate_children(net_id)
+        report = _delete_report(outcomes)
+        if report["failed"]:
+            LOG.error("Failed to delete %d of %d ports on %s" %
+                      (len(report["failed"]), len(port_ids), net_id))
+        return report
 
     def unplug_interface(self, net_id, port):
-        port = self.connection.lswitch_port(net_id, port)
-        resp = port.unattach()
+        def detach(connection):
+            lport = connection.lswitch_port(net_id, port)
+            lport["type"] = "NoAttachment"
+            return lport._action("PUT", aiclib.common.genuri(
+                    "lswitch", net_id, "lport", port, "attachment"))
+
+        try:
+            resp = self._request(detach)
+        finally:
+            self.objects.invalidate("lport", port)
         return resp
 
+    def unplug_interfaces(self, ports, max_workers=None):
+        """Detaches the attachments of many (net_id, port_id) pairs
+        concurrently with at most max_workers workers (BULK_CONCURRENCY by
+        default). A failed detach does not stop the others. Returns the
+        pool.run outcomes in input order."""
+        outcomes = pool.run(lambda p: self.unplug_interface(*p), ports,
+                            max_workers or self.bulk_concurrency)
+        _log_failures("detach", outcomes)
+        return outcomes
+
+    def plug_vif_interfaces(self, attachments, max_workers=None):
+        """Attaches many (net_id, port_id, vifuuid) concurrently like
+        unplug_interfaces detaches them"""
+        outcomes = pool.run(lambda a: self.plug_vif_interface(*a),
+                            attachments, max_workers or self.bulk_concurrency)
+        _log_failures("attach", outcomes)
+        return outcomes
+
     def plug_vif_interface(self, net_id, port, vifuuid):
         """Legacy only supports vif interfaces but supports passing a type
         which could turn it into a non-vif attachment. This is bad. We will
         force the user to only make a vif interface. If different attachment
         types are required a new function for each should be made.
         """
-        port = self.connection.lswitch_port(net_id, port)
-        resp = port.attach_vif(vifuuid)
+        return self._attach_vif(net_id, port, vifuuid)
+
+    def _attach_vif(self, net_id, port, vifuuid):
+        try:
+            resp = self._request(lambda c: c.lswitch_port(
+                    net_id, port).attachment_vif(vifuuid))
+        finally:
+            self.objects.invalidate("lport", port)
         return resp
 
     def update_port(self, net_id, port, **params):
-        port = self.connection.lswitch_port(net_id, port)
-        if "state" in params:
-            """In regard to 'state': in legacy it was the string, 'DOWN' or
-            'UP'. We except a True or False.
-            """
-            admin_status = params["state"]
-            port.admin_status(admin_status)
-        resp = port.update()
+        def update(connection):
+            lport = connection.lswitch_port(net_id, port)
+            if "state" in params:
+                """In regard to 'state': in legacy it was the string, 'DOWN'
+                or 'UP'. We except a True or False.
+                """
+                admin_status = params["state"]
+                lport.admin_status_enabled(admin_status)
+            return lport.update()
+
+        try:
+            resp = self._request(update)
+        finally:
+            self.objects.invalidate("lport", port)
+        self.objects.set(resp, "lport", port, parent=net_id)
         return resp
 
-    def query_ports(self, net_id, relations=None, fields="*", filters=None):
+    def update_port_with_status(self, net_id, port_id, **params):
+        """update_port followed by a link status read, see
+        create_port_with_status. Returns (port, 'UP' or 'DOWN')."""
+        port = self.update_port(net_id, port_id, **params)
+        return port, self._link_status(net_id, port['uuid'])
+
+    def query_ports(self, net_id, relations=None, fields="*", filters=None,
+                    page_size=None, cursor=None):
         """In regard to fields:
         Legacy expects a comma separated string. We expect a list of strings.
+
+        A single page is returned, see query_networks and iter_ports.
         """
-        query = self.connection.lswitch_port(net_id).query()
-        query.fields(fields)
-        if relations:
-            query.relations(relations)
-        if filters and "attachment" in filters:
-            query.attachment_vifuuid("=", filters["attachment"])
-        resp = query.results()
+        def query_ports(connection):
+            query = connection.lswitch_port(net_id).query()
+            query.fields(fields)
+            if relations:
+                query.relations(relations)
+            if filters and "attachment" in filters:
+                query.attachment_vif_uuid("=", filters["attachment"])
+            _paginate(query, page_size, cursor)
+            return query.results()
+
+        resp = self._request(query_ports)
         return resp
 
+    def iter_ports(self, net_id, relations=None, fields="*", filters=None,
+                   page_size=None):
+        """Yields the ports query_ports matches, fetching pages of
+        page_size (PAGE_SIZE by default) only as they are consumed"""
+        page_size = page_size or self.page_size
+        return _iterate_pages(
+                lambda cursor: self.query_ports(net_id, relations, fields,
+                                                filters, page_size, cursor))
+
     def get_port_status(self, net_id, port_id):
-        if not self.check_network_existance(net_id):
-            LOG.error("Network not found")
-            raise aiclib.nvp.ResourceNotFound()
-        port = self.connection.lswitch_port(net_id, port_id)
-        resp = port.status()
+        resp = self._port_call(
+                net_id, port_id,
+                lambda c: c.lswitch_port(net_id, port_id).status(),
+                key=("lport_status", net_id, port_id))
         return resp
 
     def get_port_link_status(self, net_id, port_id):
         resp = self.get_port_status(net_id, port_id)
         return "UP" if resp['link_status_up'] else "DOWN"
+
+
+metrics.instrument(Blue, "blue", lambda blue: blue.metrics)
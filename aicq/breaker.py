@@ -0,0 +1,74 @@
+"""A circuit breaker kept for every NVP controller so that a hung controller
+is skipped right away instead of costing every request a full timeout.
+"""
+import threading
+import time
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+DEFAULT_THRESHOLD = 5
+DEFAULT_COOLDOWN = 30
+
+
+class CircuitBreaker(object):
+    """Opens after threshold consecutive failures. While open no requests
+    are allowed until cooldown seconds have passed; then a single trial
+    request is let through (half open). The trial closes the breaker again
+    on success and reopens it on failure.
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, cooldown=DEFAULT_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def _cooled_down(self):
+        return time.time() - self.opened_at >= self.cooldown
+
+    def available(self):
+        """Returns true if a request could be let through now. Unlike
+        acquire this does not take the half open trial."""
+        if self.state == CLOSED:
+            return True
+        return not self._trial and self._cooled_down()
+
+    def acquire(self):
+        """Returns true if a request may be sent now, taking the trial
+        slot if the breaker is open and has cooled down"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self._trial or not self._cooled_down():
+                return False
+            self.state = HALF_OPEN
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.threshold:
+                if self.state != OPEN:
+                    self.trips += 1
+                self.state = OPEN
+                self.opened_at = time.time()
+            self._trial = False
+
+    def to_dict(self):
+        return {"state": self.state, "failures": self.failures,
+                "opened_at": self.opened_at, "trips": self.trips}
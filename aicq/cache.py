@@ -0,0 +1,638 @@
+"""Small in-process caches used by Blue to avoid round-trips to the NVP
+controller for information that rarely changes or that was just written.
+
+Both caches can be given a shared CacheBackend, such as a memcached
+server, so that several API worker processes see each other's lookups and
+invalidations.
+"""
+import copy
+import hashlib
+import json
+import logging
+import socket
+import threading
+import time
+import zlib
+
+LOG = logging.getLogger("aicq-cache")
+
+DEFAULT_OWNERSHIP_TTL = 300
+DEFAULT_OWNERSHIP_SIZE = 10000
+# With a shared backend local entries only live this long, so a delete
+# made by another process is seen soon
+DEFAULT_OWNERSHIP_LOCAL_TTL = 5
+# The object cache is off unless OBJECT_CACHE_SIZE is set
+DEFAULT_OBJECT_SIZE = 0
+DEFAULT_OBJECT_TTL = 30
+DEFAULT_OBJECT_BYTES = 16 * 1024 * 1024
+DEFAULT_BACKEND_SIZE = 100000
+DEFAULT_MEMCACHED_PORT = 11211
+DEFAULT_MEMCACHED_TIMEOUT = 1.0
+# memcached refuses keys longer than this
+MAX_KEY_LENGTH = 250
+
+OWNER_KEY = "owner:%s"
+GEN_KEY = "gen:%s:%s"
+CHILDREN_KEY = "children:%s"
+OBJECT_KEY = "obj:%s:%s:%s:%s:%s"
+
+
+class _LRUDict(dict):
+    """The part of collections.OrderedDict the caches need, which Python
+    2.6 lacks: keys iterate oldest first and popitem(last=False) drops the
+    oldest one. Each key has a [previous, next, key] link in a ring."""
+
+    _missing = object()
+
+    def __init__(self):
+        dict.__init__(self)
+        self._root = []
+        self._root[:] = [self._root, self._root, None]
+        self._links = {}
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            root = self._root
+            last = root[0]
+            link = [last, root, key]
+            last[1] = root[0] = self._links[key] = link
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        previous, following, key = self._links.pop(key)
+        previous[1] = following
+        following[0] = previous
+
+    def __iter__(self):
+        link = self._root[1]
+        while link is not self._root:
+            yield link[2]
+            link = link[1]
+
+    def pop(self, key, default=_missing):
+        if key in self:
+            value = dict.__getitem__(self, key)
+            del self[key]
+            return value
+        if default is self._missing:
+            raise KeyError(key)
+        return default
+
+    def popitem(self, last=True):
+        if not self:
+            raise KeyError("dictionary is empty")
+        if last:
+            key = self._root[0][2]
+        else:
+            key = self._root[1][2]
+        return key, self.pop(key)
+
+    def clear(self):
+        dict.clear(self)
+        self._links.clear()
+        self._root[:] = [self._root, self._root, None]
+
+
+class CacheBackend(object):
+    """The interface of a shared cache. Values are anything json can
+    encode. A backend must never raise because the cache is unreachable;
+    it reports a miss instead."""
+
+    def get(self, key):
+        raise NotImplementedError()
+
+    def get_multi(self, keys):
+        """Returns a dict of the keys that were found"""
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set(self, key, value, ttl):
+        raise NotImplementedError()
+
+    def set_multi(self, values, ttl):
+        """Stores every key -> value of the dict values"""
+        for key, value in values.items():
+            self.set(key, value, ttl)
+
+    def add(self, key, value, ttl=0):
+        """Stores value only if key is missing. Returns true if stored."""
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+    def incr(self, key, delta=1):
+        """Adds delta to an integer value. Returns the new value, or None
+        if key is missing."""
+        raise NotImplementedError()
+
+
+class MemoryBackend(CacheBackend):
+    """A CacheBackend kept in this process. Several Blue instances in one
+    process may share it. Values are stored encoded so callers never share
+    a mutable document."""
+
+    def __init__(self, max_entries=DEFAULT_BACKEND_SIZE):
+        self.max_entries = max_entries
+        # key -> (encoded value, expiry or None)
+        self._entries = _LRUDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _live(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] is not None and \
+                entry[1] < time.time():
+            del self._entries[key]
+            entry = None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key)
+        if entry is None:
+            return None
+        return json.loads(entry[0])
+
+    def _store(self, key, value, ttl):
+        self._entries.pop(key, None)
+        while self._entries and len(self._entries) >= self.max_entries:
+            self._entries.popitem(last=False)
+        expiry = ttl and time.time() + ttl or None
+        self._entries[key] = (json.dumps(value), expiry)
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def set_multi(self, values, ttl):
+        with self._lock:
+            for key, value in values.items():
+                self._store(key, value, ttl)
+
+    def add(self, key, value, ttl=0):
+        with self._lock:
+            if self._live(key) is not None:
+                return False
+            self._store(key, value, ttl)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def incr(self, key, delta=1):
+        with self._lock:
+            entry = self._live(key)
+            if entry is None:
+                return None
+            value = json.loads(entry[0]) + delta
+            self._entries[key] = (json.dumps(value), entry[1])
+            return value
+
+
+class MemcachedBackend(CacheBackend):
+    """A CacheBackend speaking the memcached text protocol to one or more
+    servers given as "host:port". Keys are spread over the servers by
+    hash. A server that cannot be reached counts as a miss and is retried
+    on the next call."""
+
+    def __init__(self, servers, timeout=DEFAULT_MEMCACHED_TIMEOUT,
+                 prefix="aicq:"):
+        self.servers = [self._address(s) for s in servers]
+        self.timeout = timeout
+        self.prefix = prefix
+        self.errors = 0
+        self._sockets = [None] * len(self.servers)
+        self._locks = [threading.Lock() for s in self.servers]
+
+    def _address(self, server):
+        host, _, port = server.strip().partition(":")
+        return host, int(port or DEFAULT_MEMCACHED_PORT)
+
+    def _key(self, key):
+        key = self.prefix + key
+        if len(key) > MAX_KEY_LENGTH or " " in key:
+            key = self.prefix + hashlib.md5(key).hexdigest()
+        return key
+
+    def _server(self, key):
+        return (zlib.crc32(key) & 0xffffffff) % len(self.servers)
+
+    def _call(self, index, func):
+        """Runs func(sock, reader) on server index, returning None if the
+        server could not be used"""
+        with self._locks[index]:
+            try:
+                if self._sockets[index] is None:
+                    sock = socket.create_connection(self.servers[index],
+                                                    self.timeout)
+                    self._sockets[index] = (sock, sock.makefile("rb"))
+                return func(*self._sockets[index])
+            except (socket.error, ValueError), e:
+                self.errors += 1
+                LOG.warning("memcached %s:%s failed: %s" %
+                            (self.servers[index] + (e,)))
+                self._close(index)
+                return None
+
+    def close(self):
+        for index in xrange(len(self.servers)):
+            with self._locks[index]:
+                self._close(index)
+
+    def _close(self, index):
+        if self._sockets[index] is not None:
+            sock, reader = self._sockets[index]
+            self._sockets[index] = None
+            try:
+                reader.close()
+                sock.close()
+            except socket.error:
+                pass
+
+    def _readline(self, reader):
+        line = reader.readline()
+        if not line.endswith("\r\n"):
+            raise ValueError("connection closed")
+        return line[:-2]
+
+    def _command(self, key, line, payload=None):
+        def call(sock, reader):
+            data = line + "\r\n"
+            if payload is not None:
+                data += payload + "\r\n"
+            sock.sendall(data)
+            reply = self._readline(reader)
+            if "ERROR" in reply:
+                raise ValueError(reply)
+            return reply
+        return self._call(self._server(key), call)
+
+    def get(self, key):
+        return self.get_multi([key]).get(key)
+
+    def get_multi(self, keys):
+        by_server = {}
+        for key in keys:
+            name = self._key(key)
+            by_server.setdefault(self._server(name), {})[name] = key
+        found = {}
+        for index, names in by_server.items():
+            def call(sock, reader):
+                sock.sendall("get %s\r\n" % " ".join(names))
+                values = {}
+                while True:
+                    reply = self._readline(reader)
+                    if reply == "END":
+                        return values
+                    parts = reply.split()
+                    if len(parts) != 4 or parts[0] != "VALUE":
+                        raise ValueError(reply)
+                    data = reader.read(int(parts[3]) + 2)[:-2]
+                    values[parts[1]] = data
+            values = self._call(index, call) or {}
+            for name, data in values.items():
+                found[names[name]] = json.loads(data)
+        return found
+
+    def _store(self, verb, key, value, ttl):
+        key = self._key(key)
+        data = json.dumps(value)
+        line = "%s %s 0 %d %d" % (verb, key, int(ttl), len(data))
+        return self._command(key, line, data) == "STORED"
+
+    def set(self, key, value, ttl):
+        self._store("set", key, value, ttl)
+
+    def set_multi(self, values, ttl):
+        """Sends the sets of each server in one go and then reads their
+        replies, so a server costs a single round trip"""
+        by_server = {}
+        for key, value in values.items():
+            name = self._key(key)
+            data = json.dumps(value)
+            command = "set %s 0 %d %d\r\n%s\r\n" % (name, int(ttl),
+                                                    len(data), data)
+            by_server.setdefault(self._server(name), []).append(command)
+        for index, commands in by_server.items():
+            def call(sock, reader):
+                sock.sendall("".join(commands))
+                for command in commands:
+                    reply = self._readline(reader)
+                    if "ERROR" in reply:
+                        raise ValueError(reply)
+            self._call(index, call)
+
+    def add(self, key, value, ttl=0):
+        return self._store("add", key, value, ttl)
+
+    def delete(self, key):
+        key = self._key(key)
+        self._command(key, "delete %s" % key)
+
+    def incr(self, key, delta=1):
+        key = self._key(key)
+        reply = self._command(key, "incr %s %d" % (key, delta))
+        if reply is None or reply == "NOT_FOUND":
+            return None
+        return int(reply)
+
+
+class OwnershipCache(object):
+    """A bounded, TTL based mapping of net_id -> (owners, complete), where
+    owners are the tenants of the os_tid tags of the lswitch. complete is
+    false when only some of them are known, such as a switch a tenant
+    filter matched without its tags being read.
+
+    Entries expire ttl seconds after being stored. When the cache is full
+    the oldest entry is evicted. Hit and miss counters are kept so the
+    number of saved lswitch reads can be reported.
+
+    With a shared backend, local misses are looked up there and every
+    change is written to it as well, in one batch for set_multi. Local
+    entries then expire after local_ttl seconds instead of ttl, as they do
+    not see the deletes of other processes.
+    """
+
+    def __init__(self, max_entries=DEFAULT_OWNERSHIP_SIZE,
+                 ttl=DEFAULT_OWNERSHIP_TTL, shared=None,
+                 local_ttl=DEFAULT_OWNERSHIP_LOCAL_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self.shared_hits = 0
+        self._entries = _LRUDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, net_id):
+        """Returns (owners, complete) for net_id or None if it is unknown"""
+        with self._lock:
+            entry = self._entries.get(net_id)
+            if entry is not None and entry[1] < time.time():
+                del self._entries[net_id]
+                entry = None
+            if entry is not None:
+                self.hits += 1
+                return entry[0]
+        owner = None
+        if self.shared is not None and self.ttl > 0:
+            owner = self.shared.get(OWNER_KEY % net_id)
+        if owner is None:
+            self.misses += 1
+            return None
+        self.shared_hits += 1
+        owner = tuple(owner)
+        self._store(net_id, owner)
+        return owner
+
+    def _store(self, net_id, entry):
+        ttl = self.ttl
+        if self.shared is not None:
+            ttl = min(ttl, self.local_ttl)
+        if self.max_entries <= 0 or ttl <= 0:
+            return
+        with self._lock:
+            self._entries.pop(net_id, None)
+            while len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+            self._entries[net_id] = (entry, time.time() + ttl)
+
+    def set(self, net_id, owners, complete=True):
+        self.set_multi({net_id: (owners, complete)})
+
+    def set_multi(self, entries):
+        """Stores a dict of net_id -> (owners, complete)"""
+        shared = {}
+        for net_id, (owners, complete) in entries.items():
+            entry = (list(owners), complete)
+            self._store(net_id, entry)
+            shared[OWNER_KEY % net_id] = entry
+        if shared and self.shared is not None and self.ttl > 0:
+            self.shared.set_multi(shared, self.ttl)
+
+    def delete(self, net_id):
+        with self._lock:
+            self._entries.pop(net_id, None)
+        if self.shared is not None:
+            self.shared.delete(OWNER_KEY % net_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "shared_hits": self.shared_hits,
+                "size": len(self._entries)}
+
+
+class ObjectCache(object):
+    """An LRU cache of lswitch/lport documents with a TTL and a memory cap.
+
+    Entries are keyed by (resource type, uuid, relations, fields) so reads
+    with different relations or field projections do not mix. Every entry
+    can name a parent uuid (the lswitch of an lport) so all the entries
+    below a deleted switch can be dropped at once. Documents are copied
+    in and out so callers may modify what they get.
+
+    With a shared backend the documents are kept there instead. Since
+    other processes cannot walk this process' indexes, every uuid and
+    every parent has a generation counter in the backend that is part of
+    the document keys; invalidating bumps the counter so the old entries
+    are never read again and simply expire.
+
+    A read that overlaps a change could bring back the old document after
+    it was invalidated. Callers therefore take a stamp before reading and
+    hand it to set, which drops the document if anything was invalidated
+    in between; with a shared backend the stamp is the key under the
+    generations of the time, so such a document is never read.
+    """
+
+    def __init__(self, max_entries=DEFAULT_OBJECT_SIZE,
+                 ttl=DEFAULT_OBJECT_TTL, max_bytes=DEFAULT_OBJECT_BYTES,
+                 shared=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        # bumped by every invalidation, the stamp of the local cache
+        self.invalidations = 0
+        # key -> (document, expiry, size, parent)
+        self._entries = _LRUDict()
+        # (resource type, uuid) -> set of keys
+        self._variants = {}
+        # parent uuid -> set of keys
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.ttl > 0
+
+    def _key(self, rtype, uuid, relations, fields):
+        if isinstance(relations, (list, tuple)):
+            relations = ",".join(relations)
+        if isinstance(fields, (list, tuple)):
+            fields = ",".join(fields)
+        return (rtype, uuid, relations or None, fields or None)
+
+    def _shared_key(self, key, parent, create=False):
+        """Returns the backend key of a document under the current
+        generations, or None if they are unknown and create is not set"""
+        names = [GEN_KEY % key[:2]]
+        if parent is not None:
+            names.append(CHILDREN_KEY % parent)
+        gens = self.shared.get_multi(names)
+        for name in names:
+            if name in gens:
+                continue
+            if not create:
+                return None
+            # start from the clock so an evicted counter never comes back
+            # to a value that old entries were stored under
+            self.shared.add(name, int(time.time() * 1000))
+            gens[name] = self.shared.get(name)
+            if gens[name] is None:
+                return None
+        generation = ".".join(str(gens[name]) for name in names)
+        return OBJECT_KEY % (key + (generation,))
+
+    def stamp(self, rtype, uuid, relations=None, fields=None, parent=None):
+        """Returns what to pass to set as stamp for a document about to be
+        read"""
+        if not self.enabled:
+            return None
+        if self.shared is not None:
+            return self._shared_key(self._key(rtype, uuid, relations, fields),
+                                    parent, create=True)
+        with self._lock:
+            return self.invalidations
+
+    def get(self, rtype, uuid, relations=None, fields=None, parent=None):
+        """Returns a copy of the cached document or None. parent is only
+        needed with a shared backend."""
+        if not self.enabled:
+            return None
+        key = self._key(rtype, uuid, relations, fields)
+        if self.shared is not None:
+            name = self._shared_key(key, parent)
+            document = name and self.shared.get(name)
+            if document is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return document
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] < time.time():
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            del self._entries[key]
+            self._entries[key] = entry
+            return copy.deepcopy(entry[0])
+
+    def set(self, document, rtype, uuid, relations=None, fields=None,
+            parent=None, stamp=None):
+        """Caches document. stamp, taken with stamp() before the document
+        was read, keeps it out if it was invalidated since."""
+        if not self.enabled or not isinstance(document, dict):
+            return
+        key = self._key(rtype, uuid, relations, fields)
+        size = len(json.dumps(document))
+        if size > self.max_bytes:
+            return
+        if self.shared is not None:
+            name = stamp or self._shared_key(key, parent, create=True)
+            if name is not None:
+                self.shared.set(name, document, self.ttl)
+            return
+        document = copy.deepcopy(document)
+        with self._lock:
+            if stamp is not None and stamp != self.invalidations:
+                return
+            self._drop(key)
+            while self._entries and (
+                    len(self._entries) >= self.max_entries or
+                    self.bytes + size > self.max_bytes):
+                self._drop(iter(self._entries).next())
+            self._entries[key] = (document, time.time() + self.ttl, size,
+                                  parent)
+            self.bytes += size
+            self._variants.setdefault(key[:2], set()).add(key)
+            if parent is not None:
+                self._children.setdefault(parent, set()).add(key)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry[2]
+        self._discard(self._variants, key[:2], key)
+        if entry[3] is not None:
+            self._discard(self._children, entry[3], key)
+
+    def _discard(self, index, name, key):
+        keys = index.get(name)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del index[name]
+
+    def invalidate(self, rtype, uuid):
+        """Drops every cached variant of a document"""
+        if self.shared is not None:
+            self.shared.incr(GEN_KEY % (rtype, uuid))
+        with self._lock:
+            self.invalidations += 1
+            for key in list(self._variants.get((rtype, uuid), ())):
+                self._drop(key)
+
+    def invalidate_children(self, parent):
+        """Drops every document cached below parent"""
+        if self.shared is not None:
+            self.shared.incr(CHILDREN_KEY % parent)
+        with self._lock:
+            self.invalidations += 1
+            for key in list(self._children.get(parent, ())):
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._variants.clear()
+            self._children.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._entries), "bytes": self.bytes}
+
+
+def network_owners(network):
+    """Returns the os_tid tags of an lswitch document"""
+    return [t.get("tag") for t in network.get("tags") or []
+            if t.get("scope") == "os_tid"]
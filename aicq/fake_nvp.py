@@ -0,0 +1,474 @@
+"""An in-process fake of the NVP controller API for tests and benchmarks. It
+serves login, lswitch, lport and transport-zone requests over plain HTTP
+on a local port, with configurable latency and failures:
+
+    nvp = FakeNvp(latency=0.002)
+    nvp.start()
+    path = write_config([nvp])
+    blue = aicq.blue.Blue(path)
+
+Several FakeNvp sharing one Store behave like the controllers of a single
+cluster, so failover between them can be exercised.
+"""
+import BaseHTTPServer
+import copy
+import json
+import os
+import random
+import re
+import socket
+import SocketServer
+import sys
+import tempfile
+import threading
+import urlparse
+import uuid
+
+
+API = "/ws.v1"
+DEFAULT_ZONE = "fake-transport-zone"
+
+CONFIG = """[NVP]
+DEFAULT_TZ_UUID = %(zone)s
+NVP_CONTROLLER_CONNECTIONS = %(names)s
+%(connections)s
+HEALTH_CHECK_INTERVAL = 0
+%(extra)s
+"""
+
+
+# the query parameters the controller understands, anything else is
+# answered with 400 like a controller would
+QUERY_PARAMS = frozenset(["fields", "tag", "tag_scope", "uuid", "relations",
+                          "_page_length", "_page_cursor",
+                          "attachment_vif_uuid"])
+ATTACHMENT_TYPES = ("NoAttachment", "VifAttachment")
+
+
+class NotFound(Exception):
+    pass
+
+
+class BadRequest(Exception):
+    pass
+
+
+class Store(object):
+    """The switches, ports and zones of a fake cluster"""
+
+    def __init__(self):
+        self.switches = {}
+        # switch uuid -> {port uuid: port}, ports are listed in creation
+        # order through self.order
+        self.ports = {}
+        self.order = {}
+        self.zones = {DEFAULT_ZONE: {"uuid": DEFAULT_ZONE,
+                                     "display_name": "fake zone",
+                                     "type": "TransportZone"}}
+        self.lock = threading.RLock()
+
+    def add_switch(self, body):
+        with self.lock:
+            switch = dict(body)
+            switch.setdefault("display_name", "")
+            switch.setdefault("tags", [])
+            switch.setdefault("transport_zones", [])
+            switch.setdefault("port_isolation_enabled", False)
+            switch["uuid"] = str(uuid.uuid4())
+            switch["type"] = "LogicalSwitchConfig"
+            switch["_href"] = "%s/lswitch/%s" % (API, switch["uuid"])
+            self.switches[switch["uuid"]] = switch
+            self.ports[switch["uuid"]] = {}
+            self.order[switch["uuid"]] = []
+            return switch
+
+    def switch(self, net_id):
+        switch = self.switches.get(net_id)
+        if switch is None:
+            raise NotFound("lswitch %s" % net_id)
+        return switch
+
+    def delete_switch(self, net_id):
+        with self.lock:
+            self.switch(net_id)
+            del self.switches[net_id]
+            del self.ports[net_id]
+            del self.order[net_id]
+
+    def add_port(self, net_id, body):
+        with self.lock:
+            self.switch(net_id)
+            port = dict(body)
+            port.setdefault("display_name", "")
+            port.setdefault("tags", [])
+            port.setdefault("admin_status_enabled", True)
+            port["uuid"] = str(uuid.uuid4())
+            port["type"] = "LogicalSwitchPortConfig"
+            port["_href"] = "%s/lswitch/%s/lport/%s" % (API, net_id,
+                                                        port["uuid"])
+            port["_attachment"] = {"type": "NoAttachment"}
+            self.ports[net_id][port["uuid"]] = port
+            self.order[net_id].append(port["uuid"])
+            return port
+
+    def port(self, net_id, port_id):
+        port = self.ports.get(net_id, {}).get(port_id)
+        if port is None:
+            self.switch(net_id)
+            raise NotFound("lport %s" % port_id)
+        return port
+
+    def delete_port(self, net_id, port_id):
+        with self.lock:
+            self.port(net_id, port_id)
+            del self.ports[net_id][port_id]
+            self.order[net_id].remove(port_id)
+
+    def list_ports(self, net_id):
+        if net_id == "*":
+            return [self.ports[n][p] for n in self.order
+                    for p in self.order[n]]
+        self.switch(net_id)
+        return [self.ports[net_id][p] for p in self.order[net_id]]
+
+
+def _status(port):
+    attachment = port["_attachment"].get("type") not in (None,
+                                                         "NoAttachment")
+    return {"link_status_up": bool(port["admin_status_enabled"]) and
+            attachment, "fabric_status_up": True,
+            "type": "LogicalSwitchPortStatus"}
+
+
+def _tag_filters(params):
+    """Returns [(tag, scope)] from the tag and tag_scope parameters, the
+    n-th scope belonging to the n-th tag"""
+    filters = []
+    scopes = params.get("tag_scope", [])
+    for index, value in enumerate(params.get("tag", [])):
+        scope = index < len(scopes) and scopes[index] or None
+        filters.append((value, scope))
+    return filters
+
+
+def _has_tags(document, filters):
+    tags = [(t.get("tag"), t.get("scope")) for t in document.get("tags", [])]
+    for tag, scope in filters:
+        if not [t for t in tags if t[0] == tag and scope in (None, t[1])]:
+            return False
+    return True
+
+
+def _project(document, fields):
+    """Applies the fields parameter; the uuid is always returned, and
+    underscore keys only through relations"""
+    if fields in (None, "*"):
+        return dict((k, v) for k, v in document.items()
+                    if not k.startswith("_") or k == "_href")
+    wanted = set(fields.split(",")) | set(["uuid"])
+    return dict((k, v) for k, v in document.items() if k in wanted)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # answer in one segment, keep-alive clients would otherwise wait on
+    # delayed acks
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    routes = [
+        ("login", re.compile(r"^/login$")),
+        ("logout", re.compile(r"^/logout$")),
+        ("zones", re.compile(r"^/transport-zone$")),
+        ("zone", re.compile(r"^/transport-zone/([^/]+)$")),
+        ("switches", re.compile(r"^/lswitch$")),
+        ("switch", re.compile(r"^/lswitch/([^/]+)$")),
+        ("switch_status", re.compile(r"^/lswitch/([^/]+)/status$")),
+        ("ports", re.compile(r"^/lswitch/([^/]+)/lport$")),
+        ("port", re.compile(r"^/lswitch/([^/]+)/lport/([^/]+)$")),
+        ("port_status",
+         re.compile(r"^/lswitch/([^/]+)/lport/([^/]+)/status$")),
+        ("port_stats",
+         re.compile(r"^/lswitch/([^/]+)/lport/([^/]+)/statistic$")),
+        ("attachment",
+         re.compile(r"^/lswitch/([^/]+)/lport/([^/]+)/attachment$")),
+    ]
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def _send(self, status, body=None, headers=None):
+        data = ""
+        if body is not None:
+            data = json.dumps(body)
+        self.send_response(status)
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.nvp.count_bytes(len(data))
+
+    def _dispatch(self, method):
+        nvp = self.server.nvp
+        url = urlparse.urlparse(self.path)
+        params = urlparse.parse_qs(url.query)
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = length and self.rfile.read(length) or ""
+        nvp.count(method)
+        if nvp.latency:
+            # cut short by stop() so no handler outlives the server
+            nvp.stopped.wait(nvp.latency)
+        if nvp.down or (nvp.failure_rate and
+                        nvp.random.random() < nvp.failure_rate):
+            return self._send(nvp.failure_status, {"error": "injected"})
+        path = url.path
+        if not path.startswith(API):
+            return self._send(404)
+        path = path[len(API):]
+        for name, pattern in self.routes:
+            match = pattern.match(path)
+            if match:
+                break
+        else:
+            return self._send(404)
+        if name == "login":
+            return self._send(200, headers={"Set-Cookie":
+                                            "nvp_sessionid=fake; Path=/"})
+        body = {}
+        if raw:
+            body = json.loads(raw)
+        try:
+            unknown = set(params) - QUERY_PARAMS
+            if unknown:
+                raise BadRequest("unknown parameters %s" %
+                                 ", ".join(sorted(unknown)))
+            with nvp.store.lock:
+                handler = getattr(self, "_%s_%s" % (method.lower(), name),
+                                  None)
+                if handler is None:
+                    return self._send(405)
+                status, result = handler(params, body, *match.groups())
+                result = copy.deepcopy(result)
+        except NotFound, e:
+            return self._send(404, {"error": str(e)})
+        except BadRequest, e:
+            return self._send(400, {"error": str(e)})
+        self._send(status, result)
+
+    def _get_logout(self, params, body):
+        return 200, None
+
+    def _page(self, params, documents, project):
+        fields = params.get("fields", ["*"])[0]
+        length = int(params.get("_page_length", [1000])[0])
+        start = int(params.get("_page_cursor", [0])[0])
+        page = documents[start:start + length]
+        result = {"results": [project(d, fields) for d in page],
+                  "result_count": len(documents)}
+        if start + length < len(documents):
+            result["page_cursor"] = str(start + length)
+        return result
+
+    def _get_zones(self, params, body):
+        zones = self.server.nvp.store.zones.values()
+        return 200, self._page(params, zones, _project)
+
+    def _get_zone(self, params, body, zone_id):
+        zone = self.server.nvp.store.zones.get(zone_id)
+        if zone is None:
+            raise NotFound("transport-zone %s" % zone_id)
+        return 200, zone
+
+    def _get_switches(self, params, body):
+        filters = _tag_filters(params)
+        store = self.server.nvp.store
+        switches = [s for s in store.switches.values()
+                    if _has_tags(s, filters)]
+        if "uuid" in params:
+            switches = [s for s in switches if s["uuid"] in params["uuid"]]
+        return 200, self._page(params, switches, _project)
+
+    def _post_switches(self, params, body):
+        store = self.server.nvp.store
+        for zone in body.get("transport_zones", []):
+            if not isinstance(zone, dict) or "transport_type" not in zone:
+                raise BadRequest("transport_zones takes zone_uuid and "
+                                 "transport_type")
+            if zone.get("zone_uuid") not in store.zones:
+                raise NotFound("transport-zone %s" % zone.get("zone_uuid"))
+        return 201, store.add_switch(body)
+
+    def _get_switch(self, params, body, net_id):
+        return 200, self.server.nvp.store.switch(net_id)
+
+    def _put_switch(self, params, body, net_id):
+        switch = self.server.nvp.store.switch(net_id)
+        body.pop("uuid", None)
+        switch.update(body)
+        return 200, switch
+
+    def _delete_switch(self, params, body, net_id):
+        self.server.nvp.store.delete_switch(net_id)
+        return 204, None
+
+    def _get_switch_status(self, params, body, net_id):
+        store = self.server.nvp.store
+        store.switch(net_id)
+        return 200, {"lport_count": len(store.ports[net_id]),
+                     "type": "LogicalSwitchStatus"}
+
+    def _get_ports(self, params, body, net_id):
+        ports = self.server.nvp.store.list_ports(net_id)
+        filters = _tag_filters(params)
+        ports = [p for p in ports if _has_tags(p, filters)]
+        if "uuid" in params:
+            ports = [p for p in ports if p["uuid"] in params["uuid"]]
+        vif = params.get("attachment_vif_uuid")
+        if vif:
+            # aiclib prefixes the string operator, only = is served
+            if not vif[0].startswith("="):
+                raise BadRequest("attachment_vif_uuid takes =<vif uuid>")
+            ports = [p for p in ports
+                     if p["_attachment"].get("vif_uuid") == vif[0][1:]]
+        relations = ",".join(params.get("relations", [])).split(",")
+
+        def project(port, fields):
+            result = _project(port, fields)
+            related = {}
+            if "LogicalPortStatus" in relations:
+                related["LogicalPortStatus"] = _status(port)
+            if "LogicalPortAttachment" in relations:
+                related["LogicalPortAttachment"] = port["_attachment"]
+            if related:
+                result["_relations"] = related
+            return result
+        return 200, self._page(params, ports, project)
+
+    def _post_ports(self, params, body, net_id):
+        return 201, _project(self.server.nvp.store.add_port(net_id, body),
+                             "*")
+
+    def _get_port(self, params, body, net_id, port_id):
+        port = self.server.nvp.store.port(net_id, port_id)
+        result = _project(port, "*")
+        relations = ",".join(params.get("relations", [])).split(",")
+        if "LogicalPortStatus" in relations:
+            result["_relations"] = {"LogicalPortStatus": _status(port)}
+        return 200, result
+
+    def _put_port(self, params, body, net_id, port_id):
+        port = self.server.nvp.store.port(net_id, port_id)
+        body.pop("uuid", None)
+        port.update(body)
+        return 200, _project(port, "*")
+
+    def _delete_port(self, params, body, net_id, port_id):
+        self.server.nvp.store.delete_port(net_id, port_id)
+        return 204, None
+
+    def _get_port_status(self, params, body, net_id, port_id):
+        return 200, _status(self.server.nvp.store.port(net_id, port_id))
+
+    def _get_port_stats(self, params, body, net_id, port_id):
+        self.server.nvp.store.port(net_id, port_id)
+        return 200, {"rx_packets": 0, "rx_bytes": 0, "tx_errors": 0,
+                     "rx_errors": 0, "tx_bytes": 0, "tx_packets": 0}
+
+    def _put_attachment(self, params, body, net_id, port_id):
+        port = self.server.nvp.store.port(net_id, port_id)
+        kind = body.get("type")
+        if kind not in ATTACHMENT_TYPES:
+            raise BadRequest("unsupported attachment type %s" % kind)
+        attachment = {"type": kind}
+        if kind == "VifAttachment":
+            if not body.get("vif_uuid"):
+                raise BadRequest("VifAttachment needs a vif_uuid")
+            attachment["vif_uuid"] = body["vif_uuid"]
+        port["_attachment"] = attachment
+        return 200, attachment
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        # a client that gave up on a slow answer closed the socket
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+
+class FakeNvp(object):
+    """One fake controller. latency seconds are added to every request,
+    failure_rate of them are answered with failure_status, and while down
+    is set all of them are."""
+
+    def __init__(self, store=None, latency=0.0, failure_rate=0.0,
+                 failure_status=503, seed=None):
+        self.store = store or Store()
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.down = False
+        self.stopped = threading.Event()
+        self.random = random.Random(seed)
+        self.requests = {}
+        # response body bytes, what a client pays for on the wire
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        self.server = _Server(("127.0.0.1", 0), _Handler)
+        self.server.nvp = self
+        self.port = self.server.server_address[1]
+
+    def count(self, method):
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+
+    def count_bytes(self, size):
+        with self._lock:
+            self.bytes_sent += size
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  kwargs={"poll_interval": 0.05})
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def write_config(controllers, extra="", zone=DEFAULT_ZONE, http_timeout=10):
+    """Writes an nvp.ini for Blue pointing at the given FakeNvp and returns
+    its path; the caller removes it"""
+    names = []
+    connections = []
+    for index, nvp in enumerate(controllers):
+        names.append("CONN_%d" % index)
+        connections.append("CONN_%d=127.0.0.1:%d:admin:admin:30:%d:2:2" %
+                           (index, nvp.port, http_timeout))
+    fd, path = tempfile.mkstemp(suffix=".ini")
+    os.write(fd, CONFIG % {"zone": zone, "names": " ".join(names),
+                           "connections": "\n".join(connections),
+                           "extra": extra})
+    os.close(fd)
+    return path
@@ -0,0 +1,24 @@
+"""Deferred imports for dependencies that are slow to load and only needed
+once a request is actually served, such as the quantum exceptions.
+"""
+import sys
+
+
+class LazyModule(object):
+    """Stands in for a module and imports it on first attribute access
+
+        exception = LazyModule("quantum.common.exceptions")
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            __import__(self._name)
+            self._module = sys.modules[self._name]
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return "<lazy module %s>" % self._name
@@ -0,0 +1,275 @@
+"""Latency and error instrumentation for Blue and NvpPlugin. Once a sink is
+attached every public method call and every controller request is timed:
+
+    blue.metrics.add_sink(metrics.MemorySink())
+    ...
+    blue.metrics_snapshot()
+
+Method calls are recorded as "call" labelled by layer and op, controller
+requests as "request" labelled by op (the innermost Blue method) and
+conn_id, and requests retried on another controller as "failover". Errors
+are counted by class name. Without sinks the wrappers cost one attribute
+check per call.
+"""
+import bisect
+import functools
+import socket
+import threading
+import time
+import types
+
+from aicq import pool
+
+
+CALL = "call"
+REQUEST = "request"
+FAILOVER = "failover"
+
+# upper bounds in seconds, the last bucket is +Inf
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0)
+DEFAULT_STATSD_PORT = 8125
+
+
+class Histogram(object):
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Returns [(upper bound, observations <= bound)], ending with
+        ("+Inf", count)"""
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+def _freeze(labels):
+    return tuple(sorted(labels.items()))
+
+
+class MemorySink(object):
+    """Aggregates everything in process for snapshot()"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, labels, seconds, error=None):
+        key = (name, _freeze(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+            if error is not None:
+                labels = dict(labels, error=error.__class__.__name__)
+                self._count((name + "_errors", _freeze(labels)), 1)
+
+    def incr(self, name, labels, value=1):
+        with self._lock:
+            self._count((name, _freeze(labels)), value)
+
+    def _count(self, key, value):
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def snapshot(self):
+        """Returns {"latency": [...], "counters": [...]} where every entry
+        has a name and a labels dict; latencies carry count, sum and the
+        cumulative buckets, counters a count"""
+        with self._lock:
+            latency = [{"name": name, "labels": dict(labels),
+                        "count": h.count, "sum": h.sum,
+                        "buckets": h.cumulative()}
+                       for (name, labels), h in self._histograms.items()]
+            counters = [{"name": name, "labels": dict(labels),
+                         "count": count}
+                        for (name, labels), count in self._counters.items()]
+        return {"latency": latency, "counters": counters}
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+
+class PrometheusSink(MemorySink):
+    """A MemorySink that can render itself in the Prometheus text format"""
+
+    def __init__(self, buckets=BUCKETS, prefix="aicq"):
+        super(PrometheusSink, self).__init__(buckets)
+        self.prefix = prefix
+
+    def _labels(self, labels, **extra):
+        labels = sorted(labels.items()) + sorted(extra.items())
+        return ",".join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                        for k, v in labels)
+
+    def render(self):
+        snapshot = self.snapshot()
+        lines = []
+        typed = set()
+        for entry in sorted(snapshot["latency"], key=lambda e: e["name"]):
+            metric = "%s_%s_seconds" % (self.prefix, entry["name"])
+            if metric not in typed:
+                typed.add(metric)
+                lines.append("# TYPE %s histogram" % metric)
+            for bound, count in entry["buckets"]:
+                lines.append("%s_bucket{%s} %d" %
+                             (metric, self._labels(entry["labels"], le=bound),
+                              count))
+            labels = self._labels(entry["labels"])
+            lines.append("%s_sum{%s} %f" % (metric, labels, entry["sum"]))
+            lines.append("%s_count{%s} %d" % (metric, labels, entry["count"]))
+        for entry in sorted(snapshot["counters"], key=lambda e: e["name"]):
+            metric = "%s_%s_total" % (self.prefix, entry["name"])
+            if metric not in typed:
+                typed.add(metric)
+                lines.append("# TYPE %s counter" % metric)
+            lines.append("%s{%s} %d" % (metric,
+                                        self._labels(entry["labels"]),
+                                        entry["count"]))
+        return "\n".join(lines) + "\n"
+
+
+class StatsdSink(object):
+    """Sends every observation as a StatsD timer or counter over UDP.
+    Label values, ordered by label name, become parts of the metric name:
+    aicq.request.get_network.0:12.5|ms"""
+
+    def __init__(self, address="127.0.0.1:%d" % DEFAULT_STATSD_PORT,
+                 prefix="aicq"):
+        host, _, port = address.partition(":")
+        self.address = (host, int(port or DEFAULT_STATSD_PORT))
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _name(self, name, labels):
+        parts = [self.prefix, name]
+        for key, value in _freeze(labels):
+            value = str(value)
+            for c in ".:|@ ":
+                value = value.replace(c, "_")
+            parts.append(value)
+        return ".".join(parts)
+
+    def _send(self, line):
+        try:
+            self._socket.sendto(line, self.address)
+        except socket.error:
+            pass
+
+    def observe(self, name, labels, seconds, error=None):
+        self._send("%s:%.3f|ms" % (self._name(name, labels), seconds * 1000))
+        if error is not None:
+            labels = dict(labels, error=error.__class__.__name__)
+            self.incr(name + "_errors", labels)
+
+    def incr(self, name, labels, value=1):
+        self._send("%s:%d|c" % (self._name(name, labels), value))
+
+
+class Metrics(object):
+    """Fans observations out to the attached sinks"""
+
+    def __init__(self, sinks=None):
+        self.sinks = list(sinks or [])
+        self.enabled = bool(self.sinks)
+        # pool.run workers record their requests under the caller's op
+        self._local = pool.InheritedLocal()
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+        self.enabled = True
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+        self.enabled = bool(self.sinks)
+
+    def observe(self, name, labels, seconds, error=None):
+        for sink in self.sinks:
+            sink.observe(name, labels, seconds, error)
+
+    def incr(self, name, labels, value=1):
+        for sink in self.sinks:
+            sink.incr(name, labels, value)
+
+    def operation(self):
+        """Returns the innermost instrumented method running in this
+        thread"""
+        return getattr(self._local, "op", None)
+
+    def time_call(self, layer, op, func, *args, **kwargs):
+        """Times func(*args, **kwargs). A generator it returns is timed
+        until it is exhausted or closed, see _time_iteration."""
+        labels = {"layer": layer, "op": op}
+        outer = self.operation()
+        self._local.op = op
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception, e:
+            self.observe(CALL, labels, time.time() - start, e)
+            raise
+        finally:
+            self._local.op = outer
+        if isinstance(result, types.GeneratorType):
+            return self._time_iteration(labels, result, time.time() - start)
+        self.observe(CALL, labels, time.time() - start)
+        return result
+
+    def _time_iteration(self, labels, generator, elapsed):
+        """Yields what generator does and records one call once it is done,
+        taking elapsed plus the time spent producing each item. The time
+        the caller spends between items is left out."""
+        error = None
+        try:
+            while True:
+                outer = self.operation()
+                self._local.op = labels["op"]
+                start = time.time()
+                try:
+                    item = generator.next()
+                except StopIteration:
+                    return
+                except Exception, e:
+                    error = e
+                    raise
+                finally:
+                    elapsed += time.time() - start
+                    self._local.op = outer
+                yield item
+        finally:
+            self.observe(CALL, labels, elapsed, error)
+
+
+def _timed(layer, op, func, get_metrics):
+    @functools.wraps(func)
+    def timed(self, *args, **kwargs):
+        metrics = get_metrics(self)
+        if metrics is None or not metrics.enabled:
+            return func(self, *args, **kwargs)
+        return metrics.time_call(layer, op, func, self, *args, **kwargs)
+    return timed
+
+
+def instrument(cls, layer, get_metrics):
+    """Wraps every public method of cls so its calls are timed by
+    get_metrics(instance) under the method name"""
+    for name, func in cls.__dict__.items():
+        if name.startswith("_") or not isinstance(func, types.FunctionType):
+            continue
+        setattr(cls, name, _timed(layer, name, func, get_metrics))
+    return cls
@@ -8,7 +8,12 @@ import logging
 
 import aiclib
 import aicq.blue
-from quantum.common import exceptions as exception
+import aicq.cache
+import aicq.lazy
+import aicq.pool
+
+# quantum is only imported once an error has to be raised
+exception = aicq.lazy.LazyModule("quantum.common.exceptions")
 
 LOG = logging.getLogger("aicq-nvplib")
 LOG.setLevel(logging.INFO)
@@ -32,6 +37,29 @@ def check_tenant(controller, net_id, tenant_id):
     return blue.check_tenant(net_id, tenant_id)
 
 
+def check_tenants(controller, net_ids, tenant_id):
+    """Checks the tenant owns each of net_ids, every network once and the
+    networks concurrently. Returns {<net id>: None} for owned networks and
+    {<net id>: <exception>} for the others, NetworkNotFound when the
+    tenant does not own it or it does not exist."""
+    if isinstance(controller, aicq.blue.Blue):
+        blue = controller
+    checks = {}
+    for net_id, owned, error in aicq.pool.run(
+            lambda net_id: blue.check_tenant(net_id, tenant_id),
+            set(net_ids), blue.bulk_concurrency):
+        if owned:
+            checks[net_id] = None
+        elif error is None or isinstance(error,
+                                         aiclib.nvp.ResourceNotFound):
+            checks[net_id] = exception.NetworkNotFound(net_id=net_id)
+        elif isinstance(error, aiclib.nvp.NVPException):
+            checks[net_id] = exception.QuantumException()
+        else:
+            checks[net_id] = error
+    return checks
+
+
 # -------------------------------------------------------------------
 # Network functions
 # -------------------------------------------------------------------
@@ -67,13 +95,23 @@ def get_all_networks(controller, tenant_id, networks):
     if isinstance(controller, aicq.blue.Blue):
         blue = controller
     try:
-        resp = blue.query_networks(tenant_id, fields=['uuid', 'display_name'])
+        switches = blue.iter_networks(tenant_id,
+                                      fields=['uuid', 'display_name'])
+        merge_networks(networks, switches)
     except aiclib.nvp.NVPException:
         raise exception.QuantumException()
-    switches = resp['results']
+    return networks
+
+
+def merge_networks(networks, switches):
+    """Appends every switch of the iterable switches to the network list
+    unless a network with its id is already there. A set of the ids seen
+    keeps this linear in the number of networks and switches."""
+    seen = set(x['id'] for x in networks)
     for switch in switches:
         net_id = switch['uuid']
-        if net_id not in [x['id'] for x in networks]:
+        if net_id not in seen:
+            seen.add(net_id)
             networks.append({"id": net_id,
                              "name": switch["display_name"]})
     return networks
@@ -82,32 +120,97 @@ def get_all_networks(controller, tenant_id, networks):
 def query_networks(controller, tenant_id, fields="*", tags=None):
     if isinstance(controller, aicq.blue.Blue):
         blue = controller
+    if fields == "*":
+        # only the id and name are handed back
+        fields = ['uuid', 'display_name']
     try:
-        resp = blue.query_networks(tenant_id, fields, tags)
+        nets = [{'id': switch['uuid'], 'name': switch['display_name']} for
+                switch in blue.iter_networks(tenant_id, fields, tags)]
     except aiclib.nvp.NVPException:
         raise exception.QuantumException()
-    if not resp:
-        return []
-    switches = resp['results']
-    nets = [{'id': switch['uuid'], 'name': switch['display_name']} for
-            switch in switches]
     return nets
 
 
+def get_networks_details(controller, tenant_id, net_ids):
+    """Returns the details of many networks at once keyed by net id:
+        {<net id>: {'id': <net id>, 'name': <display name>,
+                    'ifaces': [<vif uuid>, ...], 'net-op-status': 'UP'}}
+    The tenant's switches are read with a single tag filtered query and
+    the attachments of every network are queried concurrently. Networks
+    that do not exist or are not owned by the tenant are left out."""
+    if isinstance(controller, aicq.blue.Blue):
+        blue = controller
+    wanted = set(net_ids)
+    try:
+        # iter_networks asks only for the switches tagged with tenant_id
+        switches = blue.iter_networks(
+                tenant_id, fields=['uuid', 'display_name', 'tags'])
+        switches = [s for s in switches if s['uuid'] in wanted and
+                    tenant_id in aicq.cache.network_owners(s)]
+    except aiclib.nvp.NVPException:
+        raise exception.QuantumException()
+
+    def remote_vifs(switch):
+        vifs = []
+        for port in blue.iter_ports(switch['uuid'], fields=['uuid'],
+                                    relations="LogicalPortAttachment"):
+            vic = port["_relations"]["LogicalPortAttachment"]
+            if "vif_uuid" in vic:
+                vifs.append(vic["vif_uuid"])
+        return vifs
+
+    details = {}
+    for switch, vifs, error in aicq.pool.run(remote_vifs, switches,
+                                             blue.bulk_concurrency):
+        if isinstance(error, aiclib.nvp.ResourceNotFound):
+            LOG.debug("Network \"%s\" vanished while reading its ports" %
+                      switch['uuid'])
+            continue
+        if error is not None:
+            LOG.error("Reading ports of \"%s\" failed, Error: %s" %
+                      (switch['uuid'], error))
+            raise exception.QuantumException()
+        details[switch['uuid']] = {
+            "id": switch['uuid'],
+            "ifaces": vifs,
+            "name": switch["display_name"],
+            "net-op-status": "UP",
+        }
+    return details
+
+
 def delete_network(controller, network):
     delete_networks(controller, [network])
 
 
-def delete_networks(controller, networks):
+def _delete_network_error(e, network):
+    if isinstance(e, aiclib.nvp.ResourceNotFound):
+        return exception.NetworkNotFound(net_id=network)
+    if isinstance(e, aiclib.nvp.NVPException):
+        return exception.QuantumException()
+    return e
+
+
+def delete_networks(controller, networks, concurrent=False,
+                    max_workers=None):
+    """Deletes the networks one after another, raising on the first one
+    that fails. With concurrent set the deletes are sent in parallel and
+    the deleted/not_found/failed report of Blue.delete_networks is
+    returned instead, with each failure mapped to the exception the
+    sequential path would raise."""
     if isinstance(controller, aicq.blue.Blue):
         blue = controller
+    if concurrent:
+        report = blue.delete_networks(networks, max_workers=max_workers)
+        report["failed"] = dict(
+                (network, _delete_network_error(e, network))
+                for network, e in report["failed"].items())
+        return report
     for network in networks:
         try:
             blue.delete_network(network)
-        except aiclib.nvp.ResourceNotFound:
-            raise exception.NetworkNotFound(net_id=network)
-        except aiclib.nvp.NVPException:
-            raise exception.QuantumException()
+        except aiclib.nvp.NVPException as e:
+            raise _delete_network_error(e, network)
 
 
 def create_lswitch(controller, lswitch_obj):
@@ -138,11 +241,11 @@ def create_network(tenant_id, net_name, **kwargs):
 def get_port_stats(controller, network_id, port_id):
     if isinstance(controller, aicq.blue.Blue):
         blue = controller
-    if not blue.check_network_existance(network_id):
-        LOG.error("Network not found, Error")
-        raise exception.NetworkNotFound(net_id=network_id)
     try:
         stats = blue.get_port_stats(network_id, port_id)
+    except aicq.blue.NetworkNotFound:
+        LOG.error("Network not found, Error")
+        raise exception.NetworkNotFound(net_id=network_id)
     except aiclib.nvp.ResourceNotFound as e:
         LOG.error("Port not found, Error: %s" % str(e))
         raise exception.PortNotFound(port_id=port_id, net_id=network_id)
@@ -164,7 +267,7 @@ def query_ports(controller, network, relations=None, fields="*",
     if isinstance(controller, aicq.blue.Blue):
         blue = controller
     try:
-        results = blue.query_ports(network, relations, fields, filters)
+        results = list(blue.iter_ports(network, relations, fields, filters))
     except aiclib.nvp.ResourceNotFound as e:
         LOG.error("Network not found, Error: %s" % str(e))
         raise exception.NetworkNotFound(net_id=network)
@@ -178,6 +281,9 @@ def delete_port(controller, network, port):
         blue = controller
     try:
         blue.delete_port(network, port)
+    except aicq.blue.NetworkNotFound:
+        LOG.error("Network not found, Error")
+        raise exception.NetworkNotFound(net_id=network)
     except aiclib.nvp.ResourceNotFound as e:
         LOG.error("Port or Network not found, Error: %s" % str(e))
         raise exception.PortNotFound(port_id=port, net_id=network)
@@ -186,12 +292,22 @@ def delete_port(controller, network, port):
 
 
 def delete_all_ports(controller, ls_uuid):
+    """Returns the report of Blue.delete_all_ports. Ports that were
+    already gone do not matter, but if any other delete failed
+    QuantumException is raised like it was before the deletes were
+    batched."""
     if isinstance(controller, aicq.blue.Blue):
         blue = controller
     try:
-        blue.delete_all_ports(ls_uuid)
+        report = blue.delete_all_ports(ls_uuid)
+    except aicq.blue.NetworkNotFound:
+        LOG.error("Network not found, Error")
+        raise exception.NetworkNotFound(net_id=ls_uuid)
     except aiclib.nvp.NVPException:
         raise exception.QuantumException()
+    if report["failed"]:
+        raise exception.QuantumException()
+    return report
 
 
 def get_port(controller, network, port, relations=None):
@@ -207,39 +323,76 @@ def get_port(controller, network, port, relations=None):
     return port
 
 
+def _plug_error(e, network, port, attachment):
+    """Returns the quantum exception a failed attach of attachment to port
+    is reported as"""
+    if isinstance(e, aiclib.nvp.ResourceNotFound):
+        LOG.error("Port or Network not found, Error: %s" % str(e))
+        return exception.PortNotFound(port_id=port, net_id=network)
+    if isinstance(e, aiclib.nvp.Conflict):
+        LOG.error("Conflict while making attachment to port, "
+                  "Error: %s" % str(e))
+        return exception.AlreadyAttached(att_id=attachment,
+                                         port_id=port,
+                                         net_id=network,
+                                         att_port_id="UNKNOWN")
+    if isinstance(e, aiclib.nvp.NVPException):
+        return exception.QuantumException()
+    return e
+
+
+def _unplug_error(e, network, port):
+    if isinstance(e, aiclib.nvp.ResourceNotFound):
+        LOG.error("Port or Network not found, Error: %s" % str(e))
+        return exception.PortNotFound(port_id=port, net_id=network)
+    if isinstance(e, aiclib.nvp.NVPException):
+        return exception.QuantumException()
+    return e
+
+
 def plug_interface(controller, network, port, attach_type, attachment=None):
     if isinstance(controller, aicq.blue.Blue):
         blue = controller
     try:
         resp = blue.plug_vif_interface(network, port, attachment)
-    except aiclib.nvp.ResourceNotFound:
-        LOG.error("Port or Network not found, Error: %s" % str(e))
-        raise exception.PortNotFound(port_id=port, net_id=network)
-    except aiclib.nvp.Conflict as e:
-        LOG.error("Conflict while making attachment to port, "
-                  "Error: %s" % str(e))
-        raise exception.AlreadyAttached(att_id=attachment,
-                                        port_id=port,
-                                        net_id=network,
-                                        att_port_id="UNKNOWN")
-    except aiclib.nvp.NVPException:
-        raise exception.QuantumException()
+    except aiclib.nvp.NVPException as e:
+        raise _plug_error(e, network, port, attachment)
     return resp
 
 
+def plug_interfaces(controller, attachments, max_workers=None):
+    """Plugs many (network, port, attachment) at once, concurrently. A
+    failed attach does not stop the others. Returns the outcome of every
+    attachment in input order:
+        [((network, port, attachment), <result>, None), ...
+         ((network, port, attachment), None, <exception>), ...]
+    where the exception is the one plug_interface would raise."""
+    if isinstance(controller, aicq.blue.Blue):
+        blue = controller
+    outcomes = blue.plug_vif_interfaces(attachments, max_workers=max_workers)
+    return [(item, result, error and _plug_error(error, *item))
+            for item, result, error in outcomes]
+
+
 def unplug_interface(controller, network, port):
     if isinstance(controller, aicq.blue.Blue):
         blue = controller
     try:
         resp = blue.unplug_interface(network, port)
-    except aiclib.nvp.ResourceNotFound as e:
-        LOG.error("Port or Network not found, Error: %s" % str(e))
-        raise exception.PortNotFound(port_id=port, net_id=network)
-    except aiclib.nvp.NVPException:
-        raise exception.QuantumException()
+    except aiclib.nvp.NVPException as e:
+        raise _unplug_error(e, network, port)
     return resp
 
 
+def unplug_interfaces(controller, ports, max_workers=None):
+    """Unplugs many (network, port) at once like plug_interfaces"""
+    if isinstance(controller, aicq.blue.Blue):
+        blue = controller
+    outcomes = blue.unplug_interfaces(ports, max_workers=max_workers)
+    return [(item, result, error and _unplug_error(error, *item))
+            for item, result, error in outcomes]
+
+
 def update_port(network, port_id, **params):
     controller = params["controller"]
     if isinstance(controller, aicq.blue.Blue):
@@ -251,13 +404,14 @@ def update_port(network, port_id, **params):
         if state == "DOWN":
             admin_status = False
     try:
-        resp = blue.update_port(network, port_id, state=admin_status)
+        resp, status = blue.update_port_with_status(network, port_id,
+                                                    state=admin_status)
     except aiclib.nvp.ResourceNotFound as e:
         LOG.error("Port or Network not found, Error: %s" % str(e))
         raise exception.PortNotFound(port_id=port_id, net_id=network)
     except aiclib.nvp.NVPException:
         raise exception.QuantumException()
-    resp['port-op-status'] = get_port_status(controller, network, resp["uuid"])
+    resp['port-op-status'] = status
     return resp
 
 
@@ -269,30 +423,121 @@ def create_port(tenant, network, port_init_state, **params):
         blue = controller
 
     try:
-        if port_init_state == "DOWN":
-            port = blue.create_disabled_port(tenant, network, params)
-        else:
-            port = blue.create_enabled_port(tenant, network, params)
+        port, status = blue.create_port_with_status(
+                tenant, network, port_init_state != "DOWN")
+    except aicq.blue.PortNotFound as e:
+        LOG.error("Port not found, Error: %s" % str(e))
+        raise exception.PortNotFound(port_id=e.uuid, net_id=network)
     except aiclib.nvp.ResourceNotFound as e:
         LOG.error("Network not found, Error: %s" % str(e))
         raise exception.NetworkNotFound(net_id=network)
     except aiclib.nvp.NVPException:
         raise exception.QuantumException()
-    port['port-op-status'] = get_port_status(controller, network, port['uuid'])
+    port['port-op-status'] = status
     return port
 
 
-def get_port_status(controller, lswitch_id, port_id):
+def create_and_plug_port(tenant, network, attachment, port_init_state,
+                         **params):
+    """Creates a port with the vif attachment plugged in, see
+    Blue.create_and_plug_port"""
+    check_port_state(port_init_state)
+
+    controller = params["controller"]
+    if isinstance(controller, aicq.blue.Blue):
+        blue = controller
+
+    try:
+        port, status = blue.create_and_plug_port(
+                tenant, network, attachment, port_init_state != "DOWN")
+    except aicq.blue.PortNotFound as e:
+        LOG.error("Port not found, Error: %s" % str(e))
+        raise exception.PortNotFound(port_id=e.uuid, net_id=network)
+    except aiclib.nvp.ResourceNotFound as e:
+        LOG.error("Network not found, Error: %s" % str(e))
+        raise exception.NetworkNotFound(net_id=network)
+    except aiclib.nvp.Conflict as e:
+        LOG.error("Conflict while making attachment to port, "
+                  "Error: %s" % str(e))
+        raise exception.AlreadyAttached(att_id=attachment,
+                                        port_id="UNKNOWN",
+                                        net_id=network,
+                                        att_port_id="UNKNOWN")
+    except aiclib.nvp.NVPException:
+        raise exception.QuantumException()
+    port['port-op-status'] = status
+    return port
+
+
+def create_ports(tenant, network, count_or_specs, port_init_state,
+                 **params):
+    """Creates many ports on one network at once. count_or_specs is the
+    number of ports or a list of port specs, dicts whose 'state' overrides
+    port_init_state for that port. Every state is checked before anything
+    is created. Returns the ports like create_port in input order.
+
+    Should any create fail the ports already created are deleted again and
+    the error of the first failed one is raised."""
+    if isinstance(count_or_specs, (int, long)):
+        specs = [{}] * count_or_specs
+    else:
+        specs = list(count_or_specs)
+    states = [spec.get("state", port_init_state) for spec in specs]
+    for state in set(states):
+        check_port_state(state)
+
+    controller = params["controller"]
     if isinstance(controller, aicq.blue.Blue):
         blue = controller
+
     try:
-        if not blue.check_network_existance(lswitch_id):
-            LOG.error("Network not found, Error")
-            raise exception.NetworkNotFound(net_id=lswitch_id)
+        outcomes = blue.create_ports(tenant, network,
+                                     [state != "DOWN" for state in states],
+                                     max_workers=params.get("max_workers"))
+    except aicq.blue.NetworkNotFound:
+        LOG.error("Network not found, Error")
+        raise exception.NetworkNotFound(net_id=network)
     except aiclib.nvp.NVPException:
-        raise exception.QuantumException
+        raise exception.QuantumException()
+
+    errors = [error for enabled, result, error in outcomes
+              if error is not None]
+    if errors:
+        # ports whose status read failed were created all the same
+        created = [result[0]["uuid"] for enabled, result, error in outcomes
+                   if result is not None]
+        rollback = aicq.pool.run(lambda port: blue.delete_port(network, port),
+                                 created, blue.bulk_concurrency)
+        for port, result, error in rollback:
+            if error is not None:
+                LOG.error("Could not delete port %s after create_ports "
+                          "failed: %s" % (port, error))
+        e = errors[0]
+        if isinstance(e, aicq.blue.PortNotFound):
+            LOG.error("Port not found, Error: %s" % str(e))
+            raise exception.PortNotFound(port_id=e.uuid, net_id=network)
+        if isinstance(e, aiclib.nvp.ResourceNotFound):
+            LOG.error("Network not found, Error: %s" % str(e))
+            raise exception.NetworkNotFound(net_id=network)
+        if isinstance(e, aiclib.nvp.NVPException):
+            raise exception.QuantumException()
+        raise e
+
+    ports = []
+    for enabled, (port, status), error in outcomes:
+        port['port-op-status'] = status
+        ports.append(port)
+    return ports
+
+
+def get_port_status(controller, lswitch_id, port_id):
+    if isinstance(controller, aicq.blue.Blue):
+        blue = controller
     try:
         status = blue.get_port_link_status(lswitch_id, port_id)
+    except aicq.blue.NetworkNotFound:
+        LOG.error("Network not found, Error")
+        raise exception.NetworkNotFound(net_id=lswitch_id)
     except aiclib.nvp.ResourceNotFound as e:
         LOG.error("Port not found, Error: %s" % str(e))
         raise exception.PortNotFound(port_id=port_id, net_id=lswitch_id)
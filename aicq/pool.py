@@ -0,0 +1,172 @@
+"""A minimal bounded worker pool for issuing many independent controller
+requests at once, and an Executor handing out futures for callers that
+want to overlap requests. Under eventlet monkey patching the workers
+become green threads.
+"""
+import Queue
+import sys
+import threading
+import weakref
+
+
+DEFAULT_WORKERS = 10
+
+_inherited = weakref.WeakKeyDictionary()
+
+
+class InheritedLocal(threading.local):
+    """A threading.local whose values the workers of run start out with,
+    as they were in the thread that called run"""
+
+    def __init__(self):
+        _inherited[self] = True
+
+
+def _context():
+    return [(local, dict(local.__dict__)) for local in _inherited.keys()]
+
+
+def _enter(context):
+    for local, values in context:
+        local.__dict__.update(values)
+
+
+def run(func, items, max_workers=DEFAULT_WORKERS):
+    """Calls func(item) for every item using at most max_workers threads.
+    The workers see the values of every InheritedLocal this thread sees.
+
+    Errors do not stop the run. Returns a list of (item, result, error)
+    tuples in input order where error is the raised exception or None.
+    """
+    items = list(items)
+    outcomes = [None] * len(items)
+
+    def call(index):
+        item = items[index]
+        try:
+            outcomes[index] = (item, func(item), None)
+        except Exception, e:
+            outcomes[index] = (item, None, e)
+
+    workers = min(max_workers, len(items))
+    if workers <= 1:
+        for index in xrange(len(items)):
+            call(index)
+        return outcomes
+
+    todo = Queue.Queue()
+    for index in xrange(len(items)):
+        todo.put(index)
+    context = _context()
+
+    def worker():
+        _enter(context)
+        while True:
+            try:
+                index = todo.get_nowait()
+            except Queue.Empty:
+                return
+            call(index)
+
+    threads = [threading.Thread(target=worker) for i in xrange(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
+class Future(object):
+    """The eventual result of a call submitted to an Executor"""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Waits for the call and returns its result or raises its error"""
+        self._done.wait(timeout)
+        if not self._done.is_set():
+            raise RuntimeError("Timed out waiting for result")
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        self._done.wait(timeout)
+        return self._error and self._error[1]
+
+    def add_done_callback(self, callback):
+        """callback(future) is called once the call finished, right away if
+        it already has"""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self, result=None, error=None):
+        with self._lock:
+            self._result = result
+            self._error = error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class Executor(object):
+    """A fixed set of worker threads running submitted calls"""
+
+    def __init__(self, max_workers=DEFAULT_WORKERS):
+        self.max_workers = max_workers
+        self._todo = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """Queues func(*args, **kwargs) and returns its Future"""
+        future = Future()
+        self._todo.put((future, func, args, kwargs))
+        self._start_worker()
+        return future
+
+    def _start_worker(self):
+        with self._lock:
+            if len(self._threads) >= self.max_workers:
+                return
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            future, func, args, kwargs = self._todo.get()
+            if future is None:
+                return
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                future._finish(error=sys.exc_info())
+            else:
+                future._finish(result=result)
+
+    def shutdown(self):
+        with self._lock:
+            for thread in self._threads:
+                self._todo.put((None, None, None, None))
+            self._threads = []
+
+
+def wait_all(futures, timeout=None):
+    """Waits for every future and returns their results in order, raising
+    the first error"""
+    return [future.result(timeout) for future in futures]
@@ -0,0 +1,181 @@
+"""Latency and health aware selection between the NVP controllers known to
+Blue. Every request outcome is recorded against its controller and an
+optional background probe keeps the figures of idle controllers fresh.
+"""
+import logging
+import threading
+import time
+
+
+LOG = logging.getLogger("aicq-selector")
+LOG.setLevel(logging.INFO)
+
+DEFAULT_PROBE_INTERVAL = 30
+# Weight of the newest sample in the rolling latency and error rate
+DEFAULT_ALPHA = 0.3
+# A controller whose rolling error rate goes above this is unhealthy
+DEFAULT_MAX_ERROR_RATE = 0.5
+# A failed controller is passed over for this many seconds, then ranked by
+# its latency again so a request tries it
+DEFAULT_RETRY_AFTER = 10
+# The error rate halves every this many seconds without new samples
+DEFAULT_ERROR_HALF_LIFE = 60
+# The current controller is kept unless another is this much faster
+SWITCH_MARGIN = 1.5
+
+
+class ControllerStats(object):
+    """Rolling latency and error rate of a single controller.
+
+    A failure makes the controller unhealthy for retry_after seconds.
+    After that it is healthy again unless its error rate is still above
+    max_error_rate. The error rate decays while no requests are recorded,
+    so a controller that gets no traffic is not held back by old failures.
+    """
+
+    def __init__(self, alpha=DEFAULT_ALPHA,
+                 max_error_rate=DEFAULT_MAX_ERROR_RATE,
+                 retry_after=DEFAULT_RETRY_AFTER,
+                 half_life=DEFAULT_ERROR_HALF_LIFE):
+        self.alpha = alpha
+        self.max_error_rate = max_error_rate
+        self.retry_after = retry_after
+        self.half_life = half_life
+        self.latency = None
+        self.requests = 0
+        self.failures = 0
+        self.failed_at = None
+        self._error_rate = 0.0
+        self._updated_at = time.time()
+
+    def _average(self, current, sample):
+        if current is None:
+            return sample
+        return self.alpha * sample + (1 - self.alpha) * current
+
+    @property
+    def error_rate(self):
+        idle = max(0.0, time.time() - self._updated_at)
+        return self._error_rate * 0.5 ** (idle / self.half_life)
+
+    @property
+    def healthy(self):
+        if self.failed_at is not None and \
+                time.time() - self.failed_at < self.retry_after:
+            return False
+        return self.error_rate <= self.max_error_rate
+
+    def _record_error(self, sample):
+        self._error_rate = self._average(self.error_rate, sample)
+        self._updated_at = time.time()
+
+    def record_success(self, latency):
+        self.requests += 1
+        self.latency = self._average(self.latency, latency)
+        self._record_error(0.0)
+        self.failed_at = None
+
+    def record_failure(self):
+        self.requests += 1
+        self.failures += 1
+        self._record_error(1.0)
+        self.failed_at = time.time()
+
+    def to_dict(self):
+        return {"latency": self.latency, "error_rate": self.error_rate,
+                "healthy": self.healthy, "requests": self.requests,
+                "failures": self.failures}
+
+
+class ControllerSelector(object):
+    """Picks the fastest healthy controller out of Blue.connections"""
+
+    def __init__(self, connections):
+        self.connections = connections
+        self.stats = {}
+        self._lock = threading.Lock()
+        self._probe_thread = None
+        self._probe_stop = threading.Event()
+
+    def stats_for(self, conn):
+        stats = self.stats.get(conn.conn_id)
+        if stats is None:
+            with self._lock:
+                stats = self.stats.setdefault(conn.conn_id,
+                                              ControllerStats())
+        return stats
+
+    def _rank(self, conn):
+        """Healthy controllers first, then by rolling latency. A controller
+        that has not been measured yet ranks as fast so it gets tried."""
+        stats = self.stats_for(conn)
+        return (not stats.healthy, stats.latency or 0.0, stats.error_rate)
+
+    def select(self, current=None, exclude=()):
+        """Returns the controller requests should go to. current is kept
+        while it is healthy and not clearly slower than a measured one.
+        Controllers in exclude are only returned if nothing else is left.
+        """
+        candidates = [c for c in self.connections if c not in exclude]
+        if not candidates:
+            candidates = self.connections
+        best = min(candidates, key=self._rank)
+        if current is None or current in exclude or current is best:
+            return best
+        stats = self.stats_for(current)
+        best_latency = self.stats_for(best).latency
+        if not stats.healthy:
+            return best
+        if (stats.latency is None or best_latency is None or
+                stats.latency <= best_latency * SWITCH_MARGIN):
+            return current
+        return best
+
+    def record_success(self, conn, latency):
+        self.stats_for(conn).record_success(latency)
+
+    def record_failure(self, conn):
+        self.stats_for(conn).record_failure()
+
+    def report(self):
+        """Returns the stats of every controller keyed by conn_id"""
+        return dict((c['conn_id'], self.stats_for(c).to_dict())
+                    for c in self.connections)
+
+# --------------------------------
+# Background health probe
+# --------------------------------
+
+    def probe_all(self, probe):
+        """Calls probe(conn) for every controller and records how it went"""
+        for conn in self.connections:
+            start = time.time()
+            try:
+                probe(conn)
+            except Exception, e:
+                LOG.warning("Health probe of %s failed: %s" % (conn.ip, e))
+                self.record_failure(conn)
+            else:
+                self.record_success(conn, time.time() - start)
+
+    def start_probe(self, probe, interval=DEFAULT_PROBE_INTERVAL):
+        """Runs probe_all every interval seconds in a daemon thread"""
+        if interval <= 0 or self._probe_thread is not None:
+            return
+        self._probe_stop.clear()
+
+        def loop():
+            while True:
+                self._probe_stop.wait(interval)
+                if self._probe_stop.is_set():
+                    return
+                self.probe_all(probe)
+
+        self._probe_thread = threading.Thread(target=loop,
+                                              name="aicq-health-probe")
+        self._probe_thread.daemon = True
+        self._probe_thread.start()
+
+    def stop_probe(self):
+        self._probe_stop.set()
+        self._probe_thread = None
@@ -0,0 +1,68 @@
+"""Coalescing of identical concurrent reads. While a read of a key is in
+flight, callers asking for the same key wait for it and share its result
+instead of sending their own request to the controller.
+"""
+import copy
+import sys
+import threading
+
+from aicq import pool
+
+
+class SingleFlight(object):
+    """Runs at most one call per key at a time. Followers share a copy of
+    the leader's result, taken before the leader returns, or get the
+    leader's error raised again."""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.calls = 0
+        self.coalesced = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """Returns func(), or the result of the func already running for
+        key"""
+        if not self.enabled:
+            return func()
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            if flight is None:
+                # [future, number of followers]
+                flight = self._flights[key] = [pool.Future(), 0]
+                leader = True
+            else:
+                flight[1] += 1
+                self.coalesced += 1
+                leader = False
+        if not leader:
+            return copy.deepcopy(flight[0].result())
+        result = error = None
+        try:
+            result = func()
+        except BaseException:
+            error = sys.exc_info()
+            raise
+        finally:
+            # landed whatever func raised, or followers would wait on the
+            # key forever
+            self._land(key, result, error)
+        return result
+
+    def _land(self, key, result=None, error=None):
+        with self._lock:
+            future, followers = self._flights.pop(key)
+        if followers and error is None:
+            try:
+                result = copy.deepcopy(result)
+            except Exception:
+                error = sys.exc_info()
+        future._finish(result=result, error=error)
+
+    def stats(self):
+        with self._lock:
+            in_flight = len(self._flights)
+        return {"calls": self.calls, "coalesced": self.coalesced,
+                "in_flight": in_flight}
@@ -3,13 +3,139 @@ Created: August 27, 2012
 
 @author: Justin Hammond, Rackspace Hosting
 """
+import os
+import SocketServer
 import sys
+import tempfile
+import threading
+import time
 
 if sys.version_info >= (2, 7):
     import unittest
 else:
     import unittest2 as unittest
 
+import aiclib
+from aiclib import nvpentity
+from aiclib import nvpquery
+import mock
+
+from aicq import blue
+
 
 class TestCase(unittest.TestCase):
     pass
+
+
+CONFIG = """[NVP]
+DEFAULT_TZ_UUID = tz
+NVP_CONTROLLER_CONNECTIONS = CONN_1 CONN_2
+CONN_1=nvp1:443:admin:password:30:10:2:2
+CONN_2=nvp2:443:admin:password:30:10:2:2
+HEALTH_CHECK_INTERVAL = 0
+%s
+"""
+
+
+def make_blue(extra=""):
+    """Returns a Blue for two controllers whose aiclib clients are mocks.
+    extra is appended to the NVP section of the config."""
+    fd, path = tempfile.mkstemp(suffix=".ini")
+    os.write(fd, CONFIG % extra)
+    os.close(fd)
+    try:
+        b = blue.Blue(path)
+    finally:
+        os.remove(path)
+    b.clients[0] = make_client()
+    b.clients[1] = make_client()
+    return b
+
+
+def _entity(cls, query_cls):
+    entity = mock.MagicMock(spec=cls)
+    entity.query.return_value = mock.MagicMock(spec=query_cls)
+    return entity
+
+
+def make_client():
+    """Returns a mock aiclib client whose entities and queries are specced
+    on the installed aiclib classes, so calling a method aiclib lacks
+    fails the test"""
+    client = mock.MagicMock(spec=aiclib.nvp.Connection)
+    client.lswitch.return_value = _entity(nvpentity.LSwitch,
+                                          nvpquery.LSwitchQuery)
+    client.lswitch_port.return_value = _entity(
+            nvpentity.LSwitchPort, nvpquery.LSwitchPortQuery)
+    client.zone.return_value = _entity(nvpentity.TransportZone,
+                                       nvpquery.TransportZoneQuery)
+    client.nvp_function.return_value = mock.MagicMock(
+            spec=aiclib.nvp.NVPFunction)
+    return client
+
+
+def switch(net_id, tenant_id):
+    """Returns an lswitch document owned by tenant_id"""
+    return {"uuid": net_id, "display_name": net_id,
+            "tags": [{"scope": "os_tid", "tag": tenant_id}]}
+
+
+class _MemcachedHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        items = self.server.items
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.split()
+            verb, args = parts[0], parts[1:]
+            if verb == "get":
+                for key in args:
+                    item = items.get(key)
+                    if item and (not item[1] or item[1] > time.time()):
+                        self.wfile.write("VALUE %s 0 %d\r\n%s\r\n" %
+                                         (key, len(item[0]), item[0]))
+                self.wfile.write("END\r\n")
+            elif verb in ("set", "add"):
+                data = self.rfile.read(int(args[3]) + 2)[:-2]
+                if verb == "add" and args[0] in items:
+                    self.wfile.write("NOT_STORED\r\n")
+                    continue
+                ttl = int(args[2])
+                items[args[0]] = (data, ttl and time.time() + ttl)
+                self.wfile.write("STORED\r\n")
+            elif verb == "delete":
+                found = items.pop(args[0], None)
+                self.wfile.write(found and "DELETED\r\n" or
+                                 "NOT_FOUND\r\n")
+            elif verb == "incr":
+                if args[0] not in items:
+                    self.wfile.write("NOT_FOUND\r\n")
+                    continue
+                data, expiry = items[args[0]]
+                data = str(int(data) + int(args[1]))
+                items[args[0]] = (data, expiry)
+                self.wfile.write(data + "\r\n")
+            else:
+                self.wfile.write("ERROR\r\n")
+
+
+class FakeMemcached(SocketServer.ThreadingTCPServer):
+    """A memcached stand-in on a free local port speaking enough of the
+    text protocol for cache.MemcachedBackend"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0),
+                                                 _MemcachedHandler)
+        self.items = {}
+        self.address = "127.0.0.1:%d" % self.server_address[1]
+        thread = threading.Thread(target=self.serve_forever,
+                                  kwargs={"poll_interval": 0.05})
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,108 @@
+import threading
+import time
+
+from aicq import async_blue
+from aicq import blue
+from aicq import pool
+from aicq import test
+
+
+class TestAsyncBlue(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue()
+        self.ablue = async_blue.AsyncBlue(blue=self.blue,
+                                          max_per_controller=2)
+        self.lswitch = self.blue.clients[0].lswitch
+
+    def tearDown(self):
+        self.ablue.shutdown()
+
+    def test_returns_futures(self):
+        self.lswitch.return_value.read.return_value = \
+            test.switch("net", "t1")
+        futures = [self.ablue.get_network("net") for i in range(10)]
+        results = pool.wait_all(futures)
+        self.assertEqual([r["uuid"] for r in results], ["net"] * 10)
+
+    def test_errors_raised_from_result(self):
+        self.lswitch.return_value.read.side_effect = \
+            blue.aiclib.nvp.ResourceNotFound()
+        future = self.ablue.get_network("net")
+        self.assertRaises(blue.aiclib.nvp.ResourceNotFound, future.result)
+
+    def test_bounded_per_controller(self):
+        lock = threading.Lock()
+        state = {"now": 0, "max": 0}
+
+        def read():
+            with lock:
+                state["now"] += 1
+                state["max"] = max(state["max"], state["now"])
+            time.sleep(0.01)
+            with lock:
+                state["now"] -= 1
+            return {}
+
+        self.lswitch.return_value.read.side_effect = read
+        pool.wait_all([self.ablue.get_network("net%d" % i)
+                       for i in range(12)])
+        self.assertEqual(state["max"], 2)
+
+    def test_bulk_workers_limited(self):
+        lock = threading.Lock()
+        state = {"now": 0, "max": 0}
+
+        def delete():
+            with lock:
+                state["now"] += 1
+                state["max"] = max(state["max"], state["now"])
+            time.sleep(0.01)
+            with lock:
+                state["now"] -= 1
+
+        client = self.blue.clients[0]
+        query = client.lswitch_port.return_value.query.return_value
+        query.results.return_value = {"results": [{"uuid": "p%d" % i}
+                                                  for i in range(12)]}
+        client.lswitch_port.return_value.delete.side_effect = delete
+        self.blue.trust_controller = True
+        report = self.ablue.delete_all_ports("net", max_workers=6).result()
+        self.assertEqual(len(report["deleted"]), 12)
+        self.assertEqual(state["max"], 2)
+
+    def test_direct_callers_not_limited(self):
+        conn = self.blue.connections[0]
+        self.assertTrue(self.blue._limit(conn) is blue._UNLIMITED)
+        self.assertEqual(self.blue.controller_concurrency, 0)
+
+    def test_callbacks(self):
+        self.lswitch.return_value.read.return_value = {}
+        done = []
+        called = threading.Event()
+
+        def callback(future):
+            done.append(future)
+            called.set()
+
+        future = self.ablue.get_network("net")
+        future.add_done_callback(callback)
+        future.result()
+        # the callbacks run right after the result is set
+        called.wait(5)
+        future.add_done_callback(done.append)
+        self.assertEqual(done, [future, future])
+
+    def test_identical_reads_coalesced(self):
+        release = threading.Event()
+
+        def read():
+            release.wait(5)
+            return test.switch("net", "t1")
+
+        self.lswitch.return_value.read.side_effect = read
+        futures = [self.ablue.get_network("net") for i in range(4)]
+        while self.blue.coalescing_stats()["calls"] < 4:
+            time.sleep(0.001)
+        release.set()
+        pool.wait_all(futures)
+        self.assertEqual(self.lswitch.return_value.read.call_count, 1)
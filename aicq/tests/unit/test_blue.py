@@ -0,0 +1,820 @@
+import threading
+import time
+
+import mock
+
+from aicq import blue
+from aicq import selector
+from aicq import test
+
+
+class TestOwnershipCache(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue()
+        self.lswitch = self.blue.clients[0].lswitch
+
+    def test_check_tenant_reads_once(self):
+        query = self.lswitch.return_value.query.return_value
+        query.results.return_value = {"results": [test.switch("net", "t1")]}
+        self.assertTrue(self.blue.check_tenant("net", "t1"))
+        self.assertTrue(self.blue.check_tenant("net", "t1"))
+        self.assertFalse(self.blue.check_tenant("net", "t2"))
+        self.assertEqual(query.results.call_count, 1)
+        query.fields.assert_called_once_with(["uuid", "tags"])
+        self.assertFalse(self.lswitch.return_value.read.called)
+        stats = self.blue.ownership_cache_stats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_check_tenant_any_tag(self):
+        query = self.lswitch.return_value.query.return_value
+        network = test.switch("net", "t1")
+        network["tags"].append({"scope": "os_tid", "tag": "t2"})
+        query.results.return_value = {"results": [network]}
+        self.assertTrue(self.blue.check_tenant("net", "t2"))
+        self.assertTrue(self.blue.check_tenant("net", "t1"))
+        self.assertFalse(self.blue.check_tenant("net", "t3"))
+        self.assertEqual(query.results.call_count, 1)
+
+    def test_create_network_fills_cache(self):
+        self.lswitch.return_value.create.return_value = \
+            test.switch("net", "t1")
+        self.blue.create_network("t1", "name")
+        self.assertTrue(self.blue.check_tenant("net", "t1"))
+        self.assertFalse(self.lswitch.return_value.read.called)
+
+    def test_query_networks_fills_cache(self):
+        query = self.lswitch.return_value.query.return_value
+        query.results.return_value = {"results": [test.switch("a", "t1"),
+                                                  test.switch("b", "t2")]}
+        self.blue.query_networks(None)
+        self.assertTrue(self.blue.check_tenant("a", "t1"))
+        self.assertTrue(self.blue.check_tenant("b", "t2"))
+        self.assertFalse(self.lswitch.return_value.read.called)
+
+    def test_query_networks_filters_by_tenant(self):
+        query = self.lswitch.return_value.query.return_value
+        query.results.return_value = {"results": [{"uuid": "a"}]}
+        self.blue.query_networks("t1", fields=["uuid"])
+        query.tags.assert_called_once_with(["t1"])
+        query.tagscopes.assert_called_once_with(["os_tid"])
+        query.fields.assert_called_once_with(["uuid"])
+        # the filter vouches for the owner of a switch without tags
+        self.assertTrue(self.blue.check_tenant("a", "t1"))
+        self.assertEqual(query.results.call_count, 1)
+        # but cannot tell whether it has other owners
+        query.results.return_value = {"results": [test.switch("a", "t1")]}
+        self.assertFalse(self.blue.check_tenant("a", "t2"))
+        self.assertEqual(query.results.call_count, 2)
+        self.assertFalse(self.blue.check_tenant("a", "t2"))
+        self.assertEqual(query.results.call_count, 2)
+
+    def test_query_networks_keeps_tenant_filter(self):
+        query = self.lswitch.return_value.query.return_value
+        query.results.return_value = {"results": [test.switch("a", "t2")]}
+        tags = {"tag": "t2", "tag_scope": "os_tid"}
+        self.blue.query_networks("t1", tags=tags)
+        query.tags.assert_called_once_with(["t2"])
+        query.tagscopes.assert_called_once_with(["os_tid"])
+        self.assertFalse(self.blue.check_tenant("a", "t1"))
+
+    def test_delete_network_drops_entry(self):
+        self.lswitch.return_value.create.return_value = \
+            test.switch("net", "t1")
+        self.blue.create_network("t1", "name")
+        self.blue.delete_network("net")
+        query = self.lswitch.return_value.query.return_value
+        query.results.return_value = {"results": [test.switch("net", "t1")]}
+        self.blue.check_tenant("net", "t1")
+        self.assertEqual(query.results.call_count, 1)
+
+    def test_options_from_config(self):
+        b = test.make_blue("OWNERSHIP_CACHE_TTL = 5\nOWNERSHIP_CACHE_SIZE = 2")
+        self.assertEqual(b.ownership.ttl, 5)
+        self.assertEqual(b.ownership.max_entries, 2)
+
+    def test_cache_bounded(self):
+        self.blue.ownership.max_entries = 2
+        for net_id in ["a", "b", "c"]:
+            self.blue.ownership.set(net_id, ["t1"])
+        self.assertEqual(len(self.blue.ownership), 2)
+        self.assertEqual(self.blue.ownership.get("a"), None)
+
+    def test_cache_expires(self):
+        self.blue.ownership.set("a", ["t1"])
+        with mock.patch("time.time", return_value=2 ** 40):
+            self.assertEqual(self.blue.ownership.get("a"), None)
+
+
+class TestTrustController(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue("TRUST_CONTROLLER = true")
+        self.lswitch = self.blue.clients[0].lswitch
+        self.lport = self.blue.clients[0].lswitch_port.return_value
+        self.probe = self.lswitch.return_value.query.return_value
+
+    def test_option_parsed(self):
+        self.assertTrue(self.blue.trust_controller)
+        self.assertFalse(test.make_blue().trust_controller)
+
+    def test_happy_path_skips_probe(self):
+        self.lport.status.return_value = {"link_status_up": True}
+        self.assertEqual(self.blue.get_port_link_status("net", "port"), "UP")
+        self.blue.delete_port("net", "port")
+        self.assertFalse(self.probe.results.called)
+
+    def test_missing_port(self):
+        self.lport.delete.side_effect = blue.aiclib.nvp.ResourceNotFound()
+        self.assertRaises(blue.PortNotFound, self.blue.delete_port,
+                          "net", "port")
+        self.assertEqual(self.probe.results.call_count, 1)
+
+    def test_missing_network(self):
+        self.lport.status.side_effect = blue.aiclib.nvp.ResourceNotFound()
+        self.probe.results.return_value = {"results": []}
+        self.assertRaises(blue.NetworkNotFound, self.blue.get_port_status,
+                          "net", "port")
+
+    def test_untrusted_probes_first(self):
+        self.blue.trust_controller = False
+        self.probe.results.return_value = {"results": []}
+        self.assertRaises(blue.NetworkNotFound, self.blue.delete_port,
+                          "net", "port")
+        self.assertFalse(self.lport.delete.called)
+
+
+class TestBulkPortDelete(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue()
+        self.lswitch = self.blue.clients[0].lswitch
+        lport = self.blue.clients[0].lswitch_port.return_value
+        query = lport.query.return_value
+        query.results.return_value = {"results": [{"uuid": "p%d" % i}
+                                                  for i in range(20)]}
+        # mocks create their children and count their calls racily, so
+        # what the workers do is configured up front and counted here
+        self.deletes = []
+        lport.delete.side_effect = lambda: self.deletes.append("lport")
+        self.lswitch.return_value.delete.side_effect = \
+            lambda: self.deletes.append("lswitch")
+        probe = self.lswitch.return_value.query.return_value
+        probe.results.return_value = {"results": [{"uuid": "net"}]}
+
+    def test_delete_all_ports_report(self):
+        ports = self.blue.clients[0].lswitch_port.return_value
+        errors = {"p3": blue.aiclib.nvp.ResourceNotFound(),
+                  "p7": blue.aiclib.nvp.NVPException()}
+
+        def lswitch_port(net_id, port_id=None):
+            if port_id in errors:
+                port = mock.MagicMock()
+                port.delete.side_effect = errors[port_id]
+                return port
+            return ports
+
+        self.blue.clients[0].lswitch_port.side_effect = lswitch_port
+        report = self.blue.delete_all_ports("net", max_workers=4)
+        self.assertEqual(len(report["deleted"]), 18)
+        self.assertEqual(report["not_found"], ["p3"])
+        self.assertEqual(report["failed"].keys(), ["p7"])
+        probe = self.lswitch.return_value.query.return_value
+        self.assertEqual(probe.results.call_count, 1)
+        probe.fields.assert_called_once_with(["uuid"])
+
+    def test_delete_networks_with_ports(self):
+        self.blue.delete_networks(["a", "b"], delete_ports=True)
+        self.assertEqual(self.deletes.count("lswitch"), 2)
+        self.assertEqual(self.deletes.count("lport"), 40)
+
+    def test_network_with_failed_port_kept(self):
+        ports = self.blue.clients[0].lswitch_port.return_value
+
+        def lswitch_port(net_id, port_id=None):
+            if (net_id, port_id) == ("b", "p5"):
+                port = mock.MagicMock(spec=blue.aiclib.nvp.nvpentity.
+                                      LSwitchPort)
+                port.delete.side_effect = blue.aiclib.nvp.NVPException()
+                return port
+            return ports
+
+        self.blue.clients[0].lswitch_port.side_effect = lswitch_port
+        with mock.patch.object(self.blue, "delete_all_ports",
+                               wraps=self.blue.delete_all_ports) as wrapped:
+            report = self.blue.delete_networks(["a", "b"], delete_ports=True)
+        self.assertEqual(report["deleted"], ["a"])
+        self.assertTrue(isinstance(report["failed"]["b"],
+                                   blue.aiclib.nvp.NVPException))
+        self.assertTrue(mock.call("a") in self.lswitch.call_args_list)
+        self.assertFalse(mock.call("b") in self.lswitch.call_args_list)
+        wrapped.assert_any_call("b", max_workers=1)
+
+
+class TestPool(test.TestCase):
+    def test_workers_inherit_locals(self):
+        local = blue.pool.InheritedLocal()
+        local.value = "caller"
+        outcomes = blue.pool.run(lambda i: local.value, range(4), 4)
+        self.assertEqual([o[1] for o in outcomes], ["caller"] * 4)
+
+    def test_run_keeps_order(self):
+        def square(i):
+            if i == 5:
+                raise ValueError(i)
+            return i * i
+        outcomes = blue.pool.run(square, range(10), max_workers=3)
+        self.assertEqual([o[0] for o in outcomes], range(10))
+        self.assertEqual(outcomes[4][1], 16)
+        self.assertTrue(isinstance(outcomes[5][2], ValueError))
+
+
+class TestBulkNetworkDelete(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue()
+
+    def test_delete_networks_report(self):
+        errors = {"n1": blue.aiclib.nvp.ResourceNotFound(),
+                  "n2": blue.aiclib.nvp.Conflict()}
+
+        def lswitch(net_id=None):
+            switch = mock.MagicMock()
+            if net_id in errors:
+                switch.delete.side_effect = errors[net_id]
+            return switch
+
+        self.blue.clients[0].lswitch.side_effect = lswitch
+        net_ids = ["n%d" % i for i in range(10)]
+        report = self.blue.delete_networks(net_ids, max_workers=3)
+        self.assertEqual(len(report["deleted"]), 8)
+        self.assertEqual(report["not_found"], ["n1"])
+        self.assertEqual(report["failed"].keys(), ["n2"])
+
+    def test_delete_network_raises(self):
+        switch = self.blue.clients[0].lswitch.return_value
+        switch.delete.side_effect = blue.aiclib.nvp.ResourceNotFound()
+        self.assertRaises(blue.aiclib.nvp.ResourceNotFound,
+                          self.blue.delete_network, "net")
+
+
+class TestConnectionPool(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue()
+        self.blue.clients.clear()
+
+    @mock.patch("aiclib.nvp.Connection")
+    def test_connection_uses_config(self, connection):
+        self.blue.connection
+        args, kwargs = connection.call_args
+        self.assertEqual(args, ("https://nvp1",))
+        self.assertEqual(kwargs["username"], "admin")
+        self.assertEqual(kwargs["password"], "password")
+        self.assertEqual(kwargs["retries"], 2)
+        self.assertEqual(kwargs["timeout"].total, 30)
+        self.assertEqual(kwargs["timeout"].connect_timeout, 10)
+        self.assertTrue(kwargs["poolmanager"] is self.blue.http_pools[0])
+
+    @mock.patch("aiclib.nvp.Connection")
+    def test_client_kept_per_controller(self, connection):
+        first, second = self.blue.connections
+        client = self.blue.connection
+        self.blue.conn = second
+        self.blue.connection
+        self.blue.conn = first
+        self.assertTrue(self.blue.connection is client)
+        self.assertEqual(connection.call_count, 2)
+
+    @mock.patch("aiclib.nvp.Connection")
+    def test_pool_kept_per_controller(self, connection):
+        first = self.blue._http_pool(self.blue.connections[0])
+        second = self.blue._http_pool(self.blue.connections[1])
+        self.assertFalse(first is second)
+        self.assertTrue(first is
+                        self.blue._http_pool(self.blue.connections[0]))
+        self.assertEqual(first.pool_kw["maxsize"],
+                         blue.API_REQUEST_POOL_SIZE)
+
+    def test_pool_takes_aiclib_options(self):
+        manager = self.blue._http_pool(self.blue.connections[0])
+        http_pool = manager.connection_from_url("https://nvp1", retries=3,
+                                                socket_options=[])
+        self.assertEqual(http_pool.pool.maxsize, blue.API_REQUEST_POOL_SIZE)
+        self.assertEqual(http_pool.retries, 3)
+        self.assertTrue(http_pool is
+                        manager.connection_from_url("https://nvp1"))
+
+
+class TestControllerEndpoint(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue()
+        self.first, self.second = self.blue.connections
+
+    def test_parsed_once(self):
+        self.assertEqual(self.first.conn_id, 0)
+        self.assertEqual(self.first.uri, "https://nvp1")
+        self.assertEqual(self.first.retries, 2)
+        self.assertEqual(self.first.timeout.total, 30)
+        self.assertEqual(self.second.default_tz, "tz")
+
+    def test_plain_http_port(self):
+        endpoint = blue.ControllerEndpoint(5, "nvp3", 8080, "admin",
+                                           "password", "tz")
+        self.assertEqual(endpoint.uri, "http://nvp3:8080")
+        self.assertEqual(endpoint.retries, blue.DEFAULT_RETRIES)
+
+    def test_no_instance_dict(self):
+        self.assertFalse(hasattr(self.first, "__dict__"))
+        self.assertRaises(AttributeError, setattr, self.first, "extra", 1)
+
+    def test_item_access(self):
+        self.assertEqual(self.first["ip"], "nvp1")
+        self.assertEqual(self.first.get("missing", 7), 7)
+        self.assertRaises(KeyError, lambda: self.first["_lock"])
+        self.assertEqual(self.first.to_dict()["port"], "443")
+
+    def test_requests_counted(self):
+        self.blue.get_network("net1", fresh=True)
+        self.assertEqual(self.first.requests, 1)
+        self.assertEqual(self.first.errors, 0)
+
+
+class TestControllerSelection(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue()
+        self.clients = {"nvp1": self.blue.clients[0],
+                        "nvp2": self.blue.clients[1]}
+        self.first, self.second = self.blue.connections
+
+    def test_failover_retries_on_sibling(self):
+        read = self.clients["nvp1"].lswitch.return_value.read
+        read.side_effect = blue.aiclib.nvp.ServiceUnavailable()
+        other = self.clients["nvp2"].lswitch.return_value.read
+        other.return_value = test.switch("net", "t1")
+        self.assertEqual(self.blue.get_network("net")["uuid"], "net")
+        self.assertTrue(self.blue.conn is self.second)
+        self.assertEqual(self.first.errors, 1)
+        stats = self.blue.controller_stats()
+        self.assertFalse(stats[0]["healthy"])
+        self.assertTrue(stats[1]["healthy"])
+
+    def test_failover_gives_up_after_retries(self):
+        for client in self.clients.values():
+            client.lswitch.return_value.read.side_effect = \
+                blue.aiclib.nvp.ServiceUnavailable()
+        self.assertRaises(blue.aiclib.nvp.ServiceUnavailable,
+                          self.blue.get_network, "net")
+
+    def test_not_found_is_not_retried(self):
+        read = self.clients["nvp1"].lswitch.return_value.read
+        read.side_effect = blue.aiclib.nvp.ResourceNotFound()
+        self.assertRaises(blue.aiclib.nvp.ResourceNotFound,
+                          self.blue.get_network, "net")
+        self.assertFalse(self.clients["nvp2"].lswitch.called)
+        self.assertTrue(self.blue.controller_stats()[0]["healthy"])
+
+    def test_create_not_retried_once_sent(self):
+        create = self.clients["nvp1"].lswitch_port.return_value.create
+        create.side_effect = blue.aiclib.nvp.RequestTimeout()
+        self.assertRaises(blue.aiclib.nvp.RequestTimeout,
+                          self.blue.create_enabled_port, "t1", "net")
+        self.assertFalse(self.clients["nvp2"].lswitch_port.called)
+
+    def test_create_retried_when_not_connected(self):
+        create = self.clients["nvp1"].lswitch_port.return_value.create
+        create.side_effect = blue.urllib3.exceptions.MaxRetryError(
+                None, "/ws.v1/login",
+                blue.urllib3.exceptions.NewConnectionError(None, "refused"))
+        other = self.clients["nvp2"].lswitch_port.return_value.create
+        other.return_value = {"uuid": "port"}
+        self.assertEqual(self.blue.create_enabled_port("t1", "net"),
+                         {"uuid": "port"})
+
+    def test_login_failure_not_retried(self):
+        read = self.clients["nvp1"].lswitch.return_value.read
+        read.side_effect = IOError("401", "Unauthorized")
+        self.assertRaises(IOError, self.blue.get_network, "net")
+        self.assertFalse(self.clients["nvp2"].lswitch.called)
+
+    def test_prefers_faster_controller(self):
+        self.blue.selector.record_success(self.first, 1.0)
+        self.blue.selector.record_success(self.second, 0.1)
+        self.assertTrue(self.blue._get_connection() is self.second)
+
+    def test_failed_controller_recovers(self):
+        self.blue.selector.record_success(self.first, 0.1)
+        self.blue.selector.record_success(self.second, 1.0)
+        self.blue.selector.record_failure(self.first)
+        self.assertTrue(self.blue._get_connection() is self.second)
+        later = time.time() + selector.DEFAULT_RETRY_AFTER + 1
+        with mock.patch("time.time", return_value=later):
+            self.assertTrue(self.blue.controller_stats()[0]["healthy"])
+            self.assertTrue(self.blue._get_connection() is self.first)
+
+    def test_keeps_controller_within_margin(self):
+        self.blue.selector.record_success(self.first, 0.12)
+        self.blue.selector.record_success(self.second, 0.1)
+        self.assertTrue(self.blue._get_connection() is self.first)
+
+    def test_probe_marks_health(self):
+        def probe(conn):
+            if conn is self.first:
+                raise IOError("down")
+        self.blue.selector.probe_all(probe)
+        self.assertTrue(self.blue._get_connection() is self.second)
+
+    def test_probe_reuses_client(self):
+        zone = self.clients["nvp1"].zone
+        zone.return_value.read.side_effect = blue.aiclib.nvp.ResourceNotFound()
+        self.blue.selector.probe_all(self.blue._probe)
+        zone.assert_called_once_with("tz")
+        self.assertTrue(self.blue.controller_stats()[0]["healthy"])
+        self.assertFalse(self.clients["nvp1"].nvp_function.called)
+
+
+class TestCircuitBreaker(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue("BREAKER_THRESHOLD = 2\n"
+                                   "BREAKER_COOLDOWN = 60")
+        self.clients = {"nvp1": self.blue.clients[0],
+                        "nvp2": self.blue.clients[1]}
+
+    def test_fails_fast_once_all_open(self):
+        for conn in self.blue.connections:
+            self.blue._breaker(conn).record_failure()
+            self.blue._breaker(conn).record_failure()
+        self.assertRaises(blue.ControllerUnavailable,
+                          self.blue.get_network, "net")
+        self.assertFalse(self.clients["nvp1"].lswitch.called)
+        self.assertFalse(self.clients["nvp2"].lswitch.called)
+
+    def test_answer_is_not_a_failure(self):
+        read = self.clients["nvp1"].lswitch.return_value.read
+        read.side_effect = blue.aiclib.nvp.Conflict()
+        self.assertRaises(blue.aiclib.nvp.Conflict, self.blue.get_network,
+                          "net")
+        self.assertEqual(self.blue.breaker_states()[0]["failures"], 0)
+
+    def test_open_controller_is_skipped(self):
+        first, second = self.blue.connections
+        other = self.clients["nvp2"].lswitch.return_value.read
+        other.return_value = test.switch("net", "t1")
+        self.blue.selector.record_success(first, 0.01)
+        self.blue.selector.record_success(second, 1.0)
+        self.blue._breaker(first).record_failure()
+        self.blue._breaker(first).record_failure()
+        self.blue.get_network("net")
+        self.assertFalse(self.clients["nvp1"].lswitch.return_value.read.called)
+        self.assertEqual(other.call_count, 1)
+
+    def test_half_open_trial(self):
+        breaker = self.blue._breaker(self.blue.connections[0])
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertFalse(breaker.acquire())
+        breaker.opened_at -= 60
+        self.assertTrue(breaker.acquire())
+        self.assertEqual(breaker.state, "half_open")
+        self.assertFalse(breaker.acquire())
+        breaker.record_success()
+        self.assertEqual(breaker.state, "closed")
+
+
+class TestPagination(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue("PAGE_SIZE = 2")
+        self.pages = {None: {"results": [{"uuid": "a"}, {"uuid": "b"}],
+                             "page_cursor": "c1"},
+                      "c1": {"results": [{"uuid": "c"}, {"uuid": "d"}],
+                             "page_cursor": "c2"},
+                      "c2": {"results": [{"uuid": "e"}]}}
+
+    def _query(self, resource):
+        query = mock.MagicMock()
+        query.query = {}
+        query.results.side_effect = \
+            lambda: self.pages[query.query.get('_page_cursor')]
+        resource.return_value.query.return_value = query
+        return query
+
+    def test_iter_ports_streams_pages(self):
+        query = self._query(self.blue.clients[0].lswitch_port)
+        ports = self.blue.iter_ports("net")
+        self.assertEqual(ports.next()["uuid"], "a")
+        self.assertEqual(query.results.call_count, 1)
+        self.assertEqual([p["uuid"] for p in ports], ["b", "c", "d", "e"])
+        self.assertEqual(query.results.call_count, 3)
+        query.length.assert_called_with(2)
+
+    def test_iter_networks(self):
+        self._query(self.blue.clients[0].lswitch)
+        uuids = [s["uuid"] for s in self.blue.iter_networks("t1",
+                                                            page_size=5)]
+        self.assertEqual(uuids, ["a", "b", "c", "d", "e"])
+
+
+class TestPortWithStatus(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue()
+        self.client = self.blue.clients[0]
+        lport = self.client.lswitch_port.return_value
+        lport.create.return_value = {"uuid": "port"}
+        lport.update.return_value = {"uuid": "port"}
+        lport.status.return_value = {"link_status_up": False}
+
+    def test_create_port_with_status(self):
+        port, status = self.blue.create_port_with_status("t1", "net", True)
+        self.assertEqual(port["uuid"], "port")
+        self.assertEqual(status, "DOWN")
+        self.assertFalse(self.client.lswitch.called)
+
+    def test_update_port_with_status(self):
+        port, status = self.blue.update_port_with_status("net", "port",
+                                                         state=True)
+        self.assertEqual(status, "DOWN")
+        self.assertFalse(self.client.lswitch.called)
+
+    def test_status_port_vanished(self):
+        lport = self.client.lswitch_port.return_value
+        lport.status.side_effect = blue.aiclib.nvp.ResourceNotFound()
+        self.assertRaises(blue.PortNotFound,
+                          self.blue.create_port_with_status,
+                          "t1", "net", True)
+
+    def test_create_and_plug(self):
+        port, status = self.blue.create_and_plug_port("t1", "net", "vif",
+                                                      True)
+        lport = self.client.lswitch_port.return_value
+        self.assertEqual((port["uuid"], status), ("port", "DOWN"))
+        lport.attachment_vif.assert_called_once_with("vif")
+        self.assertFalse(lport.delete.called)
+        self.assertFalse(self.client.lswitch.called)
+        # the status is the one of the plugged port
+        calls = [c[0] for c in lport.mock_calls]
+        self.assertTrue(calls.index("status") > calls.index("attachment_vif"))
+
+    def test_failed_plug_deletes_port(self):
+        lport = self.client.lswitch_port.return_value
+        lport.attachment_vif.side_effect = blue.aiclib.nvp.Conflict()
+        self.assertRaises(blue.aiclib.nvp.Conflict,
+                          self.blue.create_and_plug_port,
+                          "t1", "net", "vif", True)
+        self.assertEqual(lport.delete.call_count, 1)
+
+    def test_failed_status_read_deletes_port(self):
+        lport = self.client.lswitch_port.return_value
+        lport.status.side_effect = blue.aiclib.nvp.NVPException()
+        self.assertRaises(blue.aiclib.nvp.NVPException,
+                          self.blue.create_and_plug_port,
+                          "t1", "net", "vif", True)
+        lport.attachment_vif.assert_called_once_with("vif")
+        self.assertEqual(lport.delete.call_count, 1)
+
+
+class TestObjectCache(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue("OBJECT_CACHE_SIZE = 100")
+        self.client = self.blue.clients[0]
+        self.lswitch = self.client.lswitch.return_value
+        self.lport = self.client.lswitch_port.return_value
+
+    def test_disabled_by_default(self):
+        b = test.make_blue()
+        b.clients[0].lswitch.return_value.read.return_value = \
+            test.switch("net", "t1")
+        b.get_network("net")
+        b.get_network("net")
+        self.assertEqual(b.clients[0].lswitch.return_value.read.call_count, 2)
+
+    def test_get_network_cached(self):
+        self.lswitch.read.return_value = test.switch("net", "t1")
+        self.assertEqual(self.blue.get_network("net")["uuid"], "net")
+        self.blue.get_network("net")["uuid"] = "changed"
+        self.assertEqual(self.blue.get_network("net")["uuid"], "net")
+        self.assertEqual(self.lswitch.read.call_count, 1)
+        self.blue.get_network("net", fresh=True)
+        self.assertEqual(self.lswitch.read.call_count, 2)
+
+    def test_create_writes_through(self):
+        self.lport.create.return_value = {"uuid": "port"}
+        self.blue.create_enabled_port("t1", "net")
+        self.assertEqual(self.blue.get_port("net", "port")["uuid"], "port")
+        self.assertFalse(self.lport.read.called)
+
+    def test_mutation_invalidates(self):
+        self.lport.read.return_value = {"uuid": "port"}
+        self.blue.get_port("net", "port")
+        self.blue.plug_vif_interface("net", "port", "vif")
+        self.blue.get_port("net", "port")
+        self.assertEqual(self.lport.read.call_count, 2)
+        self.blue.delete_port("net", "port")
+        self.blue.get_port("net", "port")
+        self.assertEqual(self.lport.read.call_count, 3)
+
+    def test_read_overlapping_change_not_cached(self):
+        def read():
+            self.blue.plug_vif_interface("net", "port", "vif")
+            return {"uuid": "port", "stale": True}
+        self.lport.read.side_effect = read
+        self.blue.get_port("net", "port")
+        self.lport.read.side_effect = None
+        self.lport.read.return_value = {"uuid": "port"}
+        self.assertFalse("stale" in self.blue.get_port("net", "port"))
+
+    def test_failed_mutation_invalidates(self):
+        self.lport.read.return_value = {"uuid": "port"}
+        self.blue.get_port("net", "port")
+        self.lport.attachment_vif.side_effect = blue.aiclib.nvp.Conflict()
+        self.assertRaises(blue.aiclib.nvp.Conflict,
+                          self.blue.plug_vif_interface, "net", "port", "vif")
+        self.blue.get_port("net", "port")
+        self.assertEqual(self.lport.read.call_count, 2)
+
+    def test_delete_network_drops_ports(self):
+        self.lport.read.return_value = {"uuid": "port"}
+        self.blue.get_port("net", "port", relations="LogicalPortStatus")
+        self.blue.delete_network("net")
+        self.assertEqual(len(self.blue.objects), 0)
+
+    def test_relations_cached_apart(self):
+        self.lport.read.return_value = {"uuid": "port"}
+        query = self.lport.query.return_value
+        query.results.return_value = {"results": [{"uuid": "port"}]}
+        self.blue.get_port("net", "port")
+        self.blue.get_port("net", "port", relations="LogicalPortStatus")
+        self.blue.get_port("net", "port", relations="LogicalPortStatus")
+        self.assertEqual(self.lport.read.call_count, 1)
+        query.relations.assert_called_once_with("LogicalPortStatus")
+
+    def test_bounded_by_bytes(self):
+        objects = self.blue.objects
+        objects.max_bytes = 100
+        objects.set({"uuid": "a", "pad": "x" * 50}, "lswitch", "a")
+        objects.set({"uuid": "b", "pad": "x" * 50}, "lswitch", "b")
+        self.assertEqual(len(objects), 1)
+        self.assertTrue(objects.bytes <= 100)
+        self.assertEqual(objects.get("lswitch", "b")["uuid"], "b")
+
+
+class TestSparseFields(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue("OBJECT_CACHE_SIZE = 100")
+        self.client = self.blue.clients[0]
+        self.lswitch = self.client.lswitch.return_value
+        self.query = self.lswitch.query.return_value
+
+    def test_get_network_fields(self):
+        self.query.results.return_value = {"results": [{"uuid": "net"}]}
+        self.assertEqual(self.blue.get_network("net", fields=["uuid"]),
+                         {"uuid": "net"})
+        self.query.uuid.assert_called_once_with("net")
+        self.query.fields.assert_called_once_with(["uuid"])
+        self.assertFalse(self.lswitch.read.called)
+        # partial documents stay out of the object cache
+        self.assertEqual(len(self.blue.objects), 0)
+
+    def test_cut_from_cached_document(self):
+        self.lswitch.read.return_value = test.switch("net", "t1")
+        self.blue.get_network("net")
+        network = self.blue.get_network("net", fields="uuid,tags")
+        self.assertEqual(sorted(network.keys()), ["tags", "uuid"])
+        self.assertFalse(self.query.results.called)
+
+    def test_missing(self):
+        self.query.results.return_value = {"results": []}
+        self.assertRaises(blue.aiclib.nvp.ResourceNotFound,
+                          self.blue.get_network, "net", fields=["uuid"])
+        self.assertFalse(self.blue.check_network_existance("net"))
+
+    def test_get_port_fields(self):
+        query = self.client.lswitch_port.return_value.query.return_value
+        query.results.return_value = {"results": [{"uuid": "port"}]}
+        port = self.blue.get_port("net", "port", fields=["uuid"],
+                                  relations="LogicalPortAttachment")
+        self.assertEqual(port, {"uuid": "port"})
+        query.uuid.assert_called_once_with("port")
+        query.relations.assert_called_once_with("LogicalPortAttachment")
+        self.assertFalse(self.client.lswitch_port.return_value.read.called)
+
+
+class TestCoalescing(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue()
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.read = self.blue.clients[0].lswitch.return_value.read
+
+    def _slow(self, result=None, error=None):
+        def read():
+            self.started.set()
+            self.release.wait(5)
+            if error is not None:
+                raise error
+            return result
+        self.read.side_effect = read
+
+    def _run(self, count):
+        outcomes = []
+
+        def call():
+            try:
+                outcomes.append(self.blue.get_network("net"))
+            except Exception, e:
+                outcomes.append(e)
+        threads = [threading.Thread(target=call) for i in range(count)]
+        threads[0].start()
+        self.started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        while self.blue.coalescing_stats()["calls"] < count:
+            time.sleep(0.001)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_identical_reads_share_request(self):
+        self._slow(result=test.switch("net", "t1"))
+        outcomes = self._run(5)
+        self.assertEqual(self.read.call_count, 1)
+        self.assertEqual([o["uuid"] for o in outcomes], ["net"] * 5)
+        self.assertEqual(len(set(id(o) for o in outcomes)), 5)
+        stats = self.blue.coalescing_stats()
+        self.assertEqual(stats["coalesced"], 4)
+        self.assertEqual(stats["in_flight"], 0)
+
+    def test_error_shared(self):
+        self._slow(error=blue.aiclib.nvp.ResourceNotFound())
+        outcomes = self._run(3)
+        self.assertEqual(self.read.call_count, 1)
+        self.assertTrue(all(isinstance(o, blue.aiclib.nvp.ResourceNotFound)
+                            for o in outcomes))
+
+    def test_base_exception_lands_flight(self):
+        def interrupted():
+            raise KeyboardInterrupt()
+        self.assertRaises(KeyboardInterrupt, self.blue.flights.do, "key",
+                          interrupted)
+        self.assertEqual(self.blue.coalescing_stats()["in_flight"], 0)
+
+    def test_uncopyable_result_releases_followers(self):
+        self._slow(result=threading.Lock())
+        outcomes = self._run(3)
+        self.assertEqual(len(outcomes), 3)
+        self.assertEqual(self.blue.coalescing_stats()["in_flight"], 0)
+
+    def _start(self, **kwargs):
+        thread = threading.Thread(target=self.blue.get_network,
+                                  args=("net",), kwargs=kwargs)
+        thread.start()
+        return thread
+
+    def test_follower_keeps_leader_stamp(self):
+        self.blue = test.make_blue("OBJECT_CACHE_SIZE = 100")
+        self.read = self.blue.clients[0].lswitch.return_value.read
+        self._slow(result={"uuid": "net", "state": "OLD"})
+        leader = self._start()
+        self.started.wait(5)
+        self.blue.objects.invalidate("lswitch", "net")
+        follower = self._start()
+        while self.blue.coalescing_stats()["coalesced"] < 1:
+            time.sleep(0.001)
+        self.release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(self.read.call_count, 1)
+        self.assertEqual(self.blue.objects.get("lswitch", "net"), None)
+
+    def test_fresh_read_not_coalesced(self):
+        reads = []
+
+        def read():
+            reads.append(1)
+            self.started.set()
+            self.release.wait(5)
+            return {"uuid": "net"}
+        self.read.side_effect = read
+        threads = [self._start()]
+        self.started.wait(5)
+        threads.append(self._start(fresh=True))
+        deadline = time.time() + 5
+        while len(reads) < 2 and time.time() < deadline:
+            time.sleep(0.001)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(reads), 2)
+
+    def test_disabled(self):
+        b = test.make_blue("COALESCE_READS = false")
+        self.assertFalse(b.flights.enabled)
+
+
+class TestStartup(test.TestCase):
+    def test_passwords_not_logged(self):
+        output = test.make_blue().output_config()
+        self.assertTrue("nvp1" in output)
+        self.assertFalse("'password': 'password'" in output)
+
+    def test_handler_installed_once(self):
+        handlers = len(blue.LOG.handlers)
+        blue._setup_logging()
+        test.make_blue()
+        self.assertEqual(len(blue.LOG.handlers), handlers)
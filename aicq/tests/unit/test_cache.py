@@ -0,0 +1,184 @@
+import time
+
+import mock
+
+from aicq import blue
+from aicq import cache
+from aicq import test
+
+
+class TestLRUDict(test.TestCase):
+    def test_order(self):
+        entries = cache._LRUDict()
+        for key in "abcd":
+            entries[key] = key.upper()
+        entries["b"] = "B2"
+        del entries["c"]
+        self.assertEqual(list(entries), ["a", "b", "d"])
+        self.assertEqual(entries.pop("b"), "B2")
+        entries["b"] = "B3"
+        self.assertEqual(entries.popitem(last=False), ("a", "A"))
+        self.assertEqual(entries.popitem(), ("b", "B3"))
+        self.assertEqual(entries.pop("x", None), None)
+        self.assertRaises(KeyError, entries.pop, "x")
+        entries.clear()
+        self.assertEqual(list(entries), [])
+        self.assertRaises(KeyError, entries.popitem)
+
+
+class BackendTests(object):
+    def test_get_set_delete(self):
+        self.backend.set("a", {"uuid": "a"}, 10)
+        self.assertEqual(self.backend.get("a"), {"uuid": "a"})
+        self.backend.delete("a")
+        self.assertEqual(self.backend.get("a"), None)
+
+    def test_get_multi(self):
+        self.backend.set("a", 1, 10)
+        self.backend.set("b", 2, 10)
+        self.assertEqual(self.backend.get_multi(["a", "b", "c"]),
+                         {"a": 1, "b": 2})
+
+    def test_set_multi(self):
+        self.backend.set_multi({"a": 1, "b": [2]}, 10)
+        self.assertEqual(self.backend.get_multi(["a", "b"]),
+                         {"a": 1, "b": [2]})
+
+    def test_add_and_incr(self):
+        self.assertEqual(self.backend.incr("n"), None)
+        self.assertTrue(self.backend.add("n", 5))
+        self.assertFalse(self.backend.add("n", 7))
+        self.assertEqual(self.backend.incr("n"), 6)
+        self.assertEqual(self.backend.get("n"), 6)
+
+
+class TestMemoryBackend(test.TestCase, BackendTests):
+    def setUp(self):
+        self.backend = cache.MemoryBackend()
+
+    def test_expires(self):
+        self.backend.set("a", 1, 10)
+        with mock.patch("time.time", return_value=2 ** 40):
+            self.assertEqual(self.backend.get("a"), None)
+
+    def test_bounded(self):
+        self.backend.max_entries = 2
+        for key in ["a", "b", "c"]:
+            self.backend.set(key, 1, 10)
+        self.assertEqual(len(self.backend), 2)
+        self.assertEqual(self.backend.get("a"), None)
+
+
+class TestMemcachedBackend(test.TestCase, BackendTests):
+    def setUp(self):
+        self.server = test.FakeMemcached()
+        self.backend = cache.MemcachedBackend([self.server.address])
+
+    def tearDown(self):
+        self.backend.close()
+        self.server.stop()
+
+    def test_long_keys_hashed(self):
+        key = "x" * 300
+        self.backend.set(key, 1, 10)
+        self.assertEqual(self.backend.get(key), 1)
+        self.assertTrue(all(len(k) <= cache.MAX_KEY_LENGTH
+                            for k in self.server.items))
+
+    def test_unreachable_is_a_miss(self):
+        backend = cache.MemcachedBackend(["127.0.0.1:1"], timeout=0.1)
+        backend.set("a", 1, 10)
+        self.assertEqual(backend.get("a"), None)
+        self.assertEqual(backend.incr("a"), None)
+        self.assertEqual(backend.errors, 3)
+
+
+class TestSharedCaches(test.TestCase):
+    """Two Blue instances standing in for two API workers"""
+
+    def setUp(self):
+        self.server = test.FakeMemcached()
+        extra = "OBJECT_CACHE_SIZE = 100\nCACHE_SERVERS = %s" % \
+            self.server.address
+        self.first = test.make_blue(extra)
+        self.second = test.make_blue(extra)
+
+    def tearDown(self):
+        self.first.cache_backend.close()
+        self.second.cache_backend.close()
+        self.server.stop()
+
+    def test_backend_from_config(self):
+        self.assertTrue(isinstance(self.first.cache_backend,
+                                   cache.MemcachedBackend))
+
+    def test_ownership_shared(self):
+        lswitch = self.first.clients[0].lswitch.return_value
+        lswitch.create.return_value = test.switch("net", "t1")
+        self.first.create_network("t1", "name")
+        self.assertTrue(self.second.check_tenant("net", "t1"))
+        self.assertFalse(self.second.clients[0].lswitch.called)
+        self.assertEqual(self.second.ownership_cache_stats()["shared_hits"],
+                         1)
+
+    def test_listing_owners_written_in_one_batch(self):
+        backend = self.first.cache_backend
+        query = self.first.clients[0].lswitch.return_value.query
+        query.return_value.results.return_value = {
+            "results": [test.switch("net%d" % i, "t1") for i in range(20)]}
+        with mock.patch.object(backend, "_call",
+                               wraps=backend._call) as call:
+            self.first.query_networks("t1")
+        self.assertEqual(call.call_count, 1)
+        self.assertEqual(self.second.ownership.get("net7"), (["t1"], True))
+
+    def test_ownership_delete_seen_after_local_ttl(self):
+        lswitch = self.first.clients[0].lswitch.return_value
+        lswitch.create.return_value = test.switch("net", "t1")
+        self.first.create_network("t1", "name")
+        self.assertTrue(self.second.check_tenant("net", "t1"))
+        self.first.delete_network("net")
+        query = self.second.clients[0].lswitch.return_value.query
+        query.return_value.results.return_value = {"results": []}
+        # the local entry still vouches for the owner until it expires
+        self.assertTrue(self.second.check_tenant("net", "t1"))
+        later = time.time() + self.second.ownership.local_ttl + 1
+        with mock.patch("time.time", return_value=later):
+            self.assertRaises(blue.aiclib.nvp.ResourceNotFound,
+                              self.second.check_tenant, "net", "t1")
+
+    def test_invalidation_shared(self):
+        lport = self.first.clients[0].lswitch_port.return_value
+        lport.create.return_value = {"uuid": "port"}
+        self.first.create_enabled_port("t1", "net")
+        second_lport = self.second.clients[0].lswitch_port.return_value
+        second_lport.read.return_value = {"uuid": "port", "read": True}
+        self.assertFalse("read" in self.second.get_port("net", "port"))
+        self.first.plug_vif_interface("net", "port", "vif")
+        self.assertTrue("read" in self.second.get_port("net", "port"))
+        self.second.delete_network("net")
+        self.first.get_port("net", "port")
+        self.assertTrue(lport.read.called)
+
+    def test_read_overlapping_change_not_shared(self):
+        second_lport = self.second.clients[0].lswitch_port.return_value
+
+        def read():
+            self.first.plug_vif_interface("net", "port", "vif")
+            return {"uuid": "port", "stale": True}
+        second_lport.read.side_effect = read
+        self.second.get_port("net", "port")
+        lport = self.first.clients[0].lswitch_port.return_value
+        lport.read.return_value = {"uuid": "port"}
+        self.assertFalse("stale" in self.first.get_port("net", "port"))
+
+    def test_memory_backend(self):
+        backend = cache.MemoryBackend()
+        b = test.make_blue("OBJECT_CACHE_SIZE = 100")
+        b.ownership.shared = b.objects.shared = backend
+        b.clients[0].lswitch.return_value.read.return_value = \
+            test.switch("net", "t1")
+        b.get_network("net")
+        b.get_network("net")
+        self.assertEqual(b.clients[0].lswitch.return_value.read.call_count, 1)
+        self.assertEqual(b.ownership.get("net"), (["t1"], True))
@@ -0,0 +1,190 @@
+import os
+import time
+
+import aiclib
+
+from aicq import blue
+from aicq import fake_nvp
+from aicq import test
+
+
+class TestFakeNvp(test.TestCase):
+    def setUp(self):
+        self.nvp = fake_nvp.FakeNvp().start()
+        self.client = aiclib.nvp.Connection(
+                "http://127.0.0.1:%d" % self.nvp.port, retries=0)
+
+    def tearDown(self):
+        self.client.conn.close()
+        self.nvp.stop()
+
+    def test_lswitch_crud(self):
+        switch = self.client.lswitch()
+        switch.display_name("net")
+        switch.tags([{"tag": "t1", "scope": "os_tid"}])
+        net_id = switch.create()["uuid"]
+        self.assertEqual(self.client.lswitch(net_id).read()["display_name"],
+                         "net")
+        self.client.lswitch(net_id).delete()
+        self.assertRaises(aiclib.nvp.ResourceNotFound,
+                          self.client.lswitch(net_id).read)
+
+    def test_query_tags_fields_and_pages(self):
+        for tenant in ("t1", "t1", "t2"):
+            self.nvp.store.add_switch(
+                {"tags": [{"tag": tenant, "scope": "os_tid"}]})
+        query = self.client.lswitch().query()
+        query.fields(["uuid"])
+        query.tags(["t1"]).tagscopes(["os_tid"])
+        query.length(1)
+        page = query.results()
+        self.assertEqual(page["result_count"], 2)
+        self.assertEqual(page["results"][0].keys(), ["uuid"])
+        query.query["_page_cursor"] = page["page_cursor"]
+        page = query.results()
+        self.assertEqual(len(page["results"]), 1)
+        self.assertFalse("page_cursor" in page)
+
+    def test_lport_status(self):
+        net_id = self.nvp.store.add_switch({})["uuid"]
+        port_id = self.client.lswitch_port(net_id).create()["uuid"]
+        status = self.client.lswitch_port(net_id, port_id).status()
+        self.assertFalse(status["link_status_up"])
+        self.client.lswitch_port(net_id, port_id).attachment_vif("vif")
+        status = self.client.lswitch_port(net_id, port_id).status()
+        self.assertTrue(status["link_status_up"])
+        self.assertRaises(aiclib.nvp.ResourceNotFound,
+                          self.client.lswitch_port(net_id, "missing").read)
+
+    def test_rejects_unknown_requests(self):
+        net_id = self.nvp.store.add_switch({})["uuid"]
+        port_id = self.client.lswitch_port(net_id).create()["uuid"]
+        query = self.client.lswitch().query()
+        query.query["attachment_vifuuid"] = "=vif"
+        self.assertRaises(aiclib.nvp.NVPException, query.results)
+        lport = self.client.lswitch_port(net_id, port_id)
+        self.assertRaises(aiclib.nvp.NVPException, lport._action, "PUT",
+                          "/ws.v1/lswitch/%s/lport/%s/attachment" %
+                          (net_id, port_id))
+
+    def test_injected_failures(self):
+        self.client.lswitch().query().results()
+        self.nvp.down = True
+        self.assertRaises(aiclib.nvp.ServiceUnavailable,
+                          self.client.lswitch().query().results)
+        self.nvp.down = False
+        self.nvp.failure_rate = 1.0
+        self.nvp.failure_status = 409
+        self.assertRaises(aiclib.nvp.Conflict,
+                          self.client.lswitch().query().results)
+
+
+class TestBlueOverHttp(test.TestCase):
+    """Blue with real aiclib clients, talking to a fake controller"""
+
+    def setUp(self):
+        self.nvp = fake_nvp.FakeNvp().start()
+        path = fake_nvp.write_config([self.nvp])
+        try:
+            self.blue = blue.Blue(path)
+        finally:
+            os.remove(path)
+
+    def tearDown(self):
+        self.blue.selector.stop_probe()
+        self.nvp.stop()
+
+    def test_requests_go_through_controller_pool(self):
+        net_id = self.nvp.store.add_switch(
+                {"display_name": "net",
+                 "tags": [{"tag": "t1", "scope": "os_tid"}]})["uuid"]
+        self.assertEqual(self.blue.get_network(net_id)["display_name"],
+                         "net")
+        self.assertTrue(self.blue.check_tenant(net_id, "t1"))
+        client = self.blue.clients[0]
+        http_pool = self.blue.http_pools[0].pools.values()[0]
+        self.assertTrue(client.conn is http_pool)
+        self.assertEqual(http_pool.pool.maxsize, blue.API_REQUEST_POOL_SIZE)
+
+    def test_query_networks_by_tenant(self):
+        for tenant in ("t1", "t2", "t1"):
+            self.nvp.store.add_switch(
+                    {"tags": [{"tag": tenant, "scope": "os_tid"}]})
+        self.assertEqual(len(list(self.blue.iter_networks("t1"))), 2)
+        tags = {"tag": "t2", "tag_scope": "os_tid"}
+        self.assertEqual(len(list(self.blue.iter_networks(None, tags=tags))),
+                         1)
+
+    def test_create_and_plug_reports_plugged_status(self):
+        net_id = self.blue.create_network("t1", "net")["uuid"]
+        for i in range(10):
+            port, status = self.blue.create_and_plug_port(
+                    "t1", net_id, "vif%d" % i, True)
+            self.assertEqual(status, "UP")
+
+    def test_port_lifecycle(self):
+        net_id = self.blue.create_network("t1", "net")["uuid"]
+        port_id = self.blue.create_enabled_port("t1", net_id)["uuid"]
+        self.blue.plug_vif_interface(net_id, port_id, "vif")
+        found = self.blue.query_ports(net_id, fields=["uuid"],
+                                      filters={"attachment": "vif"})
+        self.assertEqual([p["uuid"] for p in found["results"]], [port_id])
+        port = self.blue.get_port(net_id, port_id,
+                                  relations="LogicalPortAttachment")
+        self.assertEqual(port["_relations"]["LogicalPortAttachment"],
+                         {"type": "VifAttachment", "vif_uuid": "vif"})
+        self.assertEqual(self.blue.get_port_link_status(net_id, port_id),
+                         "UP")
+        self.blue.unplug_interface(net_id, port_id)
+        self.blue.update_port(net_id, port_id, state=False)
+        self.assertEqual(self.blue.get_port_link_status(net_id, port_id),
+                         "DOWN")
+        self.assertEqual(self.blue.get_port_stats(net_id, port_id)
+                         ["rx_bytes"], 0)
+
+
+class TestHungController(test.TestCase):
+    """A controller that answers slower than http_timeout"""
+
+    def setUp(self):
+        store = fake_nvp.Store()
+        self.slow = fake_nvp.FakeNvp(store).start()
+        self.fast = fake_nvp.FakeNvp(store).start()
+        path = fake_nvp.write_config([self.slow, self.fast],
+                                     "BREAKER_THRESHOLD = 1", http_timeout=1)
+        try:
+            self.blue = blue.Blue(path)
+        finally:
+            os.remove(path)
+        self.net_id = store.add_switch({"display_name": "net"})["uuid"]
+        # log both clients in before the slow one hangs
+        for conn in self.blue.connections:
+            self.blue._probe(conn)
+        self.slow.latency = 2
+        first, second = self.blue.connections
+        self.blue.selector.record_success(first, 0.001)
+        self.blue.selector.record_success(second, 0.5)
+
+    def tearDown(self):
+        self.blue.selector.stop_probe()
+        self.slow.stop()
+        self.fast.stop()
+
+    def test_timeout_trips_breaker_and_fails_over(self):
+        network = self.blue.get_network(self.net_id)
+        self.assertEqual(network["display_name"], "net")
+        states = self.blue.breaker_states()
+        self.assertEqual(states[0]["state"], "open")
+        self.assertEqual(states[0]["failures"], 1)
+        self.assertEqual(states[1]["state"], "closed")
+        self.assertFalse(self.blue.controller_stats()[0]["healthy"])
+        start = time.time()
+        self.blue.get_network(self.net_id)
+        self.assertTrue(time.time() - start < 1)
+
+    def test_timed_out_create_not_retried(self):
+        posts = self.fast.requests.get("POST", 0)
+        # what aiclib raises once a read timed out
+        self.assertRaises(UnboundLocalError, self.blue.create_enabled_port,
+                          "t1", self.net_id)
+        self.assertEqual(self.fast.requests.get("POST", 0), posts)
@@ -0,0 +1,129 @@
+import socket
+
+from aicq import blue
+from aicq import metrics
+from aicq import test
+
+
+def _find(entries, name, **labels):
+    for entry in entries:
+        if entry["name"] == name and \
+                all(entry["labels"].get(k) == v for k, v in labels.items()):
+            return entry
+    return None
+
+
+class TestSinks(test.TestCase):
+    def test_histogram_buckets(self):
+        histogram = metrics.Histogram((0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 5):
+            histogram.observe(value)
+        self.assertEqual(histogram.cumulative(),
+                         [(0.1, 1), (1.0, 3), ("+Inf", 4)])
+
+    def test_memory_snapshot(self):
+        sink = metrics.MemorySink()
+        sink.observe("call", {"op": "a"}, 0.01)
+        sink.observe("call", {"op": "a"}, 0.02, KeyError())
+        sink.incr("failover", {"conn_id": 0})
+        snapshot = sink.snapshot()
+        latency = _find(snapshot["latency"], "call", op="a")
+        self.assertEqual(latency["count"], 2)
+        errors = _find(snapshot["counters"], "call_errors", error="KeyError")
+        self.assertEqual(errors["count"], 1)
+        self.assertEqual(
+            _find(snapshot["counters"], "failover")["count"], 1)
+
+    def test_prometheus_text(self):
+        sink = metrics.PrometheusSink(buckets=(0.1,))
+        sink.observe("request", {"op": "get_network", "conn_id": 1}, 0.05)
+        text = sink.render()
+        self.assertTrue("# TYPE aicq_request_seconds histogram" in text)
+        self.assertTrue('aicq_request_seconds_bucket{conn_id="1",'
+                        'op="get_network",le="0.1"} 1' in text)
+        self.assertTrue('aicq_request_seconds_count{conn_id="1",'
+                        'op="get_network"} 1' in text)
+
+    def test_statsd_packets(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(("127.0.0.1", 0))
+        server.settimeout(5)
+        sink = metrics.StatsdSink("127.0.0.1:%d" % server.getsockname()[1])
+        sink.observe("request", {"op": "get_network", "conn_id": 0}, 0.0125,
+                     KeyError())
+        self.assertEqual(server.recv(512),
+                         "aicq.request.0.get_network:12.500|ms")
+        self.assertEqual(server.recv(512),
+                         "aicq.request_errors.0.KeyError.get_network:1|c")
+        server.close()
+
+
+class TestBlueMetrics(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue("METRICS = memory")
+        self.lswitch = self.blue.clients[0].lswitch.return_value
+
+    def test_disabled_by_default(self):
+        b = test.make_blue()
+        self.assertFalse(b.metrics.enabled)
+        self.assertEqual(b.metrics_snapshot(), None)
+
+    def test_calls_and_requests(self):
+        self.lswitch.read.return_value = test.switch("net", "t1")
+        self.blue.check_tenant("net", "t1")
+        snapshot = self.blue.metrics_snapshot()
+        for op in ("check_tenant", "get_network"):
+            self.assertEqual(_find(snapshot["latency"], "call", op=op,
+                                   layer="blue")["count"], 1)
+        request = _find(snapshot["latency"], "request", op="get_network")
+        self.assertEqual(request["labels"]["conn_id"], 0)
+
+    def test_errors_and_failover(self):
+        self.lswitch.read.side_effect = blue.aiclib.nvp.RequestTimeout()
+        self.blue.clients[1].lswitch.return_value.read.return_value = {}
+        self.blue.get_network("net")
+        snapshot = self.blue.metrics_snapshot()
+        self.assertEqual(_find(snapshot["counters"], "request_errors",
+                               conn_id=0, error="RequestTimeout")["count"], 1)
+        self.assertEqual(_find(snapshot["counters"], "failover",
+                               conn_id=0)["count"], 1)
+        self.assertEqual(_find(snapshot["latency"], "request",
+                               conn_id=1)["count"], 1)
+
+    def test_bulk_requests_labelled(self):
+        lport = self.blue.clients[0].lswitch_port.return_value
+        lport.query.return_value.results.return_value = {
+            "results": [{"uuid": "p%d" % i} for i in range(6)]}
+        self.blue.delete_all_ports("net", max_workers=3)
+        snapshot = self.blue.metrics_snapshot()
+        self.assertEqual(_find(snapshot["latency"], "request",
+                               op="delete_all_ports")["count"], 6)
+        self.assertEqual(_find(snapshot["latency"], "request", op=None),
+                         None)
+
+    def test_iteration_timed(self):
+        query = self.lswitch.query.return_value
+        query.query = {}
+        query.results.side_effect = [
+            {"results": [test.switch("a", "t1")], "page_cursor": "next"},
+            {"results": [test.switch("b", "t1")]}]
+        networks = self.blue.iter_networks("t1")
+        networks.next()
+        snapshot = self.blue.metrics_snapshot()
+        self.assertEqual(_find(snapshot["latency"], "call",
+                               op="iter_networks"), None)
+        self.assertEqual(len(list(networks)), 1)
+        snapshot = self.blue.metrics_snapshot()
+        self.assertEqual(_find(snapshot["latency"], "call",
+                               op="iter_networks")["count"], 1)
+        request = _find(snapshot["latency"], "request", op="query_networks")
+        self.assertEqual(request["count"], 2)
+
+    def test_iteration_error_counted(self):
+        query = self.lswitch.query.return_value
+        query.results.side_effect = blue.aiclib.nvp.NVPException()
+        self.assertRaises(blue.aiclib.nvp.NVPException, list,
+                          self.blue.iter_networks("t1"))
+        snapshot = self.blue.metrics_snapshot()
+        self.assertEqual(_find(snapshot["counters"], "call_errors",
+                               op="iter_networks")["count"], 1)
@@ -0,0 +1,247 @@
+import itertools
+
+import mock
+
+from aicq import nvplib
+from aicq import test
+
+
+class TestGetAllNetworks(test.TestCase):
+    def test_merge_skips_known_and_repeated(self):
+        networks = [{"id": "a", "name": "a"}]
+        switches = iter([{"uuid": "a", "display_name": "a"},
+                         {"uuid": "b", "display_name": "b"},
+                         {"uuid": "b", "display_name": "b"}])
+        nvplib.merge_networks(networks, switches)
+        self.assertEqual([n["id"] for n in networks], ["a", "b"])
+
+    def test_get_all_networks_streams(self):
+        blue = test.make_blue()
+        query = blue.clients[0].lswitch.return_value.query.return_value
+        query.results.return_value = {
+            "results": [{"uuid": "a", "display_name": "net a"}]}
+        networks = nvplib.get_all_networks(blue, "t1", [])
+        self.assertEqual(networks, [{"id": "a", "name": "net a"}])
+        query.tags.assert_called_once_with(["t1"])
+        query.tagscopes.assert_called_once_with(["os_tid"])
+        query.fields.assert_called_once_with(["uuid", "display_name"])
+
+    def test_query_networks_projects(self):
+        blue = test.make_blue()
+        query = blue.clients[0].lswitch.return_value.query.return_value
+        query.results.return_value = {
+            "results": [{"uuid": "a", "display_name": "net a"}]}
+        nets = nvplib.query_networks(blue, "t1")
+        self.assertEqual(nets, [{"id": "a", "name": "net a"}])
+        query.fields.assert_called_once_with(["uuid", "display_name"])
+
+
+class TestGetNetworksDetails(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue()
+        client = self.blue.clients[0]
+        query = client.lswitch.return_value.query.return_value
+        query.results.return_value = {"results": [
+            test.switch("a", "t1"), test.switch("b", "t1"),
+            test.switch("c", "t2"), test.switch("d", "t1")]}
+        ports = client.lswitch_port.return_value.query.return_value
+        ports.results.return_value = {"results": [
+            {"uuid": "p1", "_relations": {"LogicalPortAttachment": {
+                "type": "VifAttachment", "vif_uuid": "vif1"}}},
+            {"uuid": "p2", "_relations": {"LogicalPortAttachment": {
+                "type": "NoAttachment"}}}]}
+
+    def test_batch(self):
+        details = nvplib.get_networks_details(self.blue, "t1",
+                                              ["a", "b", "c", "x"])
+        self.assertEqual(sorted(details.keys()), ["a", "b"])
+        self.assertEqual(details["a"], {"id": "a", "name": "a",
+                                        "ifaces": ["vif1"],
+                                        "net-op-status": "UP"})
+        client = self.blue.clients[0]
+        self.assertEqual(client.lswitch.call_count, 1)
+        self.assertFalse(client.lswitch.return_value.read.called)
+        query = client.lswitch.return_value.query.return_value
+        query.tags.assert_called_once_with(["t1"])
+        query.tagscopes.assert_called_once_with(["os_tid"])
+
+
+class TestCreatePort(test.TestCase):
+    def test_create_port_two_requests(self):
+        blue = test.make_blue()
+        lport = blue.clients[0].lswitch_port.return_value
+        lport.create.return_value = {"uuid": "port"}
+        lport.status.return_value = {"link_status_up": True}
+        port = nvplib.create_port("t1", "net", "ACTIVE", controller=blue)
+        self.assertEqual(port["port-op-status"], "UP")
+        lport.admin_status_enabled.assert_called_with(True)
+        self.assertFalse(blue.clients[0].lswitch.called)
+
+    def test_create_and_plug_conflict(self):
+        blue = test.make_blue()
+        lport = blue.clients[0].lswitch_port.return_value
+        lport.create.return_value = {"uuid": "port"}
+        lport.attachment_vif.side_effect = nvplib.aiclib.nvp.Conflict()
+        self.assertRaises(nvplib.exception.AlreadyAttached,
+                          nvplib.create_and_plug_port, "t1", "net", "vif",
+                          "ACTIVE", controller=blue)
+
+
+class TestCreatePorts(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue()
+        self.client = self.blue.clients[0]
+        self.client.lswitch_port.side_effect = self._lswitch_port
+        probe = self.client.lswitch.return_value.query.return_value
+        probe.results.return_value = {"results": [test.switch("net", "t1")]}
+        self.deleted = []
+        self.fail = set()
+        self.uuids = itertools.count()
+
+    def _lswitch_port(self, net_id, port_id=None):
+        port = mock.MagicMock(spec=nvplib.aiclib.nvp.nvpentity.LSwitchPort)
+        if port_id is None:
+            def create():
+                enabled = port.admin_status_enabled.call_args[0][0]
+                uuid = "port%d" % self.uuids.next()
+                if not enabled and "DOWN" in self.fail:
+                    raise nvplib.aiclib.nvp.NVPException()
+                return {"uuid": uuid, "admin_status_enabled": enabled}
+            port.create.side_effect = create
+        else:
+            port.status.return_value = {"link_status_up": True}
+            if port_id in self.fail:
+                port.status.side_effect = nvplib.aiclib.nvp.NVPException()
+            port.delete.side_effect = lambda: self.deleted.append(port_id)
+        return port
+
+    def test_count(self):
+        ports = nvplib.create_ports("t1", "net", 5, "ACTIVE",
+                                    controller=self.blue)
+        self.assertEqual(len(set(p["uuid"] for p in ports)), 5)
+        self.assertEqual(set(p["port-op-status"] for p in ports),
+                         set(["UP"]))
+        probe = self.client.lswitch.return_value.query.return_value
+        self.assertEqual(probe.results.call_count, 1)
+
+    def test_specs_keep_order(self):
+        specs = [{}, {"state": "DOWN"}, {}, {"state": "DOWN"}]
+        ports = nvplib.create_ports("t1", "net", specs, "ACTIVE",
+                                    controller=self.blue)
+        self.assertEqual([p["admin_status_enabled"] for p in ports],
+                         [True, False, True, False])
+
+    def test_invalid_state_creates_nothing(self):
+        self.assertRaises(nvplib.exception.StateInvalid, nvplib.create_ports,
+                          "t1", "net", [{}, {"state": "BROKEN"}], "ACTIVE",
+                          controller=self.blue)
+        self.assertFalse(self.client.lswitch_port.called)
+
+    def test_failure_rolls_back(self):
+        self.fail.add("DOWN")
+        specs = [{}, {"state": "DOWN"}, {}]
+        self.assertRaises(nvplib.exception.QuantumException,
+                          nvplib.create_ports, "t1", "net", specs, "ACTIVE",
+                          controller=self.blue)
+        self.assertEqual(len(self.deleted), 2)
+
+    def test_status_failure_rolls_back_its_port(self):
+        self.fail.add("port1")
+        self.assertRaises(nvplib.exception.QuantumException,
+                          nvplib.create_ports, "t1", "net", 3, "ACTIVE",
+                          controller=self.blue, max_workers=1)
+        self.assertEqual(sorted(self.deleted), ["port0", "port1", "port2"])
+
+    def test_rollback_failure_logged(self):
+        self.fail.add("DOWN")
+        delete = self.blue.delete_port = mock.Mock(
+                side_effect=nvplib.aiclib.nvp.Conflict())
+        with mock.patch.object(nvplib.LOG, "error") as error:
+            self.assertRaises(nvplib.exception.QuantumException,
+                              nvplib.create_ports, "t1", "net",
+                              [{}, {"state": "DOWN"}], "ACTIVE",
+                              controller=self.blue, max_workers=1)
+        delete.assert_called_once_with("net", "port0")
+        self.assertTrue("port0" in error.call_args[0][0])
+
+
+class TestDeleteAllPorts(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue()
+        self.report = {"deleted": ["p1"], "not_found": ["p2"], "failed": {}}
+        self.blue.delete_all_ports = mock.Mock(return_value=self.report)
+
+    def test_gone_ports_ignored(self):
+        self.assertEqual(nvplib.delete_all_ports(self.blue, "net"),
+                         self.report)
+
+    def test_failure_raises(self):
+        self.report["failed"]["p3"] = nvplib.aiclib.nvp.NVPException()
+        self.assertRaises(nvplib.exception.QuantumException,
+                          nvplib.delete_all_ports, self.blue, "net")
+
+
+class TestDeleteNetworks(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue()
+        self.report = {"deleted": ["n1"], "not_found": ["n2"],
+                       "failed": {"n3": nvplib.aiclib.nvp.Conflict()}}
+        self.blue.delete_networks = mock.Mock(return_value=self.report)
+
+    def test_concurrent_failures_mapped(self):
+        report = nvplib.delete_networks(self.blue, ["n1", "n2", "n3"],
+                                        concurrent=True)
+        self.assertEqual(report["deleted"], ["n1"])
+        self.assertEqual(report["not_found"], ["n2"])
+        self.assertTrue(isinstance(report["failed"]["n3"],
+                                   nvplib.exception.QuantumException))
+
+    def test_sequential_not_found_raises(self):
+        self.blue.delete_network = mock.Mock(
+                side_effect=nvplib.aiclib.nvp.ResourceNotFound())
+        self.assertRaises(nvplib.exception.NetworkNotFound,
+                          nvplib.delete_networks, self.blue, ["n1"])
+
+
+class TestBatchPlug(test.TestCase):
+    def setUp(self):
+        self.blue = test.make_blue()
+        self.client = self.blue.clients[0]
+        self.client.lswitch_port.side_effect = self._lswitch_port
+        query = self.client.lswitch.return_value.query.return_value
+        query.results.side_effect = lambda: {
+            "results": [test.switch(query.uuid.call_args[0][0], "t1")]}
+        self.query = query
+
+    def _lswitch_port(self, net_id, port_id=None):
+        port = mock.MagicMock(spec=nvplib.aiclib.nvp.nvpentity.LSwitchPort)
+        if port_id == "taken":
+            port.attachment_vif.side_effect = nvplib.aiclib.nvp.Conflict()
+        if port_id == "gone":
+            port._action.side_effect = nvplib.aiclib.nvp.ResourceNotFound()
+        return port
+
+    def test_plug_interfaces(self):
+        attachments = [("net", "p1", "vif1"), ("net", "taken", "vif2"),
+                       ("net", "p3", "vif3")]
+        outcomes = nvplib.plug_interfaces(self.blue, attachments)
+        self.assertEqual([o[0] for o in outcomes], attachments)
+        self.assertEqual([o[2] is None for o in outcomes],
+                         [True, False, True])
+        self.assertTrue(isinstance(outcomes[1][2],
+                                   nvplib.exception.AlreadyAttached))
+
+    def test_unplug_interfaces(self):
+        outcomes = nvplib.unplug_interfaces(self.blue, [("net", "gone"),
+                                                        ("net", "p2")])
+        self.assertTrue(isinstance(outcomes[0][2],
+                                   nvplib.exception.PortNotFound))
+        self.assertEqual(outcomes[1][2], None)
+
+    def test_check_tenants_once_per_network(self):
+        checks = nvplib.check_tenants(self.blue, ["a", "b", "a", "b"], "t1")
+        self.assertEqual(checks, {"a": None, "b": None})
+        self.assertEqual(self.query.results.call_count, 2)
+        checks = nvplib.check_tenants(self.blue, ["a", "c"], "t2")
+        self.assertTrue(isinstance(checks["a"],
+                                   nvplib.exception.NetworkNotFound))
@@ -0,0 +1,210 @@
+"""Measures aicq's own overhead against the in-process fake NVP controller
+(aicq.fake_nvp): throughput and p50/p99 latency of the NvpPlugin
+operations, of requests failing over from a dead controller, and of the
+bulk paths. A fixed controller latency can be added to see how well
+requests overlap.
+
+    python benchmarks/bench_fake_nvp.py [-n 200] [-c 8] [--latency 0.001]
+"""
+import logging
+import optparse
+import os
+import time
+
+from aicq import blue
+from aicq import fake_nvp
+from aicq import pool
+from aicq import QuantumPlugin
+
+TENANT = "bench-tenant"
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def measure(name, func, items, concurrency, expect_errors=False):
+    """Calls func(item) for every item on concurrency threads and prints
+    the throughput, latency percentiles and error count. Unless
+    expect_errors is set a failed call stops the benchmark; with it set
+    every call has to fail."""
+    latencies = []
+
+    def call(item):
+        start = time.time()
+        try:
+            return func(item)
+        finally:
+            latencies.append(time.time() - start)
+
+    start = time.time()
+    outcomes = pool.run(call, items, concurrency)
+    elapsed = time.time() - start
+    errors = [e for item, result, e in outcomes if e is not None]
+    print "%-28s %6d %10.1f %9.2f %9.2f %6d" % (
+        name, len(outcomes), len(outcomes) / max(elapsed, 1e-9),
+        percentile(latencies, 0.5) * 1000,
+        percentile(latencies, 0.99) * 1000, len(errors))
+    if errors and not expect_errors:
+        raise BenchmarkError("%s: %d of %d calls failed, the first with "
+                             "%r" % (name, len(errors), len(outcomes),
+                                     errors[0]))
+    if expect_errors and len(errors) < len(outcomes):
+        raise BenchmarkError("%s: %d of %d calls succeeded" %
+                             (name, len(outcomes) - len(errors),
+                              len(outcomes)))
+    return [result for item, result, e in outcomes]
+
+
+def header(title):
+    print
+    print title
+    print "%-28s %6s %10s %9s %9s %6s" % ("operation", "ops", "ops/s",
+                                          "p50 ms", "p99 ms", "errors")
+
+
+def make_blue(controllers, extra=""):
+    path = fake_nvp.write_config(controllers, extra)
+    try:
+        return blue.Blue(path)
+    finally:
+        os.remove(path)
+
+
+def seed(store, networks, ports_per_network=0):
+    """Creates switches owned by TENANT straight in the store"""
+    net_ids = []
+    for i in xrange(networks):
+        switch = store.add_switch(
+                {"display_name": "bench-%d" % i,
+                 "tags": [{"tag": TENANT, "scope": "os_tid"}]})
+        for j in xrange(ports_per_network):
+            store.add_port(switch["uuid"], {})
+        net_ids.append(switch["uuid"])
+    return net_ids
+
+
+def bench_plugin(options):
+    nvp = fake_nvp.FakeNvp(latency=options.latency).start()
+    path = fake_nvp.write_config([nvp])
+    try:
+        plugin = QuantumPlugin.NvpPlugin(path)
+    finally:
+        os.remove(path)
+    n, c = options.requests, options.concurrency
+    net_ids = seed(nvp.store, n)
+    net_id = net_ids[0]
+
+    header("NvpPlugin, %d ms controller latency" % (options.latency * 1000))
+    measure("create_network",
+            lambda i: plugin.create_network(TENANT, "net-%d" % i),
+            range(n), c)
+    measure("get_network_details",
+            lambda net: plugin.get_network_details(TENANT, net), net_ids, c)
+    measure("get_all_networks",
+            lambda i: plugin.get_all_networks(TENANT), range(n / 10 or 1), c)
+    ports = measure("create_port",
+                    lambda i: plugin.create_port(TENANT, net_id, "ACTIVE"),
+                    range(n), c)
+    port_ids = [p["id"] for p in ports]
+    batch_net = seed(nvp.store, 1)[0]
+    measure("create_ports (%d per call)" % n,
+            lambda i: plugin.create_ports(TENANT, batch_net, n, "ACTIVE"),
+            range(1), 1)
+    measure("get_port_details",
+            lambda port: plugin.get_port_details(TENANT, net_id, port),
+            port_ids, c)
+    measure("update_port",
+            lambda port: plugin.update_port(TENANT, net_id, port,
+                                            state="DOWN"),
+            port_ids, c)
+    measure("plug_interface",
+            lambda port: plugin.plug_interface(TENANT, net_id, port,
+                                               "vif-%s" % port),
+            port_ids, c)
+    measure("create_and_plug_port",
+            lambda i: plugin.create_and_plug_port(TENANT, batch_net,
+                                                  "vif-new-%d" % i, "ACTIVE"),
+            range(n), c)
+    measure("unplug_interface",
+            lambda port: plugin.unplug_interface(TENANT, net_id, port),
+            port_ids, c)
+    measure("get_all_ports",
+            lambda i: plugin.get_all_ports(TENANT, net_id),
+            range(n / 10 or 1), c)
+    measure("delete_port",
+            lambda port: plugin.delete_port(TENANT, net_id, port),
+            port_ids, c)
+    measure("delete_network",
+            lambda net: plugin.delete_network(TENANT, net), net_ids[1:], c)
+    plugin.blue.selector.stop_probe()
+    nvp.stop()
+
+
+def bench_failover(options):
+    store = fake_nvp.Store()
+    controllers = [fake_nvp.FakeNvp(store, latency=options.latency).start()
+                   for i in range(2)]
+    n, c = options.requests, options.concurrency
+    net_ids = seed(store, n)
+    b = make_blue(controllers)
+
+    header("Failover")
+    measure("get_network, healthy", b.get_network, net_ids, c)
+    controllers[0].down = True
+    measure("get_network, 1st down",
+            lambda net: b.get_network(net, fresh=True), net_ids, c)
+    controllers[1].down = True
+    measure("get_network, all down",
+            lambda net: b.get_network(net, fresh=True), net_ids[:c], c,
+            expect_errors=True)
+    print "breakers: %s" % dict((k, v["state"]) for k, v in
+                                b.breaker_states().items())
+    b.selector.stop_probe()
+    for nvp in controllers:
+        nvp.stop()
+
+
+def bench_bulk(options):
+    nvp = fake_nvp.FakeNvp(latency=options.latency).start()
+    b = make_blue([nvp], "BULK_CONCURRENCY = %d" % options.concurrency)
+    n = options.requests
+
+    header("Bulk paths")
+    net_id = seed(nvp.store, 1, n * 5)[0]
+    measure("iter_ports (%d ports)" % (n * 5),
+            lambda i: list(b.iter_ports(net_id, fields="uuid")), range(3), 1)
+    measure("delete_all_ports (%d)" % (n * 5),
+            lambda net: b.delete_all_ports(net), [net_id], 1)
+    net_ids = seed(nvp.store, n, 2)
+    measure("iter_networks (%d)" % n,
+            lambda i: list(b.iter_networks(TENANT)), range(3), 1)
+    measure("delete_networks (%d)" % n,
+            lambda nets: b.delete_networks(nets, delete_ports=True),
+            [net_ids], 1)
+    b.selector.stop_probe()
+    nvp.stop()
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--requests", type="int", default=200)
+    parser.add_option("-c", "--concurrency", type="int", default=8)
+    parser.add_option("--latency", type="float", default=0.0,
+                      help="seconds the fake controller adds per request")
+    options, args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    bench_plugin(options)
+    bench_failover(options)
+    bench_bulk(options)
+
+
+if __name__ == "__main__":
+    main()
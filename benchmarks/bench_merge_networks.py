@@ -0,0 +1,52 @@
+"""Times nvplib.merge_networks, the dedupe step of get_all_networks, for a
+growing number of switches. The cost per switch should stay flat; the
+list scan it replaced grew with the number of networks.
+
+    python benchmarks/bench_merge_networks.py
+"""
+import time
+
+from aicq import nvplib
+
+SIZES = [1000, 2000, 4000, 8000, 16000, 32000]
+
+
+def legacy_merge(networks, switches):
+    for switch in switches:
+        net_id = switch['uuid']
+        if net_id not in [x['id'] for x in networks]:
+            networks.append({"id": net_id,
+                             "name": switch["display_name"]})
+    return networks
+
+
+def workload(size):
+    """Half of the switches are already in the network list"""
+    switches = [{"uuid": "net-%d" % i, "display_name": "net %d" % i}
+                for i in xrange(size)]
+    networks = [{"id": s["uuid"], "name": s["display_name"]}
+                for s in switches[::2]]
+    return networks, switches
+
+
+def timed(merge, size):
+    networks, switches = workload(size)
+    start = time.time()
+    merge(networks, iter(switches))
+    return time.time() - start
+
+
+def main():
+    print "%8s %12s %14s %14s" % (
+            "switches", "merge (s)", "us/switch", "legacy (s)")
+    for size in SIZES:
+        elapsed = timed(nvplib.merge_networks, size)
+        legacy = "-"
+        if size <= 4000:
+            legacy = "%.4f" % timed(legacy_merge, size)
+        print "%8d %12.4f %14.3f %14s" % (
+                size, elapsed, elapsed / size * 1e6, legacy)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Measures what a restarting Quantum server or agent pays before aicq can
+serve: the cold import time of each aicq module, and for a fresh process
+the time to import aicq.blue, build a Blue and complete the first
+controller request against a local fake_nvp controller. Every sample runs
+in a new interpreter so nothing is already imported.
+
+    python benchmarks/bench_startup.py [-n 10]
+"""
+import optparse
+import os
+import subprocess
+import sys
+
+from aicq import fake_nvp
+
+MODULES = ["aicq.blue", "aicq.nvplib", "aicq.QuantumPlugin"]
+
+IMPORT = """
+import time
+start = time.time()
+import %s
+print time.time() - start
+"""
+
+FIRST_REQUEST = """
+import logging
+import time
+logging.disable(logging.CRITICAL)
+start = time.time()
+import aicq.blue
+imported = time.time()
+blue = aicq.blue.Blue(%(path)r)
+built = time.time()
+blue.get_network(%(net_id)r)
+done = time.time()
+print imported - start, built - imported, done - built, done - start
+"""
+
+
+class BenchmarkError(Exception):
+    pass
+
+
+def run(source):
+    """Runs source in a new interpreter and returns the numbers it
+    printed. A failing sample stops the benchmark with its stderr."""
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+            [root] + filter(None, [env.get("PYTHONPATH")]))
+    process = subprocess.Popen([sys.executable, "-c", source], env=env,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+    output, errors = process.communicate()
+    if process.returncode:
+        raise BenchmarkError("sample exited with %d:\n%s" %
+                             (process.returncode, errors))
+    return [float(x) for x in output.split()]
+
+
+def median(samples):
+    ordered = sorted(samples)
+    return ordered[len(ordered) / 2]
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--samples", type="int", default=10)
+    options, args = parser.parse_args()
+
+    print "%-28s %10s" % ("cold import", "median ms")
+    for module in MODULES:
+        samples = [run(IMPORT % module)[0] for i in xrange(options.samples)]
+        print "%-28s %10.1f" % (module, median(samples) * 1000)
+
+    nvp = fake_nvp.FakeNvp().start()
+    net_id = nvp.store.add_switch({})["uuid"]
+    path = fake_nvp.write_config([nvp])
+    try:
+        samples = [run(FIRST_REQUEST % {"path": path, "net_id": net_id})
+                   for i in xrange(options.samples)]
+    finally:
+        os.remove(path)
+        nvp.stop()
+    print
+    print "%-28s %10s" % ("first request", "median ms")
+    for index, phase in enumerate(["import aicq.blue", "Blue()",
+                                   "first get_network", "total"]):
+        print "%-28s %10.1f" % (phase, median([s[index] for s in samples])
+                                * 1000)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Measures listing one tenant's networks against a fake_nvp controller that
+holds the switches of many tenants. The unfiltered query, which is what
+get_all_networks sent before query_networks filtered by os_tid, is
+compared with query_networks as it is now. Each row reports how long a
+listing takes, how many switches it returns and how many response bytes
+the controller sent.
+
+    python benchmarks/bench_tenant_query.py [-t 200] [-n 10] [-r 20]
+"""
+import logging
+import optparse
+import os
+import time
+
+from aicq import blue
+from aicq import fake_nvp
+
+
+def seed(store, tenants, networks):
+    for t in xrange(tenants):
+        for i in xrange(networks):
+            store.add_switch(
+                    {"display_name": "tenant-%d-net-%d" % (t, i),
+                     "tags": [{"tag": "tenant-%d" % t, "scope": "os_tid"},
+                              {"tag": "bench", "scope": "owner"}]})
+
+
+def unfiltered(b):
+    """The switches get_all_networks used to page through"""
+    def fetch(cursor):
+
+        def page(connection):
+            q = connection.lswitch().query()
+            q.fields("*")
+            blue._paginate(q, b.page_size, cursor)
+            return q.results()
+        return b._request(page)
+    return list(blue._iterate_pages(fetch))
+
+
+def filtered(b, tenant_id):
+    return list(b.iter_networks(tenant_id, fields=["uuid", "display_name"]))
+
+
+def measure(name, nvp, func, repeat):
+    before = nvp.bytes_sent
+    start = time.time()
+    for i in xrange(repeat):
+        switches = func()
+    elapsed = (time.time() - start) / repeat
+    sent = (nvp.bytes_sent - before) / repeat
+    print "%-24s %10.2f %10d %12d" % (name, elapsed * 1000, len(switches),
+                                      sent)
+
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("-t", "--tenants", type="int", default=200)
+    parser.add_option("-n", "--networks", type="int", default=10,
+                      help="networks per tenant")
+    parser.add_option("-r", "--repeat", type="int", default=20)
+    options, args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    nvp = fake_nvp.FakeNvp().start()
+    seed(nvp.store, options.tenants, options.networks)
+    path = fake_nvp.write_config([nvp])
+    try:
+        b = blue.Blue(path)
+    finally:
+        os.remove(path)
+    tenant_id = "tenant-%d" % (options.tenants / 2)
+
+    print "%d tenants, %d networks each" % (options.tenants,
+                                            options.networks)
+    print "%-24s %10s %10s %12s" % ("listing", "ms", "switches",
+                                    "bytes sent")
+    measure("unfiltered, all fields", nvp,
+            lambda: unfiltered(b), options.repeat)
+    measure("query_networks", nvp,
+            lambda: filtered(b, tenant_id), options.repeat)
+    b.selector.stop_probe()
+    nvp.stop()
+
+
+if __name__ == "__main__":
+    main()